@@ -1,2 +1,31 @@
-from loader import load
-from schedule import Schedule
+"""GTFS feeds compiled into SQLite.
+
+load, update and Schedule, and with them SQLAlchemy, are only imported
+when first used, so that modules which don't need them, gtfs.snapshot
+above all, can be imported without paying for it."""
+
+import sys
+
+
+class _Package(type(sys)):
+
+    lazy = {'load': 'gtfs.loader', 'update': 'gtfs.loader',
+            'Schedule': 'gtfs.schedule'}
+
+    def __getattr__(self, name):
+        if name not in self.lazy:
+            raise AttributeError(name)
+        value = getattr(__import__(self.lazy[name], fromlist=[name]), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self.lazy))
+
+
+_package = _Package(__name__, __doc__)
+_package.__dict__.update((key, value) for (key, value) in globals().items()
+                         if key.startswith("__") and key != "__doc__")
+# Python 2 clears a module's globals when it's garbage collected
+_package._module = sys.modules[__name__]
+sys.modules[__name__] = _package
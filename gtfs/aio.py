@@ -0,0 +1,145 @@
+"""Awaitable lookups on a schedule, for asyncio servers, or trollius ones
+on Python 2.
+
+An AsyncSchedule opens its database read-only and runs every query on a
+bounded pool of worker threads, each with its own session and pooled
+SQLite connection, so the event loop never waits on SQLite, which
+releases the GIL while it works. Each lookup returns a future:
+
+    schedule = AsyncSchedule("bart.db")
+    departures = yield From(schedule.departures("POWL", date.today(),
+                                                "08:00:00", "09:00:00"))
+
+Identical lookups made while one is already in flight share its result
+rather than queueing another query, so a burst of requests for the same
+stop costs one query. Entities come back detached from any session: what
+was loaded can be read, but relationships that weren't loaded raise
+rather than quietly blocking the loop on a lazy load.
+
+Requires asyncio, or on Python 2 trollius and futures: the aio extra."""
+
+from functools import partial
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.orm import joinedload
+
+from gtfs.schedule import Schedule
+from gtfs.entity import Stop, Route, Trip, StopTime
+
+
+def _stops(schedule):
+    return schedule.stops
+
+
+def _routes(schedule):
+    return schedule.routes
+
+
+def _get(gtfs_class, schedule, key):
+    return schedule.session.query(gtfs_class).get(key)
+
+
+def _trip_stop_times(schedule, trip_id):
+    return schedule.session.query(StopTime).options(joinedload('stop')). \
+        filter_by(trip_id=trip_id).order_by(StopTime.stop_sequence).all()
+
+
+class AsyncSchedule(object):
+
+    def __init__(self, db_filename, workers=4, loop=None, **kwargs):
+        """Opens db_filename read-only, to be queried by workers threads on
+        loop, or the current event loop. Other keyword arguments are
+        passed on to Schedule."""
+        self.schedule = Schedule(db_filename, readonly=True,
+                                 pool_size=workers, **kwargs)
+        self.executor = ThreadPoolExecutor(workers)
+        self.loop = loop or asyncio.get_event_loop()
+        self.in_flight = {}
+
+    def _call(self, function, *args):
+        try:
+            return function(self.schedule, *args)
+        finally:
+            # detaches whatever was loaded and returns the connection
+            self.schedule.session.close()
+
+    def run(self, function, *args):
+        """Returns a future of function(schedule, *args), called in a
+        worker thread with the underlying Schedule"""
+        return self.loop.run_in_executor(self.executor,
+                                         partial(self._call, function), *args)
+
+    def _coalesced(self, key, function, *args):
+        future = self.in_flight.get(key)
+        if future is None:
+            future = self.run(function, *args)
+            self.in_flight[key] = future
+
+            def done(future):
+                if self.in_flight.get(key) is future:
+                    del self.in_flight[key]
+            future.add_done_callback(done)
+        # so that one caller giving up doesn't cancel the others
+        return asyncio.shield(future)
+
+    def stops(self):
+        return self._coalesced(("stops",), _stops)
+
+    def routes(self):
+        return self._coalesced(("routes",), _routes)
+
+    def stop(self, stop_id):
+        """A future of the Stop stop_id, or None"""
+        return self._coalesced(("stop", stop_id), partial(_get, Stop),
+                               stop_id)
+
+    def route(self, route_id):
+        return self._coalesced(("route", route_id), partial(_get, Route),
+                               route_id)
+
+    def trip(self, trip_id):
+        return self._coalesced(("trip", trip_id), partial(_get, Trip),
+                               trip_id)
+
+    def trip_stop_times(self, trip_id):
+        """A future of the StopTimes of trip_id in order, with their stops
+        loaded"""
+        return self._coalesced(("trip_stop_times", trip_id),
+                               _trip_stop_times, trip_id)
+
+    def service_for_date(self, service_date):
+        return self._coalesced(("service_for_date", service_date),
+                               Schedule.service_for_date, service_date)
+
+    def departures(self, stop_id, service_date, start, end):
+        """A future of Schedule.departures"""
+        return self._coalesced(("departures", stop_id, service_date, start,
+                                end),
+                               Schedule.departures, stop_id, service_date,
+                               start, end)
+
+    def route_timetable(self, route_id, service_date):
+        """A future of Schedule.route_timetable, whose trips come with
+        their stop_times and stops loaded"""
+        return self._coalesced(("route_timetable", route_id, service_date),
+                               Schedule.route_timetable, route_id,
+                               service_date)
+
+    def stops_near(self, lat, lon, radius_m):
+        return self._coalesced(("stops_near", lat, lon, radius_m),
+                               Schedule.stops_near, lat, lon, radius_m)
+
+    def nearest_stops(self, lat, lon, k=1):
+        return self._coalesced(("nearest_stops", lat, lon, k),
+                               Schedule.nearest_stops, lat, lon, k)
+
+    def close(self):
+        """Waits for queries in flight, then closes the workers and every
+        connection"""
+        self.executor.shutdown(wait=True)
+        self.schedule.engine.dispose()
@@ -0,0 +1,228 @@
+"""Service-level summaries of a schedule, materialized into tables.
+
+For each day type, weekday, saturday and sunday, the summary tables hold
+the trips per hour of every route, the departures per hour from every
+stop, and the span and mean headway of every route direction and stop.
+A day type is summarized through one date: the first date of the most
+common combination of services running on that day of the week, so that
+holidays and one-off changes are passed over. Frequency-based trips are
+counted once per run.
+
+Everything is worked out by a few set-based GROUP BY queries over
+stop_times joined to trips, service_dates and the runs of frequencies,
+and written to the DayType, RouteHour, StopHour, RouteService and
+StopService tables, which the functions below then simply read. The
+tables are stamped with a digest of the feed_files checksums. They're
+built by load(..., summarize=True), or by refresh() on a writable
+Schedule, and update() builds them again once they have been built; the
+readers never write, so raise StaleSummaries if the tables are missing or
+were built from an older feed.
+
+    >>> schedule = load("feed.zip", "feed.db", summarize=True)
+    >>> analytics.trips_per_hour(schedule, "A", "saturday")
+    {5: 6, 6: 16, 7: 20, ...}
+
+Mean headways are (last - first) / (departures - 1), the mean of the gaps
+between consecutive departures."""
+
+import hashlib
+
+from gtfs.entity import DayType, SummaryFingerprint, RouteHour, StopHour
+from gtfs.entity import RouteService, StopService
+
+
+
+class StaleSummaries(Exception):
+    pass
+
+SUMMARY_CLASSES = (DayType, SummaryFingerprint, RouteHour, StopHour,
+                   RouteService, StopService)
+
+DAY_TYPES = """
+INSERT INTO day_types (day_type, date)
+SELECT day_type, date FROM
+(SELECT day_type, date, MAX(days) FROM
+ (SELECT day_type, services, MIN(date) AS date, COUNT(*) AS days FROM
+  (SELECT CASE strftime('%w', date) WHEN '0' THEN 'sunday'
+                                    WHEN '6' THEN 'saturday'
+                                    ELSE 'weekday' END AS day_type,
+          date, group_concat(service_id) AS services
+   FROM (SELECT date, service_id FROM service_dates
+         ORDER BY date, service_id)
+   GROUP BY date)
+  GROUP BY day_type, services)
+ GROUP BY day_type)
+"""
+
+# every run of every trip on each day type's date, with the time it
+# leaves its first stop; the times of a frequency-based trip's stop_times
+# only give the offsets of each run
+DAY_TRIPS = """
+INSERT INTO day_trips
+WITH RECURSIVE runs (trip_id, start, end_time, headway) AS
+ (SELECT trip_id, start_time, end_time, headway_secs FROM frequencies
+  WHERE headway_secs > 0
+  UNION ALL
+  SELECT trip_id, start + headway, end_time, headway FROM runs
+  WHERE start + headway < end_time)
+SELECT dt.day_type, t.trip_id, t.route_id, coalesce(t.direction_id, 0),
+       t.first_departure, coalesce(r.start, t.first_departure)
+FROM day_types dt
+JOIN service_dates d ON d.date = dt.date
+JOIN trips t ON t.service_id = d.service_id
+LEFT JOIN runs r ON r.trip_id = t.trip_id
+WHERE t.first_departure IS NOT NULL
+"""
+
+STOP_DEPARTURES = """
+FROM day_trips d JOIN stop_times st ON st.trip_id = d.trip_id
+WHERE st.departure_time IS NOT NULL
+"""
+DEPARTURE = "st.departure_time + d.start - d.first_departure"
+MEAN_HEADWAY = "CASE WHEN COUNT(*) > 1 THEN (MAX(%s) - MIN(%s)) * 1.0 / " \
+               "(COUNT(*) - 1) END"
+
+SUMMARIES = [
+    "INSERT INTO route_hours (day_type, route_id, hour, trips) "
+    "SELECT day_type, route_id, start / 3600, COUNT(*) FROM day_trips "
+    "GROUP BY day_type, route_id, start / 3600",
+
+    "INSERT INTO route_service (day_type, route_id, direction_id, trips, "
+    "                           first_departure, last_departure, "
+    "                           mean_headway) "
+    "SELECT day_type, route_id, direction_id, COUNT(*), MIN(start), "
+    "       MAX(start), %s FROM day_trips "
+    "GROUP BY day_type, route_id, direction_id" % (
+        MEAN_HEADWAY % ("start", "start")),
+
+    "INSERT INTO stop_hours (day_type, stop_id, hour, departures) "
+    "SELECT d.day_type, st.stop_id, (%s) / 3600, COUNT(*) %s "
+    "GROUP BY d.day_type, st.stop_id, (%s) / 3600" % (
+        DEPARTURE, STOP_DEPARTURES, DEPARTURE),
+
+    "INSERT INTO stop_service (day_type, stop_id, departures, "
+    "                          first_departure, last_departure, "
+    "                          mean_headway) "
+    "SELECT d.day_type, st.stop_id, COUNT(*), MIN(%s), MAX(%s), %s %s "
+    "GROUP BY d.day_type, st.stop_id" % (
+        DEPARTURE, DEPARTURE, MEAN_HEADWAY % (DEPARTURE, DEPARTURE),
+        STOP_DEPARTURES),
+]
+
+
+def _fingerprint(conn):
+    digest = hashlib.sha1()
+    for (filename, sha1) in conn.execute("SELECT filename, sha1 FROM "
+                                         "feed_files ORDER BY filename"):
+        digest.update("%s %s\n" % (filename, sha1))
+    return digest.hexdigest()
+
+
+def is_current(schedule):
+    """True if the summary tables were built from the feed as it is now"""
+    if not schedule.engine.has_table(SummaryFingerprint.__tablename__):
+        return False
+    conn = schedule.engine.connect()
+    try:
+        built = conn.execute("SELECT fingerprint FROM "
+                             "summary_fingerprint").scalar()
+        return built == _fingerprint(conn)
+    finally:
+        conn.close()
+
+
+def is_built(schedule):
+    """True if the summary tables have been built, whether or not they're
+    current"""
+    if not schedule.engine.has_table(SummaryFingerprint.__tablename__):
+        return False
+    return schedule.engine.execute("SELECT COUNT(*) FROM "
+                                   "summary_fingerprint").scalar() > 0
+
+
+def build(schedule):
+    """Computes every summary table afresh, in one transaction"""
+    if schedule.readonly:
+        raise StaleSummaries("the summary tables can't be built in a "
+                             "readonly Schedule")
+    schedule.create_tables()
+    conn = schedule.engine.connect()
+    try:
+        # pysqlite commits before DDL, so the temp table has to come first
+        conn.execute("DROP TABLE IF EXISTS temp.day_trips")
+        conn.execute("CREATE TEMP TABLE day_trips (day_type, trip_id, "
+                     "route_id, direction_id, first_departure, start)")
+        trans = conn.begin()
+        try:
+            for summary_class in SUMMARY_CLASSES:
+                conn.execute(summary_class.__table__.delete())
+            conn.execute(DAY_TYPES)
+            conn.execute(DAY_TRIPS)
+            for statement in SUMMARIES:
+                conn.execute(statement)
+            conn.execute(SummaryFingerprint.__table__.insert(),
+                         fingerprint=_fingerprint(conn))
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        conn.execute("DROP TABLE day_trips")
+    finally:
+        conn.close()
+
+
+def refresh(schedule):
+    """Builds the summary tables if they're missing or out of date.
+    Returns True if they had to be built."""
+    if is_current(schedule):
+        return False
+    build(schedule)
+    return True
+
+
+def _check(schedule):
+    if not is_current(schedule):
+        raise StaleSummaries("the summary tables are missing or out of "
+                             "date; build them with refresh() or "
+                             "load(..., summarize=True)")
+
+
+def day_types(schedule):
+    """Returns {day_type: the date summarized for it}"""
+    _check(schedule)
+    return dict((row.day_type, row.date)
+                for row in schedule.session.query(DayType))
+
+
+def trips_per_hour(schedule, route_id, day_type="weekday"):
+    """Returns {hour: trips} of route_id on day_type, for the hours in
+    which any of its trips start. Hours count from the start of the
+    service day, so may be 24 or more."""
+    _check(schedule)
+    return dict((row.hour, row.trips) for row in
+                schedule.session.query(RouteHour).filter_by(
+                    day_type=day_type, route_id=route_id))
+
+
+def departures_per_hour(schedule, stop_id, day_type="weekday"):
+    """Returns {hour: departures} from stop_id on day_type"""
+    _check(schedule)
+    return dict((row.hour, row.departures) for row in
+                schedule.session.query(StopHour).filter_by(
+                    day_type=day_type, stop_id=stop_id))
+
+
+def route_service(schedule, day_type="weekday"):
+    """Lists the RouteService of every route direction running on
+    day_type"""
+    _check(schedule)
+    return schedule.session.query(RouteService).filter_by(
+        day_type=day_type).order_by(RouteService.route_id,
+                                    RouteService.direction_id).all()
+
+
+def stop_service(schedule, day_type="weekday"):
+    """Lists the StopService of every stop served on day_type"""
+    _check(schedule)
+    return schedule.session.query(StopService).filter_by(
+        day_type=day_type).order_by(StopService.stop_id).all()
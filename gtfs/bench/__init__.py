@@ -0,0 +1,5 @@
+"""Benchmarks over synthetic feeds; see gtfs.bench.synthetic and
+gtfs.bench.runner, or run gtfs_bench."""
+
+from synthetic import generate_feed
+from runner import benchmark, run
@@ -0,0 +1,191 @@
+"""Times loading and querying synthetic feeds of increasing size.
+
+For each size, a feed is generated (or reused from the work directory) and
+then, in a fresh worker process so that peak memory is measured for that
+size alone, compiled to a database file, reopened, and queried:
+service_for_date over four weeks, and traversal of the stop_times of a
+sample of stops and trips through the ORM relationships. Every step
+records its wall-clock seconds and the peak RSS of the worker so far, and
+the traversals also the number of queries they ran. The results of a run
+are written out as JSON to compare against runs of other versions."""
+
+from optparse import OptionParser
+from datetime import date, timedelta, datetime
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import sqlalchemy
+
+from gtfs.bench.synthetic import generate_feed
+from gtfs.entity import Stop, Trip
+from gtfs.loader import load
+from gtfs.schedule import Schedule
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+FIRST_DAY = date(2024, 1, 1)
+
+
+def peak_rss():
+    """Peak resident set size of this process so far, in kilobytes"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+class Timer(object):
+    """Records the seconds and peak RSS of each step timed with it"""
+
+    def __init__(self):
+        self.steps = {}
+
+    def __call__(self, name, function, *args, **kwargs):
+        start = time.time()
+        value = function(*args, **kwargs)
+        self.steps[name] = {'seconds': round(time.time() - start, 4),
+                            'peak_rss_kb': peak_rss()}
+        return value
+
+
+def _traverse_stops(schedule, sample):
+    return sum(len(stop.stop_times) for stop in
+               schedule.session.query(Stop).limit(sample))
+
+
+def _traverse_trips(schedule, sample):
+    return sum(len([st.stop.stop_id for st in trip.stop_times])
+               for trip in schedule.session.query(Trip).limit(sample))
+
+
+def _service_for_dates(schedule, days):
+    return sum(len(schedule.service_for_date(FIRST_DAY + timedelta(days=i)))
+               for i in range(days))
+
+
+def benchmark(feed_filename, db_filename, bulk=False, jobs=1, sample=1000):
+    """Compiles feed_filename to db_filename and times the steps listed in
+    the module docstring, in this process. Returns a dict of results."""
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_filename + suffix):
+            os.remove(db_filename + suffix)
+
+    timer = Timer()
+    timer("load", load, feed_filename, db_filename, bulk=bulk, jobs=jobs,
+          progress=None)
+
+    schedule = timer("open", Schedule, db_filename, readonly=True)
+    stop_times = schedule.engine.execute(
+        "SELECT count(*) FROM stop_times").scalar()
+    timer("service_for_date", _service_for_dates, schedule, 28)
+    for (name, traverse) in (("stop_traversal", _traverse_stops),
+                             ("trip_traversal", _traverse_trips)):
+        schedule.session.expunge_all()
+        with schedule.capture_queries() as capture:
+            timer(name, traverse, schedule, sample)
+        timer.steps[name]['queries'] = len(capture)
+
+    return {'feed': os.path.basename(feed_filename),
+            'stop_times': stop_times,
+            'db_bytes': sum(os.path.getsize(db_filename + suffix)
+                            for suffix in ("", "-wal")
+                            if os.path.exists(db_filename + suffix)),
+            'steps': timer.steps}
+
+
+def _benchmark_in_worker(*args, **kwargs):
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(benchmark, args, kwargs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run(sizes=DEFAULT_SIZES, workdir=".", bulk=False, jobs=1, sample=1000,
+        seed=0):
+    """Benchmarks a synthetic feed of each of sizes stop times, generating
+    the feeds into workdir if they aren't there yet. Returns a list of
+    results, one per size."""
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    results = []
+    for size in sizes:
+        feed_filename = os.path.join(workdir,
+                                     "synthetic-%d-%d.zip" % (size, seed))
+        generated = None
+        if not os.path.exists(feed_filename):
+            start = time.time()
+            generate_feed(feed_filename, size, seed)
+            generated = round(time.time() - start, 4)
+
+        db_filename = os.path.splitext(feed_filename)[0] + ".db"
+        result = _benchmark_in_worker(feed_filename, db_filename, bulk=bulk,
+                                      jobs=jobs, sample=sample)
+        result['size'] = size
+        result['generate_seconds'] = generated
+        results.append(result)
+    return results
+
+
+def main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option("-s", "--sizes", dest="sizes",
+                      default=",".join(str(size) for size in DEFAULT_SIZES),
+                      help="comma-separated stop_times counts of the feeds "
+                           "to benchmark [default: %default]")
+    parser.add_option("-o", "--output_filename", dest="output_filename",
+                      default="bench.json",
+                      help="write results to OUTPUT_FILENAME "
+                           "[default: %default]")
+    parser.add_option("-w", "--workdir", dest="workdir", default="bench",
+                      help="keep generated feeds and databases in WORKDIR "
+                           "[default: %default]")
+    parser.add_option("-l", "--label", dest="label",
+                      help="label the run, e.g. with a version or commit")
+    parser.add_option("-b", "--bulk", dest="bulk", action="store_true",
+                      default=False, help="load with executemany batches")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="load with JOBS worker processes")
+    parser.add_option("-n", "--sample", dest="sample", type="int",
+                      default=1000,
+                      help="traverse SAMPLE stops and trips [default: "
+                           "%default]")
+    parser.add_option("--seed", dest="seed", type="int", default=0)
+
+    options, args = parser.parse_args()
+
+    try:
+        sizes = [int(size) for size in options.sizes.split(",")]
+    except ValueError:
+        parser.error("--sizes must be a comma-separated list of integers")
+
+    results = run(sizes, options.workdir, options.bulk, options.jobs,
+                  options.sample, options.seed)
+
+    report = {'label': options.label,
+              'created': datetime.now().isoformat(),
+              'python': platform.python_version(),
+              'sqlalchemy': sqlalchemy.__version__,
+              'platform': platform.platform(),
+              'options': {'bulk': options.bulk, 'jobs': options.jobs,
+                          'sample': options.sample, 'seed': options.seed},
+              'results': results}
+
+    with open(options.output_filename, "w") as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+
+    for result in results:
+        print "%d stop_times: %s" % (result['stop_times'], ", ".join(
+            "%s %.2fs" % (name, step['seconds'])
+            for (name, step) in sorted(result['steps'].items())))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""Deterministic synthetic GTFS feeds of any size.
+
+generate_feed lays stops out on a square grid and runs routes along
+monotone walks across it, each route with a fixed pattern of stops and
+running times shared by all its trips, as real feeds mostly do. Trips are
+spread over the day between weekday, Saturday and Sunday service and
+alternate direction. Every tenth route also has a frequency-based trip,
+every route has a shape per direction, holidays appear in calendar_dates,
+and transfers join some neighbouring stops. The same arguments always
+produce the same feed, and rows are streamed out, so generating a feed
+with tens of millions of stop times takes little memory."""
+
+import random
+from itertools import chain
+from math import ceil, sqrt
+
+from gtfs.export import format_time
+from gtfs.feed import FeedWriter
+from gtfs.spatial import distance
+
+ORIGIN = (37.7, -122.5)
+SPACING = 0.004
+
+TRIPS_PER_ROUTE = 150
+
+SERVICES = ("WKDY", "WKDY", "WKDY", "SAT", "SUN")
+
+HOLIDAYS = ("20240101", "20240527", "20240704", "20240902", "20241128",
+            "20241225")
+
+
+class Route(object):
+
+    def __init__(self, cells, runs, dwells, trips):
+        self.cells = cells
+        self.runs = runs
+        self.dwells = dwells
+        self.trips = trips
+
+    def pattern(self, direction):
+        """(cells, arrival offsets, departure offsets) of the route in
+        direction 0 or 1"""
+        cells, runs, dwells = self.cells, self.runs, self.dwells
+        if direction:
+            cells, runs, dwells = cells[::-1], runs[::-1], dwells[::-1]
+        arrivals = []
+        departures = []
+        t = 0
+        for (i, dwell) in enumerate(dwells):
+            if i:
+                t += runs[i - 1]
+            arrivals.append(t)
+            t += dwell
+            departures.append(t)
+        return cells, arrivals, departures
+
+
+def plan(stop_times, seed=0, stops_per_trip=30):
+    """Returns (side, routes): the side of the stop grid and the Routes of
+    a feed of about stop_times stop times"""
+    rng = random.Random(seed)
+    n_trips = max(1, stop_times // stops_per_trip)
+    n_routes = max(1, int(round(n_trips / float(TRIPS_PER_ROUTE))))
+    side = max(stops_per_trip,
+               int(ceil(sqrt(n_routes * stops_per_trip / 2.0))))
+    # walks starting this far from the far edges always have room for
+    # stops_per_trip stops
+    starts = side - (stops_per_trip + 1) // 2
+
+    routes = []
+    for r in range(n_routes):
+        (y, x) = (rng.randrange(starts), rng.randrange(starts))
+        cells = [(y, x)]
+        while len(cells) < stops_per_trip:
+            moves = [(y + dy, x + dx) for (dy, dx) in ((1, 0), (0, 1))
+                     if y + dy < side and x + dx < side]
+            if not moves:
+                break
+            (y, x) = rng.choice(moves)
+            cells.append((y, x))
+        runs = [rng.randrange(60, 181, 15) for i in range(len(cells) - 1)]
+        dwells = [rng.choice((0, 0, 30)) for cell in cells]
+        trips = n_trips // n_routes + (1 if r < n_trips % n_routes else 0)
+        routes.append(Route(cells, runs, dwells, trips))
+    return side, routes
+
+
+def _stop_id(side, cell):
+    return "S%d" % (cell[0] * side + cell[1])
+
+
+def _coordinates(cell):
+    return (ORIGIN[0] + cell[0] * SPACING, ORIGIN[1] + cell[1] * SPACING)
+
+
+def _trips(routes):
+    """Yields (route index, route, trip index, service_id, direction,
+    start time) for every scheduled trip"""
+    for (r, route) in enumerate(routes):
+        for k in range(route.trips):
+            start = 5 * 3600 + (k * 20 * 3600) // max(1, route.trips)
+            yield (r, route, k, SERVICES[k % len(SERVICES)], (k // 5) % 2,
+                   start)
+
+
+def _counted(rows, counts, filename):
+    counts[filename] = 0
+    for row in rows:
+        counts[filename] += 1
+        yield row
+
+
+def generate_feed(filename, stop_times=10000, seed=0, stops_per_trip=30):
+    """Writes a synthetic feed of about stop_times stop times to filename,
+    a .zip or a folder. Returns a dict of each file written to its number
+    of rows."""
+    (side, routes) = plan(stop_times, seed, stops_per_trip)
+    cells = sorted(set(cell for route in routes for cell in route.cells))
+    used = set(cells)
+    frequency_routes = range(0, len(routes), 10)
+    counts = {}
+
+    def write(out, name, header, rows):
+        out.write(name, header, _counted(rows, counts, name))
+
+    with FeedWriter(filename) as out:
+        write(out, "agency.txt",
+              ["agency_id", "agency_name", "agency_url", "agency_timezone"],
+              [["SYN", "Synthetic Transit", "http://example.com",
+                "America/Los_Angeles"]])
+
+        write(out, "stops.txt",
+              ["stop_id", "stop_name", "stop_lat", "stop_lon"],
+              ([_stop_id(side, cell), "Stop %d-%d" % cell,
+                "%.6f" % _coordinates(cell)[0],
+                "%.6f" % _coordinates(cell)[1]] for cell in cells))
+
+        write(out, "routes.txt",
+              ["route_id", "agency_id", "route_short_name", "route_type"],
+              (["R%d" % r, "SYN", str(r + 1), "3"]
+               for r in range(len(routes))))
+
+        def trip_rows():
+            for (r, route, k, service_id, direction, start) in \
+                    _trips(routes):
+                yield ["R%d" % r, service_id, "R%d_T%d" % (r, k),
+                       str(direction), "R%d_%d" % (r, direction)]
+            for r in frequency_routes:
+                yield ["R%d" % r, "WKDY", "R%d_F" % r, "0", "R%d_0" % r]
+        write(out, "trips.txt",
+              ["route_id", "service_id", "trip_id", "direction_id",
+               "shape_id"], trip_rows())
+
+        def stop_time_rows():
+            scheduled = ((r, route, "R%d_T%d" % (r, k), direction, start)
+                         for (r, route, k, service_id, direction, start)
+                         in _trips(routes))
+            templates = ((r, routes[r], "R%d_F" % r, 0, 6 * 3600)
+                         for r in frequency_routes)
+            patterns = (None, None)
+            for (r, route, trip_id, direction, start) in chain(scheduled,
+                                                               templates):
+                if patterns[0] is not route:
+                    patterns = (route, (route.pattern(0), route.pattern(1)))
+                (stops, arrivals, departures) = patterns[1][direction]
+                last = len(stops) - 1
+                for (i, cell) in enumerate(stops):
+                    if 0 < i < last and i % 4 == 2:
+                        times = ["", ""]
+                    else:
+                        times = [format_time(start + arrivals[i]),
+                                 format_time(start + departures[i])]
+                    yield [trip_id] + times + [_stop_id(side, cell),
+                                               str(i + 1)]
+        write(out, "stop_times.txt",
+              ["trip_id", "arrival_time", "departure_time", "stop_id",
+               "stop_sequence"], stop_time_rows())
+
+        write(out, "calendar.txt",
+              ["service_id", "monday", "tuesday", "wednesday", "thursday",
+               "friday", "saturday", "sunday", "start_date", "end_date"],
+              [["WKDY", "1", "1", "1", "1", "1", "0", "0", "20240101",
+                "20241231"],
+               ["SAT", "0", "0", "0", "0", "0", "1", "0", "20240101",
+                "20241231"],
+               ["SUN", "0", "0", "0", "0", "0", "0", "1", "20240101",
+                "20241231"]])
+
+        write(out, "calendar_dates.txt",
+              ["service_id", "date", "exception_type"],
+              ([service_id, day, exception_type] for day in HOLIDAYS
+               for (service_id, exception_type) in (("WKDY", "2"),
+                                                    ("SUN", "1"))))
+
+        write(out, "fare_attributes.txt",
+              ["fare_id", "price", "currency_type", "payment_method",
+               "transfers"],
+              [["F1", "2.50", "USD", "0", ""]])
+
+        write(out, "fare_rules.txt", ["fare_id", "route_id"],
+              (["F1", "R%d" % r] for r in range(len(routes))))
+
+        def shape_rows():
+            for (r, route) in enumerate(routes):
+                for direction in (0, 1):
+                    cells = route.cells[::-1] if direction else route.cells
+                    points = []
+                    for (i, cell) in enumerate(cells):
+                        point = _coordinates(cell)
+                        if i:
+                            before = points[-1]
+                            points.append(((before[0] + point[0]) / 2,
+                                           (before[1] + point[1]) / 2))
+                        points.append(point)
+                    travelled = 0.0
+                    for (i, point) in enumerate(points):
+                        if i:
+                            travelled += distance(points[i - 1][0],
+                                                  points[i - 1][1],
+                                                  point[0], point[1])
+                        yield ["R%d_%d" % (r, direction), "%.6f" % point[0],
+                               "%.6f" % point[1], str(i + 1),
+                               "%.1f" % travelled]
+        write(out, "shapes.txt",
+              ["shape_id", "shape_pt_lat", "shape_pt_lon",
+               "shape_pt_sequence", "shape_dist_traveled"], shape_rows())
+
+        write(out, "frequencies.txt",
+              ["trip_id", "start_time", "end_time", "headway_secs",
+               "exact_times"],
+              (["R%d_F" % r, start, end, "600", "0"]
+               for r in frequency_routes
+               for (start, end) in (("06:00:00", "09:00:00"),
+                                    ("16:00:00", "19:00:00"))))
+
+        def transfer_rows():
+            for (i, cell) in enumerate(cells):
+                neighbour = (cell[0], cell[1] + 1)
+                if i % 7 == 0 and neighbour in used:
+                    yield [_stop_id(side, cell), _stop_id(side, neighbour),
+                           "2", "180"]
+                if i % 11 == 0:
+                    yield [_stop_id(side, cell), _stop_id(side, cell), "2",
+                           "60"]
+        write(out, "transfers.txt",
+              ["from_stop_id", "to_stop_id", "transfer_type",
+               "min_transfer_time"], transfer_rows())
+
+    return counts
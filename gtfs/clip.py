@@ -0,0 +1,282 @@
+"""Clipping a GTFS feed down to an area, a set of routes or a range of
+dates, without compiling it.
+
+clip() streams the feed's CSV files in a few passes, deciding which trips
+to keep from trips.txt and, for a bounding box, from the stop_times of
+the stops inside it, and then writes out every file filtered by the sets
+of IDs the kept trips use. Memory is bounded by those sets rather than by
+the size of the feed. Rows are copied byte for byte, including columns
+this package doesn't model, and files it doesn't know are copied whole,
+byte for byte, whether or not they're CSV.
+
+A trip touching the bounding box is kept with all of its stop times, so
+the clipped feed also has the stops just outside the box that those
+trips serve. Calendars are cut down to the date range."""
+
+from csv import reader
+from datetime import date, timedelta
+
+from gtfs.feed import Feed, FeedWriter, FileNotFoundError
+
+BOM = "\xef\xbb\xbf"
+
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday",
+        "sunday"]
+
+
+class _File(object):
+    """One pass over the raw rows of a feed file"""
+
+    def __init__(self, fd, filename):
+        self.rd = reader(fd.open(filename))
+        # a file without even a header row has no rows either
+        self.header = next(self.rd, [])
+        self.columns = dict((name.strip().lstrip(BOM), i)
+                            for (i, name) in enumerate(self.header))
+
+    def __iter__(self):
+        for row in self.rd:
+            if row:
+                yield row
+
+    def get(self, row, name):
+        i = self.columns.get(name)
+        if i is None or i >= len(row):
+            return ""
+        return row[i].strip()
+
+
+def _open(fd, filename):
+    try:
+        return _File(fd, filename)
+    except FileNotFoundError:
+        return None
+
+
+def _parse_date(value):
+    return date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+
+
+def _format_date(day):
+    # strftime won't take years before 1900, and ranges may be open
+    return day.isoformat().replace("-", "")
+
+
+def _runs_between(f, row, start, end):
+    """True if the calendar.txt row runs on any day from start to end"""
+    day = max(_parse_date(f.get(row, "start_date")), start)
+    last = min(_parse_date(f.get(row, "end_date")), end)
+    for i in range(7):
+        if day > last:
+            return False
+        if f.get(row, DAYS[day.weekday()]) == "1":
+            return True
+        day += timedelta(days=1)
+    return False
+
+
+def _services(fd, start, end):
+    """The service_ids running on any day from start to end"""
+    services = set()
+    f = _open(fd, "calendar.txt")
+    if f is not None:
+        for row in f:
+            if _runs_between(f, row, start, end):
+                services.add(f.get(row, "service_id"))
+    f = _open(fd, "calendar_dates.txt")
+    if f is not None:
+        (first, last) = (_format_date(start), _format_date(end))
+        for row in f:
+            if f.get(row, "exception_type") == "1" and \
+               first <= f.get(row, "date") <= last:
+                services.add(f.get(row, "service_id"))
+    return services
+
+
+def _stops_in(fd, bbox):
+    (min_lat, min_lon, max_lat, max_lon) = bbox
+    stops = set()
+    f = _open(fd, "stops.txt")
+    for row in f:
+        try:
+            (lat, lon) = (float(f.get(row, "stop_lat")),
+                          float(f.get(row, "stop_lon")))
+        except ValueError:
+            continue
+        if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+            stops.add(f.get(row, "stop_id"))
+    return stops
+
+
+class Clipper(object):
+
+    def __init__(self, feed_filename, bbox=None, route_ids=None,
+                 start_date=None, end_date=None):
+        """bbox is (min_lat, min_lon, max_lat, max_lon). A range of dates
+        may be open at either end. Trips must meet every condition
+        given."""
+        self.fd = Feed(feed_filename)
+        self.bbox = bbox
+        self.route_ids = set(route_ids) if route_ids is not None else None
+        self.dated = start_date is not None or end_date is not None
+        self.start_date = start_date or date.min
+        self.end_date = end_date or date.max
+        self.counts = {}
+
+    def trips(self):
+        """The set of trip_ids to keep"""
+        services = None
+        if self.dated:
+            services = _services(self.fd, self.start_date, self.end_date)
+
+        trips = set()
+        f = _open(self.fd, "trips.txt")
+        for row in f:
+            if (self.route_ids is None or
+                f.get(row, "route_id") in self.route_ids) and \
+               (services is None or f.get(row, "service_id") in services):
+                trips.add(f.get(row, "trip_id"))
+
+        if self.bbox is not None:
+            inside = _stops_in(self.fd, self.bbox)
+            f = _open(self.fd, "stop_times.txt")
+            touching = set()
+            for row in f:
+                if f.get(row, "stop_id") in inside:
+                    touching.add(f.get(row, "trip_id"))
+            trips &= touching
+
+        return trips
+
+    def _write(self, out, filename, keep, transform=None):
+        """Copies the rows of filename for which keep(f, row) is true,
+        passed through transform(f, row) if given"""
+        f = _open(self.fd, filename)
+        if f is None:
+            return
+        self.counts[filename] = 0
+        if not f.header:
+            self._copy(out, filename)
+            return
+
+        def rows():
+            for row in f:
+                if keep(f, row):
+                    self.counts[filename] += 1
+                    yield transform(f, row) if transform else row
+        out.write(filename, f.header, rows())
+
+    def _copy(self, out, filename):
+        fp = self.fd.open(filename)
+        try:
+            out.copy(filename, fp)
+        finally:
+            fp.close()
+
+    def _collect(self, filename, keep, column):
+        """The set of column's values in the rows of filename kept by
+        keep(f, row)"""
+        values = set()
+        f = _open(self.fd, filename)
+        if f is not None:
+            for row in f:
+                if keep(f, row):
+                    values.add(f.get(row, column))
+        return values
+
+    def _cut_calendar(self, f, row):
+        row = list(row)
+        for (name, limit, pick) in (("start_date", self.start_date, max),
+                                    ("end_date", self.end_date, min)):
+            i = f.columns[name]
+            row[i] = _format_date(pick(_parse_date(row[i].strip()), limit))
+        return row
+
+    def write(self, out_filename):
+        """Writes the clipped feed to out_filename, a .zip or a folder.
+        Returns a dict of each file written to its number of rows, or to
+        None for the files copied whole."""
+        trips = self.trips()
+
+        def in_trips(f, row):
+            return f.get(row, "trip_id") in trips
+
+        stops = self._collect("stop_times.txt", in_trips, "stop_id")
+        stops |= self._collect("stops.txt",
+                               lambda f, row: f.get(row, "stop_id") in stops,
+                               "parent_station")
+        stops.discard("")
+        routes = self._collect("trips.txt", in_trips, "route_id")
+        services = self._collect("trips.txt", in_trips, "service_id")
+        shapes = self._collect("trips.txt", in_trips, "shape_id")
+        agencies = self._collect(
+            "routes.txt", lambda f, row: f.get(row, "route_id") in routes,
+            "agency_id")
+        zones = self._collect(
+            "stops.txt", lambda f, row: f.get(row, "stop_id") in stops,
+            "zone_id")
+        zones.add("")
+
+        def has(column, ids):
+            return lambda f, row: f.get(row, column) in ids
+
+        fare_routes = routes | set([""])
+
+        def fare_rule(f, row):
+            return f.get(row, "route_id") in fare_routes and \
+                all(f.get(row, column) in zones for column in
+                    ("origin_id", "destination_id", "contains_id"))
+
+        def calendar(f, row):
+            return f.get(row, "service_id") in services and \
+                (not self.dated or
+                 _runs_between(f, row, self.start_date, self.end_date))
+
+        def calendar_date(f, row):
+            return f.get(row, "service_id") in services and \
+                _format_date(self.start_date) <= f.get(row, "date") <= \
+                _format_date(self.end_date)
+
+        fares = None
+        if "fare_rules.txt" in self.fd.filenames():
+            fares = self._collect("fare_rules.txt", fare_rule, "fare_id")
+
+        with FeedWriter(out_filename) as out:
+            self._write(out, "agency.txt",
+                        lambda f, row: "" in agencies or
+                        f.get(row, "agency_id") in agencies)
+            self._write(out, "stops.txt", has("stop_id", stops))
+            self._write(out, "routes.txt", has("route_id", routes))
+            self._write(out, "trips.txt", in_trips)
+            self._write(out, "stop_times.txt", in_trips)
+            self._write(out, "calendar.txt", calendar,
+                        self._cut_calendar if self.dated else None)
+            self._write(out, "calendar_dates.txt", calendar_date)
+            self._write(out, "shapes.txt", has("shape_id", shapes))
+            self._write(out, "frequencies.txt", in_trips)
+            self._write(out, "transfers.txt",
+                        lambda f, row: f.get(row, "from_stop_id") in stops and
+                        f.get(row, "to_stop_id") in stops)
+            self._write(out, "fare_rules.txt", fare_rule)
+            self._write(out, "fare_attributes.txt",
+                        lambda f, row: fares is None or
+                        f.get(row, "fare_id") in fares)
+
+            for filename in self.fd.filenames():
+                if filename not in self.counts:
+                    self._copy(out, filename)
+                    self.counts[filename] = None
+
+        return self.counts
+
+
+def clip(feed_filename, out_filename, bbox=None, route_ids=None,
+         start_date=None, end_date=None):
+    """Writes the part of a feed used by the trips meeting every condition
+    given to out_filename, a .zip or a folder: touching the bounding box
+    bbox, (min_lat, min_lon, max_lat, max_lon); belonging to one of
+    route_ids; running on some date from start_date to end_date. Returns a
+    dict of each file written to its number of rows, or to None for the
+    files it doesn't know, which are copied whole."""
+    return Clipper(feed_filename, bbox, route_ids, start_date,
+                   end_date).write(out_filename)
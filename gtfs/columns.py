@@ -0,0 +1,184 @@
+"""Vectorized parsers for GTFS column values.
+
+These turn arrays of raw CSV byte strings into typed NumPy arrays in a
+handful of array operations, rather than converting one value at a time
+the way Entity.__init__ does. Blank values become a sentinel: -1 for
+times and integers, NaN for floats and NaT for dates."""
+
+import numpy as np
+import sqlalchemy
+
+from gtfs.entity import *
+from gtfs.entity.models import TransitTimeType
+
+_ZERO = ord('0')
+_COLON = ord(':') - _ZERO
+
+
+def _strip(values):
+    values = np.asarray(values, dtype=np.string_)
+    if values.dtype.itemsize and (values.view(np.uint8) == ord(' ')).any():
+        values = np.char.strip(values)
+    return values
+
+
+def _right_aligned(values, width, fill):
+    """Returns an (n, width) uint8 array of the bytes of each value, right
+    aligned and left padded with fill"""
+    values = np.ascontiguousarray(values, dtype='S%d' % width)
+    chars = values.view(np.uint8).reshape(-1, width)
+    lengths = (chars != 0).sum(axis=1)
+
+    index = np.arange(width) - (width - lengths)[:, np.newaxis]
+    rows = np.arange(len(values))[:, np.newaxis]
+    return np.where(index >= 0, chars[rows, np.maximum(index, 0)], ord(fill))
+
+
+def parse_times(values):
+    """Converts HHH:MM:SS strings into int32 seconds since midnight.
+
+    As with TransitTime, the hours may have one to three digits and may be
+    more than 23."""
+    values = _strip(values)
+    blank = values == ''
+
+    if values.dtype.itemsize > 9:
+        too_long = np.char.str_len(values) > 9
+        if too_long.any():
+            raise ValueError('Bad HH:MM:SS "%s"' % values[too_long][0])
+
+    digits = _right_aligned(values, 9, '0').astype(np.int32) - _ZERO
+
+    numeric = np.delete(digits, [3, 6], axis=1)
+    valid = ((digits[:, 3] == _COLON) & (digits[:, 6] == _COLON) &
+             (numeric >= 0).all(axis=1) & (numeric <= 9).all(axis=1) &
+             (digits[:, 4] <= 5) & (digits[:, 7] <= 5)) | blank
+    if not valid.all():
+        raise ValueError('Bad HH:MM:SS "%s"' % values[~valid][0])
+
+    seconds = ((digits[:, 0] * 100 + digits[:, 1] * 10 + digits[:, 2]) * 3600 +
+               (digits[:, 4] * 10 + digits[:, 5]) * 60 +
+               digits[:, 7] * 10 + digits[:, 8])
+    seconds[blank] = -1
+    return seconds
+
+
+def parse_dates(values):
+    """Converts YYYYMMDD strings into a datetime64[D] array"""
+    values = _strip(values)
+    blank = values == ''
+
+    if values.dtype.itemsize > 8:
+        too_long = np.char.str_len(values) > 8
+        if too_long.any():
+            raise ValueError('Bad YYYYMMDD "%s"' % values[too_long][0])
+
+    filled = np.where(blank, '19700101', values)
+    digits = _right_aligned(filled, 8, ' ').astype(np.int32) - _ZERO
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    if not valid.all():
+        raise ValueError('Bad YYYYMMDD "%s"' % values[~valid][0])
+
+    years = digits[:, :4].dot([1000, 100, 10, 1])
+    months = digits[:, 4:6].dot([10, 1])
+    days = digits[:, 6:8].dot([10, 1])
+
+    dates = ((years - 1970).astype('datetime64[Y]') +
+             (months - 1).astype('timedelta64[M]')).astype('datetime64[D]')
+    dates = dates + (days - 1).astype('timedelta64[D]')
+
+    # out of range months and days roll over, so 20100231 would become
+    # 2010-03-03; such dates don't read back the month and day they came from
+    first_days = dates.astype('datetime64[M]')
+    valid = (((first_days - dates.astype('datetime64[Y]')).astype(np.int32) ==
+              months - 1) &
+             ((dates - first_days).astype(np.int32) == days - 1))
+    if not valid.all():
+        raise ValueError('Bad YYYYMMDD "%s"' % values[~valid][0])
+
+    dates[blank] = np.datetime64('NaT')
+    return dates
+
+
+def parse_floats(values):
+    values = _strip(values)
+    return np.where(values == '', 'nan', values).astype(np.float64)
+
+
+def parse_ints(values, dtype=np.int32):
+    values = _strip(values)
+    return np.where(values == '', '-1', values).astype(dtype)
+
+
+def parse_bools(values):
+    return parse_ints(values, np.int8)
+
+
+def parse_strings(values):
+    return np.char.decode(np.asarray(values, dtype=np.string_), 'utf-8')
+
+
+PARSERS = {'time': parse_times,
+           'date': parse_dates,
+           'float': parse_floats,
+           'int': parse_ints,
+           'bool': parse_bools,
+           'str': parse_strings}
+
+
+def column_kinds(tablename):
+    """Maps each column of the model stored in tablename to the name of
+    its parser in PARSERS"""
+    for gtfs_class in (Agency, Route, Stop, Trip, StopTime, ServicePeriod,
+                       ServiceException, Fare, FareRule, ShapePoint,
+                       Frequency, Transfer):
+        if gtfs_class.__tablename__ == tablename:
+            break
+    else:
+        return {}
+
+    kinds = {}
+    for column in gtfs_class.__table__.columns:
+        if isinstance(column.type, TransitTimeType):
+            kinds[column.name] = 'time'
+        elif isinstance(column.type, sqlalchemy.types.Date):
+            kinds[column.name] = 'date'
+        elif isinstance(column.type, sqlalchemy.types.Float):
+            kinds[column.name] = 'float'
+        elif isinstance(column.type, sqlalchemy.types.Boolean):
+            kinds[column.name] = 'bool'
+        elif isinstance(column.type, sqlalchemy.types.Integer):
+            kinds[column.name] = 'int'
+        else:
+            kinds[column.name] = 'str'
+    return kinds
+
+
+def iter_columns(rows, header, columns, chunk_rows, kinds):
+    """Groups CSV rows into chunks and yields a dict of column name to
+    parsed array for each chunk. Only the requested columns are
+    converted; a column missing from header comes back all blank."""
+    indexes = [header.index(name) if name in header else None
+               for name in columns]
+    parsers = [PARSERS[kinds.get(name, 'str')] for name in columns]
+    width = max([i for i in indexes if i is not None] or [-1]) + 1
+
+    def convert(chunk):
+        out = {}
+        for (name, i, parser) in zip(columns, indexes, parsers):
+            if i is None:
+                out[name] = parser([''] * len(chunk))
+            else:
+                out[name] = parser([row[i] for row in chunk])
+        return out
+
+    chunk = []
+    for row in rows:
+        if len(row) < width:
+            row = row + [''] * (width - len(row))
+        chunk.append(row)
+        if len(chunk) == chunk_rows:
+            yield convert(chunk)
+            chunk = []
+    if chunk:
+        yield convert(chunk)
@@ -1,2 +1,7 @@
 from models import Base, ShapePoint, Agency, ServicePeriod, ServiceException
+from models import ServiceDate, PackedShape, FeedFile
+from models import PatternStop, TimingOffset, TripPattern
 from models import Route, Stop, Trip, StopTime, Fare, FareRule, Frequency, Transfer
+from models import GeneratedTransfer
+from models import DayType, SummaryFingerprint, RouteHour, StopHour
+from models import RouteService, StopService
@@ -1,10 +1,10 @@
 from datetime import date
 
 import sqlalchemy
-from sqlalchemy.orm import relationship
-from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.orm import relationship, object_session
+from sqlalchemy.schema import Column, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.types import String, Integer, Float, Date, Boolean
+from sqlalchemy.types import String, Integer, Float, Date, Boolean, LargeBinary
 
 from gtfs.types import TransitTime
 
@@ -47,14 +47,36 @@ Base = declarative_base()
 
 
 class Entity():
+    defaults = {}
+
+    # the columns that identify a row of the feed file, when they aren't
+    # the primary key; see gtfs.loader.update. () means rows have no
+    # identity beyond their values.
+    natural_key = None
+
     def __init__(self, **kwargs):
-        for k, v in kwargs.items():
+        for k, v in self.convert_record(kwargs).items():
+            setattr(self, k, v)
+
+    @classmethod
+    def convert_record(cls, record):
+        """Apply inbound_conversions and defaults to a raw GTFS record,
+        returning a new dict of attribute values"""
+        conversions = getattr(cls, 'inbound_conversions', {})
+
+        out = {}
+        for k, v in record.items():
             if v == '' or v is None:
                 v = None
-            elif hasattr(self, 'inbound_conversions') and \
-                     k in self.inbound_conversions:
-                v = self.inbound_conversions[k](v)
-            setattr(self, k, v)
+            elif k in conversions:
+                v = conversions[k](v)
+            out[k] = v
+
+        for k, v in cls.defaults.items():
+            if out.get(k) is None:
+                out[k] = v
+
+        return out
 
 
 class ShapePoint(Entity, Base):
@@ -63,8 +85,10 @@ class ShapePoint(Entity, Base):
     inbound_conversions = {'shape_pt_lat': float,
                            'shape_pt_lon': float}
 
+    natural_key = ("shape_id", "shape_pt_sequence")
+
     id = Column(Integer, primary_key=True)
-    shape_id = Column(String, nullable=False)
+    shape_id = Column(String, nullable=False, index=True)
     shape_pt_lat = Column(Float, nullable=False)
     shape_pt_lon = Column(Float, nullable=False)
     shape_pt_sequence = Column(Integer, nullable=False)
@@ -76,6 +100,22 @@ class ShapePoint(Entity, Base):
                                               self.shape_pt_lon)
 
 
+class PackedShape(Base):
+    """All the points of one shape in a single row, written instead of
+    ShapePoints when the loader is asked to pack shapes. See gtfs.shapes
+    for the encoding."""
+    __tablename__ = "packed_shapes"
+
+    shape_id = Column(String, primary_key=True, nullable=False)
+    num_points = Column(Integer, nullable=False)
+    points = Column(LargeBinary, nullable=False)
+    distances = Column(LargeBinary)
+
+    def __repr__(self):
+        return "<PackedShape %s (%s points)>" % (self.shape_id,
+                                                 self.num_points)
+
+
 class Agency(Entity, Base):
     __tablename__ = "agency"
 
@@ -86,15 +126,11 @@ class Agency(Entity, Base):
     agency_lang = Column(String(2))
     agency_phone = Column(String)
 
+    defaults = {'agency_id': "__DEFAULT__"}
+
     def __repr__(self):
         return "<Agency %s>" % self.agency_id
 
-    def __init__(self, **kwargs):
-        Entity.__init__(self, **kwargs)
-
-        if not hasattr(self, "agency_id") or self.agency_id is None:
-            self.agency_id = "__DEFAULT__"
-
 
 class ServicePeriod(Entity, Base):
     __tablename__ = "calendar"
@@ -140,9 +176,9 @@ class ServicePeriod(Entity, Base):
         within_period = (self.start_date <= service_date and \
                          service_date <= self.end_date)
         active_on_day = self.active_on_dow(service_date.weekday())
-        exception_remove = ServiceException.query.with_parent(
-            self).filter_by(date=service_date,
-                            exception_type='2').count() > 0
+        exception_remove = object_session(self).query(
+            ServiceException).with_parent(self).filter_by(
+                date=service_date, exception_type='2').count() > 0
 
         if within_period and active_on_day and not exception_remove:
             return True
@@ -167,6 +203,31 @@ class ServiceException(Entity, Base):
         return "<ServiceException %s %s>" % (self.date, self.exception_type)
 
 
+class ServiceDate(Base):
+    """A date on which a service_id runs, expanded by the loader from
+    calendar and calendar_dates"""
+    __tablename__ = "service_dates"
+
+    date = Column(Date, primary_key=True, nullable=False)
+    service_id = Column(String, ForeignKey("calendar.service_id"),
+                        primary_key=True, nullable=False)
+
+    def __repr__(self):
+        return "<ServiceDate %s %s>" % (self.service_id, self.date)
+
+
+class FeedFile(Base):
+    """The checksum of a feed file as it was when last compiled, so that
+    gtfs.loader.update can tell which files have changed since"""
+    __tablename__ = "feed_files"
+
+    filename = Column(String, primary_key=True, nullable=False)
+    sha1 = Column(String(40), nullable=False)
+
+    def __repr__(self):
+        return "<FeedFile %s %s>" % (self.filename, self.sha1)
+
+
 class Route(Entity, Base):
     __tablename__ = "routes"
 
@@ -184,15 +245,11 @@ class Route(Entity, Base):
 
     inbound_conversions = {'route_type': int}
 
+    defaults = {'agency_id': "__DEFAULT__"}
+
     def __repr__(self):
         return "<Route %s>" % self.route_id
 
-    def __init__(self, **kwargs):
-        Entity.__init__(self, **kwargs)
-
-        if not hasattr(self, "agency_id") or self.agency_id is None:
-            self.agency_id = "__DEFAULT__"
-
 
 class Stop(Entity, Base):
     __tablename__ = "stops"
@@ -233,6 +290,11 @@ class Trip(Entity, Base):
     block_id = Column(String)
     shape_id = Column(String)
 
+    # derived from stop_times and frequencies by the loader; see
+    # gtfs.loader.build_trip_times
+    first_departure = Column(TransitTimeType, info={'derived': True})
+    uses_frequency = Column(Boolean, info={'derived': True})
+
     route = relationship("Route", backref="trips")
     service_period = relationship("ServicePeriod", backref="trips")
     stop_times = relationship("StopTime", order_by="StopTime.stop_sequence")
@@ -242,15 +304,12 @@ class Trip(Entity, Base):
     def __repr__(self):
         return "<Trip %s>" % self.trip_id
 
-    @property
-    def uses_frequency(self):
-        #would be even better to use EXISTS here since the actual count is irrelevant
-        return Frequency.query.with_parent(self).count() > 0
-
 
 class StopTime(Entity, Base):
     __tablename__ = "stop_times"
 
+    natural_key = ("trip_id", "stop_sequence")
+
     id = Column(Integer, primary_key=True)
     trip_id = Column(String, ForeignKey("trips.trip_id"),
                      index=True, nullable=False)
@@ -264,6 +323,10 @@ class StopTime(Entity, Base):
     drop_off_type = Column(Integer)
     shape_dist_traveled = Column(String)
 
+    # seconds from the trip's first arrival to this one; derived by the
+    # loader, see gtfs.loader.build_trip_times
+    elapsed_time = Column(Integer, info={'derived': True})
+
     trip = relationship(Trip)
     stop = relationship(Stop, backref="stop_times")
 
@@ -276,13 +339,53 @@ class StopTime(Entity, Base):
     def __repr__(self):
         return "<StopTime %s %s>" % (self.trip_id, self.departure_time)
 
-    @property
-    def elapsed_time(self):
-        q = StopTime.query
-        q = q.with_parent(self.trip)
-        q = q.order_by(StopTime.stop_sequence.asc())
-        st = q.value(StopTime.arrival_time)
-        return self.arrival_time.val - st.val
+class PatternStop(Base):
+    """One stop of a stop pattern: the stops, in order, shared by every
+    trip with the same pattern_id. Written when the loader compresses
+    stop_times; see gtfs.patterns."""
+    __tablename__ = "pattern_stops"
+
+    pattern_id = Column(Integer, primary_key=True, nullable=False)
+    position = Column(Integer, primary_key=True, nullable=False)
+    stop_id = Column(String, ForeignKey("stops.stop_id"),
+                     index=True, nullable=False)
+    stop_sequence = Column(Integer, nullable=False)
+    stop_headsign = Column(String)
+    pickup_type = Column(Integer)
+    drop_off_type = Column(Integer)
+    shape_dist_traveled = Column(String)
+
+
+class TimingOffset(Base):
+    """The arrival and departure at one position of a timing profile, in
+    seconds after the start_time of the trips using the profile"""
+    __tablename__ = "timing_offsets"
+
+    profile_id = Column(Integer, primary_key=True, nullable=False)
+    position = Column(Integer, primary_key=True, nullable=False)
+    arrival_offset = Column(Integer)
+    departure_offset = Column(Integer)
+    elapsed_time = Column(Integer)
+
+
+class TripPattern(Base):
+    """A trip's stop times, as a stop pattern and timing profile applied
+    from start_time"""
+    __tablename__ = "trip_patterns"
+
+    trip_id = Column(String, ForeignKey("trips.trip_id"), primary_key=True,
+                     nullable=False)
+    pattern_id = Column(Integer, index=True, nullable=False)
+    profile_id = Column(Integer, nullable=False)
+    start_time = Column(TransitTimeType)
+
+    def __repr__(self):
+        return "<TripPattern %s %s/%s>" % (self.trip_id, self.pattern_id,
+                                           self.profile_id)
+
+
+Index("ix_stop_times_stop_id_departure_time",
+      StopTime.__table__.c.stop_id, StopTime.__table__.c.departure_time)
 
 
 class Fare(Entity, Base):
@@ -306,6 +409,8 @@ class Fare(Entity, Base):
 class FareRule(Entity, Base):
     __tablename__ = "fare_rules"
 
+    natural_key = ()
+
     id = Column(Integer, primary_key=True)
     fare_id = Column(String, ForeignKey("fare_attributes.fare_id"),
                      index=True, nullable=False)
@@ -323,7 +428,10 @@ class Frequency(Entity, Base):
 
     inbound_conversions = {'start_time': make_time,
                            'end_time': make_time,
-                           'headway_secs': int}
+                           'headway_secs': int,
+                           'exact_times': int}
+
+    natural_key = ("trip_id", "start_time")
 
     id = Column(Integer, primary_key=True)
     trip_id = Column(String, ForeignKey("trips.trip_id"),
@@ -331,6 +439,7 @@ class Frequency(Entity, Base):
     start_time = Column(TransitTimeType, nullable=False)
     end_time = Column(TransitTimeType, nullable=False)
     headway_secs = Column(Integer, nullable=False)
+    exact_times = Column(Integer)
 
     trip = relationship(Trip, backref="frequencies")
 
@@ -340,14 +449,9 @@ class Frequency(Entity, Base):
 
     @property
     def trip_times(self):
-        out = []
-        start_time = self.start_time.val
-        end_time = self.end_time.val
-        time = start_time
-        while time < end_time:
-            out.append(time)
-            time += self.headway_secs
-        return out
+        from gtfs.frequencies import run_times
+        return run_times(self.start_time.val, self.end_time.val,
+                         self.headway_secs)
 
 
 class Transfer(Entity, Base):
@@ -355,6 +459,8 @@ class Transfer(Entity, Base):
 
     inbound_conversions = {'transfer_type': int}
 
+    natural_key = ("from_stop_id", "to_stop_id")
+
     id = Column(Integer, primary_key=True)
     from_stop_id = Column(String, ForeignKey("stops.stop_id"),
                           index=True, nullable=False)
@@ -369,3 +475,111 @@ class Transfer(Entity, Base):
     to_stop = relationship(Stop,
                            primaryjoin="Transfer.to_stop_id==Stop.stop_id",
                            backref="transfers_from")
+
+
+class GeneratedTransfer(Base):
+    """A walk between two nearby stops, worked out by gtfs.transfers from
+    the distance between them rather than published in transfers.txt"""
+    __tablename__ = "generated_transfers"
+
+    from_stop_id = Column(String, ForeignKey("stops.stop_id"),
+                          primary_key=True, nullable=False)
+    to_stop_id = Column(String, ForeignKey("stops.stop_id"),
+                        primary_key=True, nullable=False)
+    distance = Column(Float, nullable=False)
+    min_transfer_time = Column(Integer, nullable=False)
+
+    from_stop = relationship(
+        Stop, primaryjoin="GeneratedTransfer.from_stop_id==Stop.stop_id")
+    to_stop = relationship(
+        Stop, primaryjoin="GeneratedTransfer.to_stop_id==Stop.stop_id")
+
+    def __repr__(self):
+        return "<GeneratedTransfer %s-%s %ss>" % (
+            self.from_stop_id, self.to_stop_id, self.min_transfer_time)
+
+
+class DayType(Base):
+    """The date whose service a day type's summaries describe: the busiest
+    weekday, Saturday or Sunday of the feed. This and the summary tables
+    below are built by gtfs.analytics."""
+    __tablename__ = "day_types"
+
+    day_type = Column(String, primary_key=True, nullable=False)
+    date = Column(Date, nullable=False)
+
+    def __repr__(self):
+        return "<DayType %s %s>" % (self.day_type, self.date)
+
+
+class SummaryFingerprint(Base):
+    """A digest of feed_files as it was when the summary tables were
+    built, so that they can be rebuilt once the feed changes"""
+    __tablename__ = "summary_fingerprint"
+
+    fingerprint = Column(String(40), primary_key=True, nullable=False)
+
+
+class RouteHour(Base):
+    """The number of trips of a route starting in each hour of a day type"""
+    __tablename__ = "route_hours"
+
+    day_type = Column(String, primary_key=True, nullable=False)
+    route_id = Column(String, primary_key=True, nullable=False)
+    hour = Column(Integer, primary_key=True, nullable=False)
+    trips = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<RouteHour %s %s %s:00 %s>" % (self.day_type, self.route_id,
+                                               self.hour, self.trips)
+
+
+class StopHour(Base):
+    """The number of departures from a stop in each hour of a day type"""
+    __tablename__ = "stop_hours"
+
+    day_type = Column(String, primary_key=True, nullable=False)
+    stop_id = Column(String, primary_key=True, nullable=False)
+    hour = Column(Integer, primary_key=True, nullable=False)
+    departures = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<StopHour %s %s %s:00 %s>" % (self.day_type, self.stop_id,
+                                              self.hour, self.departures)
+
+
+class RouteService(Base):
+    """The span and mean headway of a route in one direction on a day type,
+    measured between the departures of its trips from their first stops"""
+    __tablename__ = "route_service"
+
+    day_type = Column(String, primary_key=True, nullable=False)
+    route_id = Column(String, primary_key=True, nullable=False)
+    direction_id = Column(Integer, primary_key=True, nullable=False)
+    trips = Column(Integer, nullable=False)
+    first_departure = Column(TransitTimeType, nullable=False)
+    last_departure = Column(TransitTimeType, nullable=False)
+    mean_headway = Column(Float)
+
+    def __repr__(self):
+        return "<RouteService %s %s/%s %s-%s>" % (
+            self.day_type, self.route_id, self.direction_id,
+            self.first_departure, self.last_departure)
+
+
+class StopService(Base):
+    """The span and mean headway of all departures from a stop on a day
+    type"""
+    __tablename__ = "stop_service"
+
+    day_type = Column(String, primary_key=True, nullable=False)
+    stop_id = Column(String, primary_key=True, nullable=False)
+    departures = Column(Integer, nullable=False)
+    first_departure = Column(TransitTimeType, nullable=False)
+    last_departure = Column(TransitTimeType, nullable=False)
+    mean_headway = Column(Float)
+
+    def __repr__(self):
+        return "<StopService %s %s %s-%s>" % (self.day_type, self.stop_id,
+                                              self.first_departure,
+                                              self.last_departure)
@@ -0,0 +1,145 @@
+"""Export of a compiled Schedule back to a GTFS feed.
+
+Each table is read through one cursor in fixed-size batches and streamed
+straight into a FeedWriter, so an export takes the same memory however big
+the feed. Values are read raw, bypassing the ORM, and turned back into GTFS
+text by column type: TransitTimes to HH:MM:SS, dates to YYYYMMDD and
+booleans to 0 or 1. Columns the loader derives are left out. Packed
+shapes are unpacked, and compressed stop_times are read through their
+view."""
+
+from sqlalchemy.types import Date, Boolean, Float
+
+from gtfs.entity import *
+from gtfs.entity.models import TransitTimeType
+from gtfs.feed import FeedWriter
+from gtfs.loader import GTFS_CLASSES, OPTIONAL_FILES
+
+
+def format_time(seconds):
+    """Formats seconds since midnight as HH:MM:SS, HH going past 23 for
+    times on the following day"""
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def _format_date(value):
+    # SQLite keeps dates as YYYY-MM-DD text
+    return value.replace("-", "").encode("ascii")
+
+
+def _format_boolean(value):
+    return "1" if value else "0"
+
+
+def _format_text(value):
+    return unicode(value).encode("utf-8")
+
+
+def column_formatter(column, default=None):
+    """Returns a function turning a raw value of column into GTFS text.
+    None, and the default the loader put in place of a blank, become
+    blank."""
+    if isinstance(column.type, TransitTimeType):
+        convert = format_time
+    elif isinstance(column.type, Date):
+        convert = _format_date
+    elif isinstance(column.type, Boolean):
+        convert = _format_boolean
+    elif isinstance(column.type, Float):
+        convert = repr
+    else:
+        convert = _format_text
+
+    def formatter(value):
+        if value is None or (default is not None and value == default):
+            return ""
+        return convert(value)
+    return formatter
+
+
+def _batches(conn, query, batch_size):
+    result = conn.execute(query)
+    while True:
+        batch = result.fetchmany(batch_size)
+        if not batch:
+            break
+        yield batch
+
+
+def _table_rows(conn, gtfs_class, columns, batch_size, counter):
+    formatters = [column_formatter(column,
+                                   gtfs_class.defaults.get(column.name))
+                  for column in columns]
+    query = "SELECT %s FROM %s" % (", ".join(column.name for column in columns),
+                                   gtfs_class.__tablename__)
+    for batch in _batches(conn, query, batch_size):
+        counter[0] += len(batch)
+        for row in batch:
+            yield [formatter(value)
+                   for (formatter, value) in zip(formatters, row)]
+
+
+def _packed_shape_rows(conn, batch_size, counter):
+    """Yields shapes.txt rows for every PackedShape, numbering the points
+    of each shape from 1"""
+    from gtfs import shapes
+
+    query = "SELECT shape_id, points, distances FROM packed_shapes"
+    for batch in _batches(conn, query, max(1, batch_size // 1000)):
+        for (shape_id, points, distances) in batch:
+            shape_id = _format_text(shape_id)
+            points = shapes.unpack_points(points).tolist()
+            if distances is None:
+                distances = [""] * len(points)
+            else:
+                distances = ["" if d != d else repr(d)
+                             for d in shapes.unpack_distances(distances)
+                             .tolist()]
+            counter[0] += len(points)
+            for (i, ((lat, lon), distance)) in enumerate(zip(points,
+                                                             distances)):
+                yield [shape_id, "%.6f" % lat, "%.6f" % lon, str(i + 1),
+                       distance]
+
+
+def _has_rows(conn, tablename):
+    return conn.execute("SELECT 1 FROM %s LIMIT 1" % tablename).first() \
+           is not None
+
+
+def export(schedule, filename, batch_size=10000):
+    """Writes schedule out as a GTFS feed, into a zip archive if filename
+    ends in .zip and otherwise into a folder. Optional files with no rows
+    are left out. Returns a dict of each file written to its number of
+    rows."""
+    counts = {}
+    conn = schedule.engine.connect()
+    try:
+        with FeedWriter(filename) as out:
+            for gtfs_class in GTFS_CLASSES:
+                tablename = gtfs_class.__tablename__
+                feed_filename = tablename + ".txt"
+                columns = [column for column in gtfs_class.__table__.columns
+                           if column.name != "id" and
+                           not column.info.get('derived')]
+                counter = [0]
+
+                if gtfs_class is ShapePoint and \
+                   not _has_rows(conn, tablename) and \
+                   _has_rows(conn, PackedShape.__tablename__):
+                    rows = _packed_shape_rows(conn, batch_size, counter)
+                elif feed_filename in OPTIONAL_FILES and \
+                     not _has_rows(conn, tablename):
+                    continue
+                else:
+                    rows = _table_rows(conn, gtfs_class, columns, batch_size,
+                                       counter)
+
+                out.write(feed_filename, [column.name for column in columns],
+                          rows)
+                counts[feed_filename] = counter[0]
+    finally:
+        conn.close()
+
+    return counts
@@ -1,6 +1,10 @@
 import os
 import errno
-from zipfile import ZipFile
+import hashlib
+import shutil
+import tempfile
+from csv import reader, writer
+from zipfile import ZipFile, ZIP_DEFLATED
 from util import TolerantDictReader
 
 
@@ -15,24 +19,135 @@ class Feed(object):
         if not os.path.isdir(filename):
             self.zf = ZipFile(filename)
 
-    def get_reader(self, filename):
+    def open(self, filename):
         if self.zf:
             try:
-                f = self.zf.open(filename)
+                return self.zf.open(filename)
             except KeyError:
                 raise FileNotFoundError("%s not found" % filename)
         else:
             try:
-                f = open(os.path.join(self.filename, filename))
+                return open(os.path.join(self.filename, filename))
             except IOError, e:
                 if e.errno == errno.ENOENT:
                     raise FileNotFoundError("%s not found" % filename)
                 else:
                     raise
 
-        dr = TolerantDictReader(f)
+    def filenames(self):
+        """Lists the files in the feed"""
+        if self.zf:
+            return [name for name in self.zf.namelist()
+                    if not name.endswith("/")]
+        return [name for name in os.listdir(self.filename)
+                if os.path.isfile(os.path.join(self.filename, name))]
+
+    def size(self, filename):
+        """The uncompressed size in bytes of filename"""
+        if self.zf:
+            try:
+                return self.zf.getinfo(filename).file_size
+            except KeyError:
+                raise FileNotFoundError("%s not found" % filename)
+        else:
+            try:
+                return os.path.getsize(os.path.join(self.filename, filename))
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    raise FileNotFoundError("%s not found" % filename)
+                else:
+                    raise
+
+    def checksum(self, filename):
+        """The SHA-1 hex digest of filename's uncompressed contents"""
+        digest = hashlib.sha1()
+        fp = self.open(filename)
+        try:
+            while True:
+                block = fp.read(1 << 20)
+                if not block:
+                    break
+                digest.update(block)
+        finally:
+            fp.close()
+        return digest.hexdigest()
+
+    def get_reader(self, filename):
+        dr = TolerantDictReader(self.open(filename))
         return dr
 
+    def read_columns(self, filename, columns, chunk_rows=100000, kinds=None):
+        """Streams the named columns of a file as NumPy arrays.
+
+        Yields one dict of column name to array per chunk_rows rows. Values
+        are parsed according to the type of the matching model column,
+        unless kinds maps the column name to one of 'time', 'date',
+        'float', 'int', 'bool' or 'str'. Columns that aren't requested are
+        never decoded. Requires NumPy."""
+        from gtfs.columns import column_kinds, iter_columns
+
+        table_kinds = column_kinds(os.path.splitext(filename)[0])
+        table_kinds.update(kinds or {})
+
+        rd = reader(self.open(filename))
+        header = [fieldname.strip() for fieldname in rd.next()]
+
+        return iter_columns(rd, header, list(columns), chunk_rows,
+                            table_kinds)
+
+
+class FeedWriter(object):
+    """Writes the CSV files of a feed into a zip archive, if filename ends
+    in .zip, or else loose into a folder. A file is written to disk as its
+    rows are streamed in and only then added to the archive, so memory use
+    doesn't depend on its size."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.zf = None
+
+        if os.path.splitext(filename)[1].lower() == ".zip":
+            self.zf = ZipFile(filename, "w", ZIP_DEFLATED, allowZip64=True)
+            self.folder = tempfile.mkdtemp()
+        else:
+            if not os.path.isdir(filename):
+                os.makedirs(filename)
+            self.folder = filename
+
+    def write(self, filename, header, rows):
+        """Writes a file from a header and an iterable of rows, whose
+        values must already be byte strings"""
+        path = os.path.join(self.folder, filename)
+        with open(path, "wb") as fp:
+            out = writer(fp)
+            out.writerow(header)
+            out.writerows(rows)
+
+        self._add(path, filename)
+
+    def copy(self, filename, fp):
+        """Writes a file byte for byte from the file object fp"""
+        path = os.path.join(self.folder, filename)
+        with open(path, "wb") as out:
+            shutil.copyfileobj(fp, out)
+        self._add(path, filename)
+
+    def _add(self, path, filename):
+        if self.zf:
+            self.zf.write(path, filename)
+            os.remove(path)
+
+    def close(self):
+        if self.zf:
+            self.zf.close()
+            shutil.rmtree(self.folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
 
 class FileNotFoundError(Exception):
     pass
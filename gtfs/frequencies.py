@@ -0,0 +1,169 @@
+"""Expansion of frequency-based trips into concrete stop times.
+
+A trip listed in frequencies.txt is a template: its stop times give the
+running times between stops, and each frequencies.txt row starts a run of
+it every headway_secs from start_time until end_time. FrequencyExpander
+turns the runs active on a service date into (trip, run, stop, arrival,
+departure) records within a time window, computing a whole block of runs
+at once as NumPy arrays and yielding them chunk by chunk, so a day is
+never materialized unless asked for.
+
+Run start times are worked out by run_times(), which Frequency.trip_times,
+Schedule.departures and the Router use too. A row with exact_times 1 is
+schedule-based, and its runs leave at exactly those times. A row with
+exact_times 0 or blank is headway-based: the feed promises only the
+headway, so its runs are laid out on the same grid from start_time as a
+nominal timetable. Each record carries its row's exact_times and
+headway_secs so the two can be told apart, and the expander can be asked
+for only one kind. Untimed template stop times are interpolated.
+
+FrequencyExpander requires NumPy; run_times() doesn't."""
+
+from collections import namedtuple
+
+FrequencyStopTime = namedtuple("FrequencyStopTime",
+                               ["trip_id", "run_start", "stop_id",
+                                "stop_sequence", "arrival_time",
+                                "departure_time", "exact_times",
+                                "headway_secs"])
+
+
+def run_times(start_time, end_time, headway_secs, first=None, last=None):
+    """Lists the times the runs of one frequencies.txt row leave their
+    first stop: every headway_secs from start_time, while before end_time.
+    first and last narrow them down to first <= time < last."""
+    if headway_secs <= 0:
+        return []
+    k = 0
+    if first is not None and first > start_time:
+        k = -((start_time - first) // headway_secs)
+    if last is not None:
+        end_time = min(end_time, last)
+    return range(start_time + k * headway_secs, end_time, headway_secs)
+
+
+class FrequencyExpander(object):
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.timetable = schedule.timetable()
+        self.frequencies = schedule.engine.execute(
+            "SELECT f.trip_id, t.service_id, f.start_time, f.end_time, "
+            "f.headway_secs, f.exact_times "
+            "FROM frequencies f JOIN trips t ON t.trip_id = f.trip_id "
+            "ORDER BY f.start_time").fetchall()
+        self._templates = {}
+
+    def _template(self, trip_id):
+        """(stops, sequences, arrival offsets, departure offsets) of a
+        trip's stop times, relative to its first departure, or None if the
+        trip can't be expanded"""
+        import numpy as np
+        from gtfs.timetable import interpolate
+
+        if trip_id not in self._templates:
+            template = None
+            if trip_id in self.timetable.trip_index:
+                s = self.timetable.trip_slice(trip_id)
+                times = interpolate(self.timetable.arrivals[s].tolist(),
+                                    self.timetable.departures[s].tolist())
+                if times is not None:
+                    (arrivals, departures) = times
+                    first = departures[0]
+                    template = (self.timetable.stops[s],
+                                self.timetable.sequences[s],
+                                np.array(arrivals, dtype=np.int32) - first,
+                                np.array(departures, dtype=np.int32) - first)
+            self._templates[trip_id] = template
+        return self._templates[trip_id]
+
+    def chunks(self, service_date, start=0, end=None, max_runs=1000,
+               exact_times=None):
+        """Yields the stop times of runs active on service_date that depart
+        in start <= departure_time < end, as dicts of parallel arrays:
+
+          trip            index into timetable.trip_ids
+          run_start       time the run leaves its first stop
+          stop            index into timetable.stop_ids
+          stop_sequence, arrival_time, departure_time
+          exact_times     boolean; false for nominal, headway-based runs
+          headway_secs    of the run's frequencies.txt row
+
+        Each chunk holds at most max_runs runs of one frequencies.txt row,
+        and at least one stop time. exact_times True or False expands only
+        the schedule-based or only the headway-based rows."""
+        import numpy as np
+
+        active = set(self.schedule.service_for_date(service_date))
+
+        for (trip_id, service_id, run_start, run_end, headway,
+             exact) in self.frequencies:
+            if service_id not in active or (exact_times is not None and
+                                            bool(exact) != exact_times):
+                continue
+            template = self._template(trip_id)
+            if template is None:
+                continue
+            (stops, sequences, arrival_offsets, departure_offsets) = template
+
+            # the runs with any departure in the window
+            (first, last) = (int(departure_offsets.min()),
+                             int(departure_offsets.max()))
+            runs = np.array(run_times(run_start, run_end, headway,
+                                      start - last,
+                                      None if end is None else end - first),
+                            dtype=np.int32)
+
+            trip = self.timetable.trip_index[trip_id]
+            for i in range(0, len(runs), max_runs):
+                block = runs[i:i + max_runs, np.newaxis]
+                departures = block + departure_offsets
+                mask = departures >= start
+                if end is not None:
+                    mask &= departures < end
+                (run, position) = np.nonzero(mask)
+                if not len(run):
+                    # none of the block's runs stops within the window
+                    continue
+
+                yield {'trip': np.repeat(np.int32(trip), len(run)),
+                       'run_start': block[run, 0],
+                       'stop': stops[position],
+                       'stop_sequence': sequences[position],
+                       'arrival_time': (block + arrival_offsets)[mask],
+                       'departure_time': departures[mask],
+                       'exact_times': np.repeat(bool(exact), len(run)),
+                       'headway_secs': np.repeat(np.int32(headway), len(run))}
+
+    def expand(self, service_date, start=0, end=None, exact_times=None):
+        """Generates FrequencyStopTimes for the runs active on
+        service_date departing in start <= departure_time < end, of the
+        rows chosen by exact_times as in chunks()"""
+        trip_ids = self.timetable.trip_ids
+        stop_ids = self.timetable.stop_ids
+        for chunk in self.chunks(service_date, start, end,
+                                 exact_times=exact_times):
+            for row in zip(chunk['trip'].tolist(), chunk['run_start'].tolist(),
+                           chunk['stop'].tolist(),
+                           chunk['stop_sequence'].tolist(),
+                           chunk['arrival_time'].tolist(),
+                           chunk['departure_time'].tolist(),
+                           chunk['exact_times'].tolist(),
+                           chunk['headway_secs'].tolist()):
+                yield FrequencyStopTime(trip_ids[row[0]], row[1],
+                                        stop_ids[row[2]], *row[3:])
+
+    def arrays(self, service_date, start=0, end=None, exact_times=None):
+        """All of chunks() concatenated into one dict of arrays"""
+        import numpy as np
+
+        chunks = list(self.chunks(service_date, start, end,
+                                  exact_times=exact_times))
+        keys = ['trip', 'run_start', 'stop', 'stop_sequence', 'arrival_time',
+                'departure_time', 'exact_times', 'headway_secs']
+        if not chunks:
+            return dict((key, np.zeros(0, dtype=np.bool_ if
+                                       key == 'exact_times' else np.int32))
+                        for key in keys)
+        return dict((key, np.concatenate([chunk[key] for chunk in chunks]))
+                    for key in keys)
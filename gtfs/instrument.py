@@ -0,0 +1,117 @@
+"""Counting and timing of the SQL a Schedule runs.
+
+Every Schedule has a QueryStats listening to its engine's cursor events.
+It keeps a running count and time of all statements, in total and per
+statement text, which Schedule.stats() reports. Schedule.capture_queries()
+is a context manager that also records each statement the calling thread
+runs inside a with block, so that ORM code can be checked for N+1
+patterns: the same statement run over and over with different parameters,
+once per object of an earlier query, where one query would do.
+
+    with schedule.capture_queries() as capture:
+        for stop in schedule.stops:
+            stop.stop_times
+    print capture.repeated()"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import Lock
+from thread import get_ident
+import time
+
+from sqlalchemy import event
+
+Query = namedtuple("Query", ["statement", "parameters", "seconds"])
+
+StatementStats = namedtuple("StatementStats", ["statement", "count",
+                                               "seconds"])
+
+
+class Capture(object):
+    """The Queries run by one thread inside a capture_queries() block"""
+
+    def __init__(self):
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    @property
+    def seconds(self):
+        return sum(query.seconds for query in self.queries)
+
+    def repeated(self, threshold=2):
+        """StatementStats of the statements run at least threshold times,
+        most often run first: the likely N+1s"""
+        counts = {}
+        for query in self.queries:
+            stat = counts.setdefault(query.statement, [0, 0.0])
+            stat[0] += 1
+            stat[1] += query.seconds
+        return sorted((StatementStats(statement, count, seconds)
+                       for (statement, (count, seconds)) in counts.items()
+                       if count >= threshold),
+                      key=lambda stat: (-stat.count, stat.statement))
+
+
+class QueryStats(object):
+
+    def __init__(self, engine):
+        self.lock = Lock()
+        self.captures = {}
+        self.reset()
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def reset(self):
+        with self.lock:
+            self.queries = 0
+            self.seconds = 0.0
+            self.statements = {}
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault('query_start', []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        seconds = time.time() - conn.info['query_start'].pop()
+        with self.lock:
+            self.queries += 1
+            self.seconds += seconds
+            stat = self.statements.setdefault(statement, [0, 0.0])
+            stat[0] += 1
+            stat[1] += seconds
+            captures = self.captures.get(get_ident())
+        if captures:
+            for capture in captures:
+                capture.queries.append(Query(statement, parameters, seconds))
+
+    def snapshot(self):
+        """Returns a dict of the number of statements run, the seconds they
+        took, and StatementStats for each distinct statement, most often
+        run first"""
+        with self.lock:
+            statements = [StatementStats(statement, count, seconds)
+                          for (statement, (count, seconds))
+                          in self.statements.items()]
+            out = {'queries': self.queries, 'seconds': self.seconds}
+        statements.sort(key=lambda stat: (-stat.count, stat.statement))
+        out['statements'] = statements
+        return out
+
+    @contextmanager
+    def capture(self):
+        """Yields a Capture of the statements the calling thread runs
+        until the block exits"""
+        capture = Capture()
+        thread = get_ident()
+        with self.lock:
+            self.captures.setdefault(thread, []).append(capture)
+        try:
+            yield capture
+        finally:
+            with self.lock:
+                self.captures[thread].remove(capture)
+                if not self.captures[thread]:
+                    del self.captures[thread]
@@ -1,45 +1,773 @@
-import sys
+import os
+import time
+from datetime import timedelta
+import multiprocessing
+from collections import deque, namedtuple
+from itertools import groupby, islice
+from operator import itemgetter
+
+from sqlalchemy.dialects import sqlite
 
 from gtfs.feed import Feed, FileNotFoundError
 from gtfs.schedule import Schedule
 from gtfs.entity import *
+from gtfs.util import make_record
+from gtfs import shapes
+from gtfs.patterns import compress_stop_times, is_compressed
+from gtfs import analytics
 
+GTFS_CLASSES = (Agency, Route, Stop, Trip, StopTime,
+                ServicePeriod, ServiceException,
+                Fare, FareRule, ShapePoint,
+                Frequency, Transfer)
 
-def load(feed_filename, db_filename=":memory:"):
-    schedule = Schedule(db_filename)
+OPTIONAL_FILES = ['calendar_dates.txt', 'fare_rules.txt',
+                  'frequencies.txt', 'transfers.txt']
+
+
+def row_converter(gtfs_class, dialect):
+    """Returns (columns, convert), where convert turns a raw GTFS record
+    into a tuple of DB-API values ordered like columns.
+
+    The record goes through the same inbound_conversions and defaults an
+    ORM instance would get, followed by each column type's bind processor,
+    so rows written this way are indistinguishable from rows written
+    through the session. Record keys that aren't columns are dropped."""
+    columns = [column.name for column in gtfs_class.__table__.columns]
+    processors = [column.type.bind_processor(dialect)
+                  for column in gtfs_class.__table__.columns]
+    fields = zip(columns, processors)
+
+    def convert(record):
+        values = gtfs_class.convert_record(record)
+        row = []
+        for (name, processor) in fields:
+            value = values.get(name)
+            if processor is not None:
+                value = processor(value)
+            row.append(value)
+        return tuple(row)
+
+    return columns, convert
+
+
+def insert_statement(gtfs_class, columns):
+    return "INSERT INTO %s (%s) VALUES (%s)" % (gtfs_class.__tablename__,
+                                                ", ".join(columns),
+                                                ", ".join("?" * len(columns)))
+
+
+class TableStats(namedtuple("TableStats", ["tablename", "rows", "bytes",
+                                           "seconds", "commit_seconds"])):
+    """What loading one table took: bytes is the size of its feed file,
+    and commit_seconds the part of seconds spent inserting rows and
+    committing them"""
+    __slots__ = ()
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.seconds if self.seconds > 0 else 0
+
+
+class TableChanges(namedtuple("TableChanges", ["tablename", "inserted",
+                                               "updated", "deleted",
+                                               "seconds"])):
+    """The rows update() changed in one table, and the seconds it took to
+    read the feed file and work them out"""
+    __slots__ = ()
+
+
+def bulk_load(schedule, gtfs_class, records, batch_size=50000):
+    """Writes records straight into gtfs_class's table in executemany
+    batches, bypassing the ORM session. Returns (rows, commit_seconds)."""
+    columns, convert = row_converter(gtfs_class, schedule.engine.dialect)
+    statement = insert_statement(gtfs_class, columns)
+
+    conn = schedule.engine.connect()
+    try:
+        count = 0
+        commit_seconds = 0.0
+        batch = []
+        for record in records:
+            batch.append(convert(record))
+            if len(batch) == batch_size:
+                commit_seconds += _execute_batch(conn, statement, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            commit_seconds += _execute_batch(conn, statement, batch)
+            count += len(batch)
+    finally:
+        conn.close()
+
+    return count, commit_seconds
+
+
+def _execute_batch(conn, statement, batch):
+    """Inserts batch in one transaction, returning the seconds it took"""
+    start = time.time()
+    trans = conn.begin()
+    try:
+        conn.execute(statement, batch)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    return time.time() - start
+
+
+_worker_converters = {}
+
+
+def _convert_chunk(chunk):
+    """Pool worker: decodes and converts one chunk of raw CSV rows into
+    DB-API tuples for the writer"""
+    (tablename, header, rows) = chunk
+
+    if tablename not in _worker_converters:
+        gtfs_class = [cls for cls in GTFS_CLASSES
+                      if cls.__tablename__ == tablename][0]
+        _worker_converters[tablename] = row_converter(gtfs_class,
+                                                      sqlite.dialect())
+    convert = _worker_converters[tablename][1]
+
+    return tablename, [convert(make_record(header, row)) for row in rows]
+
+
+def _read_chunks(fd, gtfs_classes, chunk_rows, progress=None):
+    """Yields (tablename, header, rows) chunks of undecoded CSV rows for
+    every file in the feed"""
+    for gtfs_class in gtfs_classes:
+        filename = gtfs_class.__tablename__ + ".txt"
+
+        try:
+            reader = fd.get_reader(filename)
+        except FileNotFoundError:
+            if filename in OPTIONAL_FILES:
+                _say(progress, "Optional file %s not found. Continuing." %
+                     filename)
+            continue
+
+        rows = []
+        for row in reader.rd:
+            rows.append(row)
+            if len(rows) == chunk_rows:
+                yield (gtfs_class.__tablename__, reader.header, rows)
+                rows = []
+        if rows:
+            yield (gtfs_class.__tablename__, reader.header, rows)
+
+
+def _convert_in_pool(pool, chunks, jobs):
+    """Yields converted chunks in feed order, keeping at most jobs * 4 of
+    them in flight so memory stays flat however large the feed is"""
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(_convert_chunk, (chunk,)))
+        if len(pending) >= jobs * 4:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def parallel_load(schedule, fd, gtfs_classes, jobs, chunk_rows=10000,
+                  progress=None):
+    """Decodes and converts the feed's CSV files in a pool of jobs worker
+    processes, while this process drains the converted batches into the
+    database as the single writer. progress, if given, is called with the
+    TableStats of each table as it's finished. Returns {tablename:
+    TableStats}."""
+    classes = dict((cls.__tablename__, cls) for cls in gtfs_classes)
+    stats = {}
+
+    pool = multiprocessing.Pool(jobs)
+    conn = schedule.engine.connect()
+    try:
+        chunks = _read_chunks(fd, gtfs_classes, chunk_rows, progress)
+
+        current = None
+        table_start = time.time()
+        for (tablename, rows) in _convert_in_pool(pool, chunks, jobs):
+            if tablename != current:
+                if current is not None:
+                    table_start = _finish_table(fd, stats, current,
+                                                table_start, progress)
+                _say(progress, "loading %s" % classes[tablename])
+                current = tablename
+                stats[tablename] = [0, 0.0]
+
+                columns = [c.name for c in classes[tablename].__table__.columns]
+                statement = insert_statement(classes[tablename], columns)
+
+            stats[tablename][1] += _execute_batch(conn, statement, rows)
+            stats[tablename][0] += len(rows)
+
+        if current is not None:
+            _finish_table(fd, stats, current, table_start, progress)
+    finally:
+        pool.terminate()
+        pool.join()
+        conn.close()
+
+    return stats
+
+
+def _finish_table(fd, stats, tablename, table_start, progress):
+    now = time.time()
+    (rows, commit_seconds) = stats[tablename]
+    stats[tablename] = TableStats(tablename, rows, fd.size(tablename + ".txt"),
+                                  now - table_start, commit_seconds)
+    if progress is not None:
+        progress(stats[tablename])
+    return now
+
+
+def _say(progress, message):
+    """Prints message, unless progress is None, which asks for silence"""
+    if progress is not None:
+        print message
+
+
+def report_table(stats):
+    """The default loader progress callback: prints a table's TableStats"""
+    print "%s: %d rows, %d bytes in %.2fs (%d rows/sec, %.2fs committing)" % (
+        stats.tablename, stats.rows, stats.bytes, stats.seconds,
+        stats.rows_per_sec, stats.commit_seconds)
+
+
+def report_changes(changes):
+    """The default update progress callback: prints a table's
+    TableChanges"""
+    print "%s: %d inserted, %d updated, %d deleted in %.2fs" % changes
+
+
+def feed_checksums(fd, gtfs_classes):
+    """Returns {filename: SHA-1} for the files of gtfs_classes in the feed"""
+    checksums = {}
+    for gtfs_class in gtfs_classes:
+        filename = gtfs_class.__tablename__ + ".txt"
+        try:
+            checksums[filename] = fd.checksum(filename)
+        except FileNotFoundError:
+            pass
+    return checksums
+
+
+def _write_checksums(conn, checksums):
+    conn.execute(FeedFile.__table__.delete())
+    if checksums:
+        conn.execute(FeedFile.__table__.insert(),
+                     [{'filename': filename, 'sha1': sha1}
+                      for (filename, sha1) in sorted(checksums.items())])
+
+
+def record_checksums(schedule, fd):
+    """Records the checksum of every feed file in the feed_files table"""
+    checksums = feed_checksums(fd, GTFS_CLASSES)
+    conn = schedule.engine.connect()
+    trans = conn.begin()
+    try:
+        _write_checksums(conn, checksums)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _diff_columns(gtfs_class):
+    """Returns (columns, key) for diffing gtfs_class's table: the columns
+    its feed file fills in, and those of them that identify a row"""
+    key = gtfs_class.natural_key
+    if key is None:
+        key = [column.name for column in gtfs_class.__table__.primary_key]
+    columns = [column.name for column in gtfs_class.__table__.columns
+               if not column.info.get('derived')
+               and (column.name in key or not column.primary_key)]
+    return columns, list(key)
+
+
+def _create_feed_table(conn, gtfs_class):
+    """Creates the empty temp table a feed file is read into for diffing.
+    pysqlite commits before any DDL, so this has to happen before the
+    transaction the diffs are applied in begins."""
+    columns, key = _diff_columns(gtfs_class)
+    feed_table = "feed_" + gtfs_class.__tablename__
+    conn.execute("CREATE TEMP TABLE %s AS SELECT %s FROM %s WHERE 0" % (
+        feed_table, ", ".join(columns), gtfs_class.__tablename__))
+    if key:
+        conn.execute("CREATE INDEX temp.%s_key ON %s (%s)" % (
+            feed_table, feed_table, ", ".join(key)))
+    return feed_table
+
+
+def diff_table(conn, gtfs_class, rows, batch_size=50000):
+    """Brings gtfs_class's table in line with rows, the records of its feed
+    file as converted by row_converter, with set-based statements against
+    the temp table made by _create_feed_table. Rows whose key is gone are
+    deleted, rows whose other values differ are updated in place, and new
+    keys are inserted; tables with no key are simply replaced. Derived
+    columns are left for the caller to rebuild. Returns (inserted,
+    updated, deleted)."""
+    table = gtfs_class.__tablename__
+    feed_table = "feed_" + table
+    columns, key = _diff_columns(gtfs_class)
+
+    all_columns = [column.name for column in gtfs_class.__table__.columns]
+    positions = [all_columns.index(column) for column in columns]
+    statement = "INSERT INTO %s (%s) VALUES (%s)" % (
+        feed_table, ", ".join(columns), ", ".join("?" * len(columns)))
+    batch = []
+    for row in rows:
+        batch.append(tuple(row[i] for i in positions))
+        if len(batch) == batch_size:
+            conn.execute(statement, batch)
+            batch = []
+    if batch:
+        conn.execute(statement, batch)
+
+    names = ", ".join(columns)
+    if not key:
+        deleted = conn.execute("DELETE FROM %s" % table).rowcount
+        inserted = conn.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+            table, names, names, feed_table)).rowcount
+        return inserted, 0, deleted
+
+    match = " AND ".join("f.%s = %s.%s" % (column, table, column)
+                         for column in key)
+    deleted = conn.execute(
+        "DELETE FROM %s WHERE NOT EXISTS (SELECT 1 FROM %s f WHERE %s)" % (
+            table, feed_table, match)).rowcount
+
+    updated = 0
+    values = [column for column in columns if column not in key]
+    if values:
+        differs = " OR ".join("f.%s IS NOT %s.%s" % (column, table, column)
+                              for column in values)
+        assignments = ", ".join(
+            "%s = (SELECT f.%s FROM %s f WHERE %s)" % (column, column,
+                                                       feed_table, match)
+            for column in values)
+        updated = conn.execute(
+            "UPDATE %s SET %s WHERE EXISTS "
+            "(SELECT 1 FROM %s f WHERE %s AND (%s))" % (
+                table, assignments, feed_table, match, differs)).rowcount
+
+    inserted = conn.execute(
+        "INSERT INTO %s (%s) SELECT %s FROM %s f WHERE NOT EXISTS "
+        "(SELECT 1 FROM %s WHERE %s)" % (
+            table, names, ", ".join("f." + column for column in columns),
+            feed_table, table, match)).rowcount
+
+    return inserted, updated, deleted
+
+
+class _Ungrouped(Exception):
+    pass
+
+
+def _shape_points(records):
+    """Yields the points of shapes.txt records as (shape_id,
+    shape_pt_sequence, lat, lon, shape_dist_traveled) tuples"""
+    for record in records:
+        point = ShapePoint.convert_record(record)
+        dist = point.get('shape_dist_traveled')
+        yield (point['shape_id'], int(point['shape_pt_sequence']),
+               point['shape_pt_lat'], point['shape_pt_lon'],
+               float(dist) if dist else None)
+
+
+def _grouped_shapes(points):
+    """Yields (shape_id, points) for each run of points with the same
+    shape_id. Raises _Ungrouped if a shape_id comes back after another."""
+    seen = set()
+    for (shape_id, run) in groupby(points, itemgetter(0)):
+        if shape_id in seen:
+            raise _Ungrouped(shape_id)
+        seen.add(shape_id)
+        yield shape_id, list(run)
+
+
+def _insert_packed(conn, grouped, tolerance, batch_size):
+    """Packs each shape of grouped and inserts them in executemany batches
+    of batch_size shapes, all in one transaction. Returns the number of
+    shapes."""
+    statement = PackedShape.__table__.insert()
+    count = 0
+    batch = []
+    trans = conn.begin()
+    try:
+        for (shape_id, shape) in grouped:
+            shape.sort(key=itemgetter(1))
+            if tolerance:
+                shape = [shape[i] for i in shapes.simplify(
+                    [point[2:4] for point in shape], tolerance)]
+            batch.append({'shape_id': shape_id,
+                          'num_points': len(shape),
+                          'points': shapes.pack_points(
+                              [point[2:4] for point in shape]),
+                          'distances': shapes.pack_distances(
+                              [point[4] for point in shape])})
+            if len(batch) == batch_size:
+                conn.execute(statement, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            conn.execute(statement, batch)
+            count += len(batch)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    return count
+
+
+def pack_shapes(schedule, fd, tolerance=None, batch_size=1000):
+    """Loads shapes.txt into the packed_shapes table, one row per shape_id,
+    optionally simplifying each shape to within tolerance metres first.
+
+    Shapes are packed as they're read, so only one is held in memory at a
+    time, provided shapes.txt keeps each shape's points together, as feeds
+    almost always do. If it doesn't, the points are first copied into a
+    temporary table for SQLite to sort by shape_id."""
+    filename = ShapePoint.__tablename__ + ".txt"
+    try:
+        records = fd.get_reader(filename)
+    except FileNotFoundError:
+        return 0
+
+    conn = schedule.engine.connect()
+    try:
+        try:
+            return _insert_packed(conn,
+                                  _grouped_shapes(_shape_points(records)),
+                                  tolerance, batch_size)
+        except _Ungrouped:
+            pass
+
+        conn.execute("CREATE TEMP TABLE shape_points "
+                     "(shape_id, sequence, lat, lon, dist)")
+        points = _shape_points(fd.get_reader(filename))
+        while True:
+            batch = list(islice(points, 50000))
+            if not batch:
+                break
+            _execute_batch(conn, "INSERT INTO shape_points "
+                                 "VALUES (?, ?, ?, ?, ?)", batch)
+        rows = conn.execute("SELECT * FROM shape_points "
+                            "ORDER BY shape_id, sequence")
+        count = _insert_packed(conn, ((shape_id, list(run)) for
+                                      (shape_id, run) in
+                                      groupby(rows, itemgetter(0))),
+                               tolerance, batch_size)
+        conn.execute("DROP TABLE shape_points")
+        return count
+    finally:
+        conn.close()
+
+
+FIRST_STOP_TIMES = ("CREATE TEMP TABLE IF NOT EXISTS first_stop_times "
+                    "(trip_id PRIMARY KEY, arrival_time, departure_time)")
+
+
+def _fill_trip_times(conn, compressed):
+    """Fills in the derived trip time columns through conn, which must
+    have the empty first_stop_times table. A compressed database keeps
+    elapsed_time in timing_offsets, where it depends only on the profile."""
+    # SQLite takes the bare columns from the row with the MIN()
+    conn.execute("INSERT INTO first_stop_times "
+                 "SELECT trip_id, arrival_time, departure_time FROM "
+                 "(SELECT trip_id, MIN(stop_sequence), arrival_time, "
+                 " departure_time FROM stop_times GROUP BY trip_id)")
+    if compressed:
+        conn.execute("UPDATE timing_offsets SET elapsed_time = "
+                     "arrival_offset - (SELECT f.arrival_offset "
+                     " FROM timing_offsets f "
+                     " WHERE f.profile_id = timing_offsets.profile_id "
+                     " AND f.position = 0)")
+    else:
+        conn.execute("UPDATE stop_times SET elapsed_time = arrival_time - "
+                     "(SELECT f.arrival_time FROM first_stop_times f "
+                     " WHERE f.trip_id = stop_times.trip_id)")
+    conn.execute("UPDATE trips SET first_departure = "
+                 "(SELECT f.departure_time FROM first_stop_times f "
+                 " WHERE f.trip_id = trips.trip_id), "
+                 "uses_frequency = EXISTS "
+                 "(SELECT 1 FROM frequencies f "
+                 " WHERE f.trip_id = trips.trip_id)")
+    conn.execute("DELETE FROM first_stop_times")
+
+
+def build_trip_times(schedule):
+    """Fills in the columns derived from stop_times and frequencies, each
+    with one set-based UPDATE: every trip's first_departure and
+    uses_frequency, and every stop time's elapsed_time"""
+    compressed = is_compressed(schedule)
+    conn = schedule.engine.connect()
+    try:
+        conn.execute(FIRST_STOP_TIMES)
+        trans = conn.begin()
+        try:
+            _fill_trip_times(conn, compressed)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        conn.execute("DROP TABLE first_stop_times")
+    finally:
+        conn.close()
+
+
+def build_service_dates(schedule):
+    """Expands calendar and calendar_dates into the service_dates table,
+    one row for every date on which each service_id runs"""
+    dates = set()
+    for period in schedule.session.query(ServicePeriod):
+        day = period.start_date
+        while day <= period.end_date:
+            if period.active_on_dow(day.weekday()):
+                dates.add((period.service_id, day))
+            day += timedelta(days=1)
+
+    for exception in schedule.session.query(ServiceException):
+        if exception.exception_type == 1:
+            dates.add((exception.service_id, exception.date))
+        elif exception.exception_type == 2:
+            dates.discard((exception.service_id, exception.date))
+    schedule.session.commit()
+
+    conn = schedule.engine.connect()
+    trans = conn.begin()
+    try:
+        conn.execute(ServiceDate.__table__.delete())
+        if dates:
+            conn.execute(ServiceDate.__table__.insert(),
+                         [{'service_id': service_id, 'date': day}
+                          for (service_id, day) in sorted(dates)])
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+    schedule.clear_caches()
+
+
+def load(feed_filename, db_filename=":memory:", bulk=False, jobs=1,
+         pack=False, shape_tolerance=None, compress=False,
+         progress=report_table, summarize=False):
+    """Compiles a GTFS feed into a Schedule.
+
+    bulk writes rows in executemany batches rather than through the ORM;
+    jobs > 1 additionally converts them in that many worker processes.
+    pack stores each shape as one PackedShape row instead of a ShapePoint
+    per vertex, first simplifying it to within shape_tolerance metres if
+    that's given. compress replaces the stop_times table with trip
+    patterns and a read-only view; see gtfs.patterns. summarize builds
+    the service summary tables of gtfs.analytics. progress is called
+    with the TableStats of each table once it's loaded, and the other
+    steps are reported as they start; pass None for silence."""
+    schedule = Schedule(db_filename, pragmas={'synchronous': 'OFF'})
     schedule.create_tables()
 
-    schedule.engine.execute("PRAGMA synchronous=OFF")
+    fd = Feed(feed_filename)
+
+    gtfs_classes = GTFS_CLASSES
+    if pack:
+        gtfs_classes = [cls for cls in gtfs_classes if cls is not ShapePoint]
+
+    if jobs > 1:
+        parallel_load(schedule, fd, gtfs_classes, jobs, progress=progress)
+    else:
+        serial_load(schedule, fd, gtfs_classes, bulk, progress)
+
+    build_trip_times(schedule)
+
+    if pack:
+        _say(progress, "packing shapes")
+        pack_shapes(schedule, fd, shape_tolerance)
+
+    if compress:
+        _say(progress, "compressing stop_times: %d trips, %d patterns, "
+                       "%d timing profiles" % compress_stop_times(schedule))
+        if db_filename != ":memory:":
+            schedule.engine.execute("VACUUM")
+
+    build_service_dates(schedule)
+    record_checksums(schedule, fd)
+    schedule.stop_index()
+
+    if summarize:
+        _say(progress, "summarizing service")
+        analytics.build(schedule)
 
+    return schedule
+
+
+def update(feed_filename, db_filename, bulk=False, jobs=1, pack=False,
+           shape_tolerance=None, compress=False, progress=report_changes,
+           summarize=False):
+    """Brings the Schedule compiled into db_filename up to date with a new
+    version of its feed. The options are those of load(), and should be
+    the ones the database was compiled with.
+
+    Feed files whose checksums match those recorded by the last compile
+    are skipped. The tables of the rest are diffed against their files by
+    natural key, and all the differences applied in one transaction, along
+    with the trip time columns derived from them; the service dates and
+    packed shapes derived from the rest are rebuilt after. A database with
+    no recorded checksums, or a compressed one whose trips or stop times
+    have changed, is compiled again from scratch. progress is called
+    with the TableChanges of each changed table, or may be None for
+    silence, including that of any compile from scratch. The summary
+    tables are built again if summarize is true or they had been built
+    before. Returns the Schedule."""
+    if not os.path.exists(db_filename):
+        return load(feed_filename, db_filename, bulk, jobs, pack,
+                    shape_tolerance, compress,
+                    None if progress is None else report_table, summarize)
+
+    schedule = Schedule(db_filename)
+    schedule.create_tables()
     fd = Feed(feed_filename)
+    summarize = summarize or analytics.is_built(schedule)
+
+    old = dict((row.filename, row.sha1)
+               for row in schedule.session.query(FeedFile))
+    schedule.session.commit()
+    new = feed_checksums(fd, GTFS_CLASSES)
+    changed = [cls for cls in GTFS_CLASSES
+               if old.get(cls.__tablename__ + ".txt") !=
+               new.get(cls.__tablename__ + ".txt")]
 
-    for gtfs_class in (Agency, Route, Stop, Trip, StopTime,
-                       ServicePeriod, ServiceException,
-                       Fare, FareRule, ShapePoint,
-                       Frequency, Transfer):
+    # the stop_times view can't be diffed, whatever compress says
+    compressed = is_compressed(schedule)
+    if not old or (compressed and (Trip in changed or StopTime in changed)):
+        _say(progress, "compiling %s from scratch" % db_filename)
+        schedule.engine.dispose()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_filename + suffix):
+                os.remove(db_filename + suffix)
+        return load(feed_filename, db_filename, bulk, jobs, pack,
+                    shape_tolerance, compress,
+                    None if progress is None else report_table, summarize)
+
+    diffed = [cls for cls in changed if not (pack and cls is ShapePoint)]
+    trip_times = Trip in changed or StopTime in changed or \
+        Frequency in changed
+    pool = multiprocessing.Pool(jobs) if jobs > 1 and diffed else None
+    conn = schedule.engine.connect()
+    try:
+        # pysqlite commits before any DDL, so every temp table is made first
+        feed_tables = [_create_feed_table(conn, cls) for cls in diffed]
+        if trip_times:
+            conn.execute(FIRST_STOP_TIMES)
+            feed_tables.append("first_stop_times")
+        trans = conn.begin()
+        try:
+            for gtfs_class in diffed:
+                start = time.time()
+                rows = _converted_rows(schedule, fd, gtfs_class, pool, jobs)
+                (inserted, updated, deleted) = diff_table(conn, gtfs_class,
+                                                          rows)
+                if progress is not None:
+                    progress(TableChanges(gtfs_class.__tablename__, inserted,
+                                          updated, deleted,
+                                          time.time() - start))
+            if trip_times:
+                _fill_trip_times(conn, compressed)
+            _write_checksums(conn, new)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        for feed_table in feed_tables:
+            conn.execute("DROP TABLE %s" % feed_table)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        conn.close()
+
+    if pack and ShapePoint in changed:
+        schedule.engine.execute(PackedShape.__table__.delete())
+        _say(progress, "packing shapes")
+        pack_shapes(schedule, fd, shape_tolerance)
+
+    if ServicePeriod in changed or ServiceException in changed:
+        build_service_dates(schedule)
+
+    schedule.clear_caches()
+    schedule.stop_index()
+
+    if summarize and not analytics.is_current(schedule):
+        _say(progress, "summarizing service")
+        analytics.build(schedule)
+
+    return schedule
 
-        print "loading %s" % gtfs_class
+
+def _converted_rows(schedule, fd, gtfs_class, pool, jobs):
+    """Yields the records of gtfs_class's feed file converted into DB-API
+    tuples, in pool if there is one, or else in this process"""
+    if pool is not None:
+        chunks = _read_chunks(fd, [gtfs_class], 10000)
+        for (tablename, rows) in _convert_in_pool(pool, chunks, jobs):
+            for row in rows:
+                yield row
+        return
+
+    try:
+        records = fd.get_reader(gtfs_class.__tablename__ + ".txt")
+    except FileNotFoundError:
+        return
+    convert = row_converter(gtfs_class, schedule.engine.dialect)[1]
+    for record in records:
+        yield convert(record)
+
+
+def serial_load(schedule, fd, gtfs_classes, bulk, progress=None):
+
+    for gtfs_class in gtfs_classes:
+
+        _say(progress, "loading %s" % gtfs_class)
 
         filename = gtfs_class.__tablename__ + ".txt"
 
         try:
             records = fd.get_reader(filename)
+            table_start = time.time()
 
-            for (i, record) in enumerate(records):
-                if (i % 25000) == 0:
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
-                    schedule.session.commit()
+            if bulk:
+                (count, commit_seconds) = bulk_load(schedule, gtfs_class,
+                                                    records)
+            else:
+                count = 0
+                commit_seconds = 0.0
+                for (i, record) in enumerate(records):
+                    if i and (i % 25000) == 0:
+                        commit_seconds += _commit(schedule.session)
 
-                instance = gtfs_class(**record)
-                schedule.session.add(instance)
-            print
-            schedule.session.commit()
+                    instance = gtfs_class(**record)
+                    schedule.session.add(instance)
+                    count += 1
+                commit_seconds += _commit(schedule.session)
+            if progress is not None:
+                progress(TableStats(gtfs_class.__tablename__, count,
+                                    fd.size(filename),
+                                    time.time() - table_start,
+                                    commit_seconds))
         except (FileNotFoundError):
-            optional_files = ['calendar_dates', 'fare_rules',
-                              'frequencies', 'transfers']
-            if filename in optional_files:
-                print "Optional file %s not found. Continuing." % filename
+            if filename in OPTIONAL_FILES:
+                _say(progress, "Optional file %s not found. Continuing." %
+                     filename)
                 continue
 
-    return schedule
+
+def _commit(session):
+    """Flushes and commits session, returning the seconds it took"""
+    start = time.time()
+    session.commit()
+    return time.time() - start
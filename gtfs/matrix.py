@@ -0,0 +1,137 @@
+"""Many-to-many travel-time matrices over one service day.
+
+A Matrix builds a single Router for the day, then shares it among a pool
+of worker processes by forking after it's built, so every worker reads
+the same patterns and footpaths through copy-on-write pages rather than
+building or receiving its own. Origins are sharded across the workers,
+each running a one-to-all earliest-arrival search per departure time and
+sending back only the destinations' times. The searches share nothing,
+so throughput grows with the number of workers.
+
+Origins and destinations are lists of stop_ids or dicts of zone name to
+lists of stop_ids. A zone is left from all of its stops at once, and
+reached when the first of its stops is. Travel times are in seconds from
+the departure time; unreachable destinations are infinite in arrays and
+left out of CSV files.
+
+    >>> times = Matrix(schedule, date(2024, 7, 5)).array(
+    ...     zones, zones, range(8 * 3600, 9 * 3600, 600), jobs=8)
+    >>> times.shape  # departure times, origins, destinations
+    (6, 1200, 1200)
+
+Requires NumPy."""
+
+from csv import writer
+import multiprocessing
+
+import numpy as np
+
+from gtfs.routing import Router, INFINITY
+
+# set before the pool forks, so the workers inherit them
+_router = None
+_search = None
+
+
+def _points(places):
+    """Returns (labels, lists of stop_ids) for a list of stop_ids or a dict
+    of zone names to lists of stop_ids"""
+    if isinstance(places, dict):
+        labels = sorted(places)
+        return labels, [places[label] for label in labels]
+    return list(places), [[stop_id] for stop_id in places]
+
+
+def _travel_times(origin):
+    """Pool worker: the travel times from one origin, as (origin position,
+    a list per departure time of a list per destination)"""
+    (position, sources) = origin
+    (destinations, departure_times, max_transfers) = _search
+
+    out = []
+    for time in departure_times:
+        best = _router._run(dict((stop, time) for stop in sources),
+                            max_transfers)[1]
+        out.append([min(best[stop] for stop in stops) - time
+                    if stops else INFINITY for stops in destinations])
+    return position, out
+
+
+class Matrix(object):
+
+    def __init__(self, schedule, service_date):
+        self.router = Router(schedule, service_date)
+
+    def _stop_indexes(self, stop_lists):
+        # stops that no trip serves on the day can't be reached at all
+        index = self.router.stop_index
+        return [[index[stop_id] for stop_id in stop_ids if stop_id in index]
+                for stop_ids in stop_lists]
+
+    def travel_times(self, origins, destinations, departure_times, jobs=1,
+                     max_transfers=4):
+        """Yields (origin label, [travel times to each destination, per
+        departure time]) as each origin is finished, in jobs worker
+        processes, in the order of origins"""
+        global _router, _search
+
+        (origin_labels, origin_stops) = _points(origins)
+        origin_stops = self._stop_indexes(origin_stops)
+        destination_stops = self._stop_indexes(_points(destinations)[1])
+
+        _router = self.router
+        _search = (destination_stops, list(departure_times), max_transfers)
+        pool = None
+        try:
+            if jobs > 1:
+                pool = multiprocessing.Pool(jobs)
+                results = pool.imap(_travel_times, enumerate(origin_stops))
+            else:
+                results = (_travel_times(origin)
+                           for origin in enumerate(origin_stops))
+            for (position, times) in results:
+                yield origin_labels[position], times
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            _router = _search = None
+
+    def array(self, origins, destinations, departure_times, jobs=1,
+              max_transfers=4):
+        """Returns the travel times as a float array indexed by departure
+        time, origin and destination, in the order given, or that of the
+        sorted zone names"""
+        departure_times = list(departure_times)
+        out = np.empty((len(departure_times), len(_points(origins)[0]),
+                        len(_points(destinations)[0])))
+        for (o, (label, times)) in enumerate(self.travel_times(
+                origins, destinations, departure_times, jobs,
+                max_transfers)):
+            out[:, o, :] = times
+        return out
+
+    def write_csv(self, filename, origins, destinations, departure_times,
+                  jobs=1, max_transfers=4):
+        """Streams the reachable destinations to filename as CSV rows of
+        origin, destination, departure_time and travel_time, origin by
+        origin. Returns the number of rows written."""
+        destination_labels = _points(destinations)[0]
+        departure_times = list(departure_times)
+
+        count = 0
+        with open(filename, "wb") as fp:
+            out = writer(fp)
+            out.writerow(["origin", "destination", "departure_time",
+                          "travel_time"])
+            for (origin, times) in self.travel_times(
+                    origins, destinations, departure_times, jobs,
+                    max_transfers):
+                for (time, row) in zip(departure_times, times):
+                    for (destination, travel_time) in zip(
+                            destination_labels, row):
+                        if travel_time != INFINITY:
+                            out.writerow([origin, destination, time,
+                                          int(travel_time)])
+                            count += 1
+        return count
@@ -0,0 +1,148 @@
+"""Compression of stop_times into trip patterns.
+
+Most trips of a route visit the same stops with the same stop attributes,
+and many also share the same running times. compress_stop_times rewrites
+the stop_times table as
+
+  pattern_stops   -- each distinct sequence of stops, once
+  timing_offsets  -- each distinct set of arrival/departure offsets for a
+                     pattern, once
+  trip_patterns   -- per trip, its pattern, timing profile and start time
+
+and replaces the table with a view of the same name and columns that
+reassembles the original rows, so StopTime, trip.stop_times and
+stop.stop_times keep working (read-only) against a compressed database.
+
+Dropping the table drops its index on (stop_id, departure_time) too, and
+the view's departure_time is computed, so no index can take its place.
+Looking up a stop's stop times, as Schedule.departures() does, still
+goes through indexes -- pattern_stops.stop_id to the patterns serving the
+stop and trip_patterns.pattern_id to their trips -- but every trip of
+those patterns is read, rather than only those in the time window."""
+
+from gtfs.entity import *
+
+STOP_TIMES_VIEW = """
+CREATE VIEW stop_times AS
+SELECT tp.rowid * 100000 + ps.position AS id,
+       tp.trip_id AS trip_id,
+       tp.start_time + o.arrival_offset AS arrival_time,
+       tp.start_time + o.departure_offset AS departure_time,
+       ps.stop_id AS stop_id,
+       ps.stop_sequence AS stop_sequence,
+       ps.stop_headsign AS stop_headsign,
+       ps.pickup_type AS pickup_type,
+       ps.drop_off_type AS drop_off_type,
+       ps.shape_dist_traveled AS shape_dist_traveled,
+       o.elapsed_time AS elapsed_time
+FROM trip_patterns tp
+JOIN pattern_stops ps ON ps.pattern_id = tp.pattern_id
+JOIN timing_offsets o ON o.profile_id = tp.profile_id
+                     AND o.position = ps.position
+"""
+
+
+def is_compressed(schedule):
+    """True if schedule's stop_times is the trip pattern view"""
+    return schedule.engine.execute(
+        "SELECT count(*) FROM sqlite_master "
+        "WHERE type = 'view' AND name = 'stop_times'").scalar() > 0
+
+
+def _trips(conn, batch_size=100000):
+    """Yields (trip_id, rows) for each trip in stop_times, with rows in
+    stop_sequence order"""
+    result = conn.execute("SELECT trip_id, stop_id, stop_sequence, "
+                          "stop_headsign, pickup_type, drop_off_type, "
+                          "shape_dist_traveled, arrival_time, departure_time, "
+                          "elapsed_time "
+                          "FROM stop_times ORDER BY trip_id, stop_sequence")
+    trip_id = None
+    rows = []
+    while True:
+        batch = result.fetchmany(batch_size)
+        if not batch:
+            break
+        for row in batch:
+            if row[0] != trip_id:
+                if rows:
+                    yield trip_id, rows
+                trip_id = row[0]
+                rows = []
+            rows.append(row)
+    if rows:
+        yield trip_id, rows
+
+
+def compress_stop_times(schedule, batch_size=50000):
+    """Rewrites schedule's stop_times table as trip patterns. Returns
+    (trips, patterns, profiles)."""
+    patterns = {}
+    profiles = {}
+    pattern_rows = []
+    offset_rows = []
+    trip_rows = []
+    trips = 0
+
+    conn = schedule.engine.connect()
+    trans = conn.begin()
+    try:
+        for (trip_id, rows) in _trips(conn):
+            stops = tuple(tuple(row[1:7]) for row in rows)
+            if stops not in patterns:
+                patterns[stops] = len(patterns)
+                for (position, stop) in enumerate(stops):
+                    pattern_rows.append((patterns[stops], position) + stop)
+            pattern_id = patterns[stops]
+
+            timed = [t for row in rows for t in (row[8], row[7])
+                     if t is not None]
+            start = timed[0] if timed else None
+            offsets = tuple((None if arrival is None else arrival - start,
+                             None if departure is None else departure - start,
+                             elapsed)
+                            for (arrival, departure, elapsed) in
+                            [(row[7], row[8], row[9]) for row in rows])
+
+            key = (pattern_id, offsets)
+            if key not in profiles:
+                profiles[key] = len(profiles)
+                for (position, offset) in enumerate(offsets):
+                    offset_rows.append((profiles[key], position) + offset)
+
+            trip_rows.append((trip_id, pattern_id, profiles[key], start))
+            trips += 1
+
+            if len(trip_rows) >= batch_size:
+                _flush(conn, pattern_rows, offset_rows, trip_rows)
+
+        _flush(conn, pattern_rows, offset_rows, trip_rows)
+
+        conn.execute("DROP TABLE stop_times")
+        conn.execute(STOP_TIMES_VIEW)
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        conn.close()
+
+    schedule.clear_caches()
+    return trips, len(patterns), len(profiles)
+
+
+def _flush(conn, pattern_rows, offset_rows, trip_rows):
+    for (statement, rows) in (
+            ("INSERT INTO pattern_stops (pattern_id, position, stop_id, "
+             "stop_sequence, stop_headsign, pickup_type, drop_off_type, "
+             "shape_dist_traveled) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+             pattern_rows),
+            ("INSERT INTO timing_offsets (profile_id, position, "
+             "arrival_offset, departure_offset, elapsed_time) "
+             "VALUES (?, ?, ?, ?, ?)",
+             offset_rows),
+            ("INSERT INTO trip_patterns (trip_id, pattern_id, profile_id, "
+             "start_time) VALUES (?, ?, ?, ?)", trip_rows)):
+        if rows:
+            conn.execute(statement, rows)
+            del rows[:]
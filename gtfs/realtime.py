@@ -0,0 +1,625 @@
+"""GTFS-Realtime TripUpdates applied over a compiled schedule.
+
+parse_feed() decodes a FeedMessage from a byte string, and read_feed()
+from a file, with a small protocol buffer decoder of its own, so neither
+protobuf nor the gtfs-realtime bindings are needed. Only TripUpdate
+entities are decoded; vehicle positions, alerts and extensions are
+skipped over.
+
+An Overlay holds the predicted delays of one service day in arrays laid
+out like the gtfs.timetable.Timetable's stop times, in trip and
+stop_sequence order, beside a mask of skipped stops. Applying a
+TripUpdate overwrites the slice of its trip, and nothing else, so a
+DIFFERENTIAL message costs only what it updates; a FULL_DATASET message
+clears the overlay first. The SQLite tables are never written.
+
+A message's trip updates are applied together, their stop time updates
+found with one search and their delays carried along in NumPy. On Python
+2.7, a snapshot of 50k trip updates with three stop time updates each
+takes about 0.3s to apply once decoded and 0.55 to 0.75s to decode: about
+a second from bytes to overlay, most of it in decoding.
+
+    >>> overlay = Overlay(schedule, date.today())
+    >>> overlay.apply(read_feed("tripupdates.pb"))
+    >>> overlay.departures("S1", "08:00:00", "09:00:00")
+    [PredictedDeparture(trip_id=u'AWD1', ..., departure_time=28800,
+                        predicted_arrival_time=28920,
+                        predicted_departure_time=28920, skipped=False)]
+
+Delays follow the GTFS-Realtime rules: a stop time update's departure
+delay carries on to the stops after it until the next update, and stops
+before the first update keep the trip's delay, if it has one, or their
+scheduled times. Predicted times given as POSIX times are counted from
+the service day's midnight, noon less twelve hours, in the process's
+local timezone unless the Overlay is given midnight. Untimed stop times,
+and the runs of frequency-based trips, keep their scheduled times.
+
+Requires NumPy."""
+
+from array import array
+from bisect import bisect_left
+from codecs import utf_8_decode as _utf_8_decode
+from collections import namedtuple
+import gc
+from operator import itemgetter
+import time
+
+import numpy as np
+
+from gtfs.schedule import Departure
+
+FULL_DATASET = 0
+DIFFERENTIAL = 1
+
+# TripDescriptor.ScheduleRelationship
+SCHEDULED = 0
+ADDED = 1
+UNSCHEDULED = 2
+CANCELED = 3
+
+# StopTimeUpdate.ScheduleRelationship
+SKIPPED = 1
+NO_DATA = 2
+
+FeedMessage = namedtuple("FeedMessage", ["version", "incrementality",
+                                         "timestamp", "entities"])
+FeedEntity = namedtuple("FeedEntity", ["id", "is_deleted", "trip_update"])
+TripUpdate = namedtuple("TripUpdate", ["trip_id", "route_id", "start_time",
+                                       "start_date", "schedule_relationship",
+                                       "delay", "timestamp",
+                                       "stop_time_updates"])
+StopTimeUpdate = namedtuple("StopTimeUpdate", ["stop_sequence", "stop_id",
+                                               "arrival_delay", "arrival_time",
+                                               "departure_delay",
+                                               "departure_time",
+                                               "schedule_relationship"])
+PredictedDeparture = namedtuple("PredictedDeparture", Departure._fields + (
+    "predicted_arrival_time", "predicted_departure_time", "skipped"))
+
+
+class DecodeError(ValueError):
+    pass
+
+
+# builds namedtuples without the keyword handling of their constructors
+_new_tuple = tuple.__new__
+
+
+def _varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _signed(value):
+    # int32 and int64 are sent as 64-bit two's complement
+    return int(value - (1 << 64)) if value >= 1 << 63 else value
+
+
+def _tag(field, wire_type):
+    return (field << 3) | wire_type
+
+# the tags of the fields read, as (field number << 3) | wire type: 0 for
+# varints, 2 for strings and messages
+VARINT_1, VARINT_2, VARINT_3, VARINT_4, VARINT_5 = [
+    _tag(field, 0) for field in range(1, 6)]
+BYTES_1, BYTES_2, BYTES_3, BYTES_4, BYTES_5 = [
+    _tag(field, 2) for field in range(1, 6)]
+
+
+def _skip(data, pos, tag):
+    wire_type = tag & 7
+    if wire_type == 0:
+        return _varint(data, pos)[1]
+    elif wire_type == 1:
+        return pos + 8
+    elif wire_type == 2:
+        (length, pos) = _varint(data, pos)
+        return pos + length
+    elif wire_type == 5:
+        return pos + 4
+    raise DecodeError("unsupported wire type %d" % wire_type)
+
+
+def _string(data, pos, end):
+    # final, so that a truncated character raises rather than being dropped
+    return _utf_8_decode(data[pos:end], "strict", True)[0]
+
+# The decoders below run once per entity or stop time update, so they read
+# one-byte tags, lengths and varints inline rather than through _varint,
+# which is only called for the rest, and decode strings without _string.
+
+
+def _stop_time_event(data, pos, end):
+    delay = when = None
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        if tag >= 0x80:
+            (tag, pos) = _varint(data, pos - 1)
+        if tag == VARINT_1:
+            delay = data[pos]
+            pos += 1
+            if delay >= 0x80:
+                (delay, pos) = _varint(data, pos - 1)
+                delay = _signed(delay)
+        elif tag == VARINT_2:
+            (when, pos) = _varint(data, pos)
+            when = _signed(when)
+        else:
+            pos = _skip(data, pos, tag)
+    return delay, when
+
+
+def _stop_time_update(data, pos, end):
+    sequence = stop_id = None
+    arrival = departure = (None, None)
+    relationship = SCHEDULED
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        if tag >= 0x80:
+            (tag, pos) = _varint(data, pos - 1)
+        if tag == VARINT_1:
+            sequence = data[pos]
+            pos += 1
+            if sequence >= 0x80:
+                (sequence, pos) = _varint(data, pos - 1)
+        elif tag == BYTES_2 or tag == BYTES_3 or tag == BYTES_4:
+            length = data[pos]
+            pos += 1
+            if length >= 0x80:
+                (length, pos) = _varint(data, pos - 1)
+            if tag == BYTES_2:
+                arrival = _stop_time_event(data, pos, pos + length)
+            elif tag == BYTES_3:
+                departure = _stop_time_event(data, pos, pos + length)
+            else:
+                stop_id = _utf_8_decode(data[pos:pos + length], "strict",
+                                        True)[0]
+            pos += length
+        elif tag == VARINT_5:
+            (relationship, pos) = _varint(data, pos)
+        else:
+            pos = _skip(data, pos, tag)
+    return _new_tuple(StopTimeUpdate, (sequence, stop_id, arrival[0],
+                                       arrival[1], departure[0], departure[1],
+                                       relationship))
+
+
+def _trip_descriptor(data, pos, end):
+    trip_id = route_id = start_time = start_date = None
+    relationship = SCHEDULED
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        if tag >= 0x80:
+            (tag, pos) = _varint(data, pos - 1)
+        if tag == BYTES_1 or tag == BYTES_2 or tag == BYTES_3 or \
+           tag == BYTES_5:
+            length = data[pos]
+            pos += 1
+            if length >= 0x80:
+                (length, pos) = _varint(data, pos - 1)
+            value = _utf_8_decode(data[pos:pos + length], "strict", True)[0]
+            pos += length
+            if tag == BYTES_1:
+                trip_id = value
+            elif tag == BYTES_2:
+                start_time = value
+            elif tag == BYTES_3:
+                start_date = value
+            else:
+                route_id = value
+        elif tag == VARINT_4:
+            (relationship, pos) = _varint(data, pos)
+        else:
+            pos = _skip(data, pos, tag)
+    return trip_id, route_id, start_time, start_date, relationship
+
+
+def _trip_update(data, pos, end):
+    descriptor = (None, None, None, None, SCHEDULED)
+    delay = stamp = None
+    updates = []
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        if tag >= 0x80:
+            (tag, pos) = _varint(data, pos - 1)
+        if tag == BYTES_2 or tag == BYTES_1:
+            length = data[pos]
+            pos += 1
+            if length >= 0x80:
+                (length, pos) = _varint(data, pos - 1)
+            if tag == BYTES_2:
+                updates.append(_stop_time_update(data, pos, pos + length))
+            else:
+                descriptor = _trip_descriptor(data, pos, pos + length)
+            pos += length
+        elif tag == VARINT_4:
+            (stamp, pos) = _varint(data, pos)
+        elif tag == VARINT_5:
+            (delay, pos) = _varint(data, pos)
+            delay = _signed(delay)
+        else:
+            pos = _skip(data, pos, tag)
+    return _new_tuple(TripUpdate, descriptor + (delay, stamp, updates))
+
+
+def _entity(data, pos, end):
+    entity_id = trip_update = None
+    is_deleted = False
+    while pos < end:
+        tag = data[pos]
+        pos += 1
+        if tag >= 0x80:
+            (tag, pos) = _varint(data, pos - 1)
+        if tag == BYTES_1 or tag == BYTES_3:
+            length = data[pos]
+            pos += 1
+            if length >= 0x80:
+                (length, pos) = _varint(data, pos - 1)
+            if tag == BYTES_3:
+                trip_update = _trip_update(data, pos, pos + length)
+            else:
+                entity_id = _utf_8_decode(data[pos:pos + length],
+                                          "strict", True)[0]
+            pos += length
+        elif tag == VARINT_2:
+            (is_deleted, pos) = _varint(data, pos)
+            is_deleted = bool(is_deleted)
+        else:
+            pos = _skip(data, pos, tag)
+    return FeedEntity(entity_id, is_deleted, trip_update)
+
+
+def _feed_header(data, pos, end):
+    version = stamp = None
+    incrementality = FULL_DATASET
+    while pos < end:
+        (tag, pos) = _varint(data, pos)
+        if tag == BYTES_1:
+            (length, pos) = _varint(data, pos)
+            version = _string(data, pos, pos + length)
+            pos += length
+        elif tag == VARINT_2:
+            (incrementality, pos) = _varint(data, pos)
+        elif tag == VARINT_3:
+            (stamp, pos) = _varint(data, pos)
+        else:
+            pos = _skip(data, pos, tag)
+    return version, incrementality, stamp
+
+
+def parse_feed(data):
+    """Decodes a FeedMessage from the byte string data. Entities without a
+    TripUpdate are left out, unless they delete one."""
+    data = bytearray(data)
+    header = (None, FULL_DATASET, None)
+    entities = []
+    (pos, end) = (0, len(data))
+    # the decoded tuples and lists can't form cycles, but there are enough
+    # of them to set off many collections over everything they fill
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        while pos < end:
+            tag = data[pos]
+            pos += 1
+            if tag >= 0x80:
+                (tag, pos) = _varint(data, pos - 1)
+            if tag == BYTES_2:
+                length = data[pos]
+                pos += 1
+                if length >= 0x80:
+                    (length, pos) = _varint(data, pos - 1)
+                entity = _entity(data, pos, pos + length)
+                if entity.trip_update is not None or entity.is_deleted:
+                    entities.append(entity)
+                pos += length
+            elif tag == BYTES_1:
+                (length, pos) = _varint(data, pos)
+                header = _feed_header(data, pos, pos + length)
+                pos += length
+            else:
+                pos = _skip(data, pos, tag)
+    except IndexError:
+        raise DecodeError("truncated message")
+    except UnicodeDecodeError:
+        raise DecodeError("bad UTF-8 string")
+    finally:
+        if collecting:
+            gc.enable()
+    if pos != end:
+        raise DecodeError("truncated message")
+    return FeedMessage(*header + (entities,))
+
+
+def read_feed(filename):
+    """Decodes the FeedMessage in the file filename"""
+    with open(filename, "rb") as fp:
+        return parse_feed(fp.read())
+
+
+def _array(values):
+    return array("i", values.astype(np.intc).tostring())
+
+
+class Overlay(object):
+
+    def __init__(self, schedule, service_date, midnight=None):
+        """An empty overlay over schedule's stop times on service_date.
+        midnight is the POSIX time the day's times count from."""
+        self.schedule = schedule
+        self.service_date = service_date
+        self.start_date = service_date.strftime("%Y%m%d")
+        if midnight is None:
+            midnight = time.mktime(service_date.timetuple()[:3] +
+                                   (12, 0, 0, 0, 0, -1)) - 12 * 3600
+        self.midnight = int(midnight)
+
+        self.timetable = timetable = schedule.timetable()
+        # plain arrays, since indexing them and bisecting them is much
+        # quicker than through NumPy one element at a time
+        self.offsets = _array(timetable.trip_offsets)
+        self.sequences = _array(timetable.sequences)
+        self.scheduled_arrivals = _array(timetable.arrivals)
+        self.scheduled_departures = _array(timetable.departures)
+        # trip index << 32 | stop_sequence of every stop time, in order, to
+        # find the stop times of a batch of updates with one search
+        self.keys = (timetable.trips.astype(np.int64) << 32) + \
+            timetable.sequences
+
+        n = len(timetable)
+        self.arrival_delays = array("i", [0]) * n
+        self.departure_delays = array("i", [0]) * n
+        self.skipped = array("b", [0]) * n
+        # the trips whose slices differ from the schedule, by trip index
+        self.updated = set()
+        # the trip each entity last updated, for deletions
+        self.entity_trips = {}
+
+        self.frequency_trips = set(
+            row[0] for row in schedule.engine.execute(
+                "SELECT DISTINCT trip_id FROM frequencies"))
+
+    def clear(self):
+        """Goes back to the schedule"""
+        n = len(self.timetable)
+        self.arrival_delays = array("i", [0]) * n
+        self.departure_delays = array("i", [0]) * n
+        self.skipped = array("b", [0]) * n
+        self.updated.clear()
+        self.entity_trips.clear()
+
+    def _fill(self, trip, arrival_delays, departure_delays, skipped):
+        (first, last) = (self.offsets[trip], self.offsets[trip + 1])
+        self.arrival_delays[first:last] = arrival_delays
+        self.departure_delays[first:last] = departure_delays
+        self.skipped[first:last] = skipped
+
+    def _reset(self, trip):
+        n = self.offsets[trip + 1] - self.offsets[trip]
+        zeros = array("i", [0]) * n
+        self._fill(trip, zeros, zeros, array("b", [0]) * n)
+        self.updated.discard(trip)
+
+    def apply(self, message):
+        """Applies a FeedMessage, or the byte string of one. Returns the
+        number of trip updates applied; those of other days, of unknown
+        trips and of frequency-based trips are passed over."""
+        if not isinstance(message, FeedMessage):
+            message = parse_feed(message)
+        if message.incrementality == FULL_DATASET:
+            self.clear()
+
+        # each update or deletion rewrites its trip's whole slice, so only
+        # the last one of each trip needs applying; None resets the trip
+        # the fields are unpacked and indexed rather than named, which is
+        # slower for namedtuples, since this runs once per entity
+        trip_index = self.timetable.trip_index
+        (entity_trips, frequency_trips, start_date) = (
+            self.entity_trips, self.frequency_trips, self.start_date)
+        latest = {}
+        count = 0
+        for (entity_id, is_deleted, update) in message.entities:
+            if is_deleted:
+                trip = entity_trips.pop(entity_id, None)
+                if trip is not None:
+                    latest[trip] = None
+                continue
+
+            # trip_id and start_date
+            trip = trip_index.get(update[0])
+            if trip is None or update[0] in frequency_trips or \
+               (update[3] or start_date) != start_date:
+                continue
+            latest[trip] = update
+            entity_trips[entity_id] = trip
+            count += 1
+
+        updates = []
+        for (trip, update) in latest.iteritems():
+            if update is None:
+                self._reset(trip)
+            elif update[4] == CANCELED:
+                n = self.offsets[trip + 1] - self.offsets[trip]
+                zeros = array("i", [0]) * n
+                self._fill(trip, zeros, zeros, array("b", [1]) * n)
+                self.updated.add(trip)
+            else:
+                updates.append((trip, update))
+        if updates:
+            updates.sort(key=itemgetter(0))
+            self._apply_trips(updates)
+        return count
+
+    def _find_stop(self, first, last, stop_id):
+        """The position of the first stop time at stop_id from first up to
+        last, or None"""
+        stop = self.timetable.stop_index.get(stop_id)
+        if stop is None:
+            return None
+        stops = self.timetable.stops
+        for i in range(first, last):
+            if stops[i] == stop:
+                return i
+        return None
+
+    def _positions(self, trips, stus, owner):
+        """The position of each stop time update's stop time, or -1 if it
+        has none, found by stop_sequence through one search over every
+        trip's stop times at once, or failing that by stop_id"""
+        timetable = self.timetable
+        sequences = np.array([stu[0] for stu in stus], dtype=float)
+        by_sequence = ~np.isnan(sequences)
+        keys = (trips[owner].astype(np.int64) << 32) + \
+            np.where(by_sequence, sequences, -1).astype(np.int64)
+        positions = np.searchsorted(self.keys, keys)
+        np.minimum(positions, len(self.keys) - 1, positions)
+        positions[~by_sequence | (self.keys[positions] != keys)] = -1
+
+        for j in np.flatnonzero(~by_sequence).tolist():
+            trip = trips[owner[j]]
+            i = self._find_stop(self.offsets[trip], self.offsets[trip + 1],
+                                stus[j][1])
+            if i is not None:
+                positions[j] = i
+        return positions
+
+    def _apply_trips(self, updates):
+        """Writes the delays of TripUpdates, given as (trip index, update)
+        pairs in trip order, into their slices all at once"""
+        trip_offsets = self.timetable.trip_offsets
+        trips = np.array([trip for (trip, update) in updates], dtype=np.intp)
+        # TripUpdate.delay and stop_time_updates
+        trip_delays = np.array([update[5] or 0 for (trip, update) in updates],
+                               dtype=float)
+        self.updated.update(trips.tolist())
+
+        # the rows of every updated trip, and which update each belongs to
+        (firsts, lengths) = (trip_offsets[trips],
+                             trip_offsets[trips + 1] - trip_offsets[trips])
+        starts = np.cumsum(lengths) - lengths
+        row_owner = np.repeat(np.arange(len(trips)), lengths)
+        rows = np.arange(len(row_owner)) + np.repeat(firsts - starts, lengths)
+
+        stus = [stu for (trip, update) in updates for stu in update[7]]
+        owner = np.repeat(np.arange(len(trips)),
+                          [len(update[7]) for (trip, update) in updates])
+        positions = self._positions(trips, stus, owner) if stus else owner
+
+        # the updates found, in trip order, keeping the first of any given
+        # for the same stop time
+        kept = np.flatnonzero(positions >= 0)
+        kept = kept[np.argsort(positions[kept], kind="mergesort")]
+        if len(kept):
+            kept = kept[np.r_[True, np.diff(positions[kept]) != 0]]
+        at = positions[kept]
+        owner = owner[kept]
+
+        arrival_delays = np.frombuffer(self.arrival_delays, np.intc)
+        departure_delays = np.frombuffer(self.departure_delays, np.intc)
+        skipped = np.frombuffer(self.skipped, np.int8)
+        skipped[rows] = 0
+        if not len(kept):
+            arrival_delays[rows] = trip_delays[row_owner]
+            departure_delays[rows] = trip_delays[row_owner]
+            return
+
+        (arrival, arrival_time, departure, departure_time,
+         relationship) = [np.array([stu[field] for stu in stus],
+                                   dtype=float)[kept]
+                          for field in range(2, 7)]
+        scheduled = (self.timetable.arrivals[at],
+                     self.timetable.departures[at])
+        for (delay, when, times) in ((arrival, arrival_time, scheduled[0]),
+                                     (departure, departure_time,
+                                      scheduled[1])):
+            counted = np.isnan(delay) & ~np.isnan(when) & (times != -1)
+            delay[counted] = when[counted] - self.midnight - times[counted]
+        no_data = relationship == NO_DATA
+        arrival[no_data] = departure[no_data] = 0
+
+        # the delay running on after each update is its departure delay,
+        # or else its arrival delay, or else the one running before it,
+        # starting from its trip's delay
+        j = np.arange(len(kept))
+        trip_start = np.maximum.accumulate(
+            np.where(np.r_[True, owner[1:] != owner[:-1]], j, 0))
+        own = np.where(np.isnan(departure), arrival, departure)
+        last = np.maximum.accumulate(np.where(np.isnan(own), -1, j))
+        running = np.where(last >= trip_start, own[np.maximum(last, 0)],
+                           trip_delays[owner])
+        before = np.where(j > trip_start, running[np.maximum(j - 1, 0)],
+                          trip_delays[owner])
+        arrival = np.where(np.isnan(arrival),
+                           np.where(np.isnan(departure), before, departure),
+                           arrival)
+        departure = np.where(np.isnan(departure), arrival, departure)
+
+        # every other stop time carries the delay running before it: that
+        # of the last update at or before it, if that's of the same trip
+        latest = np.zeros(len(rows), dtype=np.intp)
+        latest[at - firsts[owner] + starts[owner]] = j + 1
+        g = np.maximum.accumulate(latest) - 1
+        governed = (g >= 0) & (owner[np.maximum(g, 0)] == row_owner)
+        carried = np.where(governed, running[np.maximum(g, 0)],
+                           trip_delays[row_owner])
+        arrival_delays[rows] = carried
+        departure_delays[rows] = carried
+        arrival_delays[at] = arrival
+        departure_delays[at] = departure
+        skipped[at[(relationship == SKIPPED) & ~no_data]] = 1
+
+    def stop_times(self, trip_id):
+        """Returns (stop_sequences, predicted arrivals, predicted
+        departures, skipped) arrays for trip_id. Untimed stop times stay
+        -1."""
+        timetable = self.timetable
+        s = timetable.trip_slice(trip_id)
+        (arrivals, departures) = (timetable.arrivals[s],
+                                  timetable.departures[s])
+        arrival_delays = np.frombuffer(self.arrival_delays, np.intc)[s]
+        departure_delays = np.frombuffer(self.departure_delays, np.intc)[s]
+        return (timetable.sequences[s],
+                np.where(arrivals == -1, -1, arrivals + arrival_delays),
+                np.where(departures == -1, -1,
+                         departures + departure_delays),
+                np.frombuffer(self.skipped, np.int8)[s].astype(bool))
+
+    def _predicted(self, scheduled, delay):
+        if scheduled is None or scheduled == -1:
+            return scheduled
+        return scheduled + delay
+
+    def departures(self, stop_id, start, end):
+        """Lists the PredictedDepartures from stop_id with scheduled
+        departure times start <= departure_time < end, ordered by their
+        scheduled departure times, as Schedule.departures"""
+        trip_index = self.timetable.trip_index
+        out = []
+        for departure in self.schedule.departures(stop_id, self.service_date,
+                                                  start, end):
+            trip = trip_index.get(departure.trip_id)
+            if trip not in self.updated:
+                out.append(PredictedDeparture(*departure + (
+                    departure.arrival_time, departure.departure_time,
+                    False)))
+                continue
+            i = bisect_left(self.sequences, departure.stop_sequence,
+                            self.offsets[trip], self.offsets[trip + 1])
+            out.append(PredictedDeparture(*departure + (
+                self._predicted(departure.arrival_time,
+                                self.arrival_delays[i]),
+                self._predicted(departure.departure_time,
+                                self.departure_delays[i]),
+                bool(self.skipped[i]))))
+        return out
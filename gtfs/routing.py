@@ -0,0 +1,330 @@
+"""Journey planning over one service day of a compiled Schedule.
+
+Router implements RAPTOR (Delling, Pajor and Werneck, "Round-Based Public
+Transit Routing"). Trips running on the day are grouped into route
+patterns -- trips visiting the same sequence of stops, none overtaking
+another -- and each pattern keeps its departures and arrivals as one
+sorted column per stop, so that the earliest trip catchable from a stop
+is a bisection. Frequency-based trips are expanded into their individual
+runs, and untimed stop times are interpolated between the timed stop times
+around them.
+
+Footpaths between stops come from transfers.txt: rows with transfer_type 0
+to 2 between two different stops can be walked in min_transfer_time
+seconds (0 if blank), and a transfer_type 2 row from a stop to itself sets
+the minimum time needed to change vehicles there. Walks generated by
+gtfs.transfers are added between stops transfers.txt says nothing about.
+
+Times are seconds since midnight of the service day. Trips belonging to
+the previous service day that run past midnight are not included."""
+
+from bisect import bisect_left
+from collections import namedtuple
+
+from gtfs.frequencies import run_times
+from gtfs.timetable import interpolate
+
+INFINITY = float('inf')
+
+Leg = namedtuple("Leg", ["trip_id", "from_stop_id", "to_stop_id",
+                         "departure_time", "arrival_time"])
+
+
+class Router(object):
+
+    def __init__(self, schedule, service_date):
+        self.service_date = service_date
+        timetable = schedule.timetable()
+        self.stop_ids = timetable.stop_ids
+        self.stop_index = timetable.stop_index
+
+        self._build_patterns(schedule, timetable)
+        self._build_footpaths(schedule)
+
+    def _active_trips(self, schedule, timetable):
+        """Yields (trip_id, stops, arrivals, departures) for every trip, or
+        run of a frequency-based trip, active on the service day"""
+        active = set(schedule.service_for_date(self.service_date))
+        runs = {}
+        for (trip_id, start, end, headway) in schedule.engine.execute(
+                "SELECT trip_id, start_time, end_time, headway_secs "
+                "FROM frequencies"):
+            runs.setdefault(trip_id, []).extend(run_times(start, end,
+                                                          headway))
+
+        for (trip_id, service_id) in schedule.engine.execute(
+                "SELECT trip_id, service_id FROM trips"):
+            if service_id not in active or trip_id not in timetable.trip_index:
+                continue
+
+            (stops, arrivals, departures) = timetable.trip_stop_times(trip_id)
+            times = interpolate(arrivals.tolist(), departures.tolist())
+            if times is None or len(stops) < 2:
+                continue
+            (arrivals, departures) = times
+            stops = tuple(stops.tolist())
+
+            if trip_id not in runs:
+                yield (trip_id, stops, arrivals, departures)
+                continue
+
+            first = departures[0]
+            for run in runs[trip_id]:
+                shift = run - first
+                yield (trip_id, stops, [t + shift for t in arrivals],
+                       [t + shift for t in departures])
+
+    def _build_patterns(self, schedule, timetable):
+        by_stops = {}
+        for trip in self._active_trips(schedule, timetable):
+            by_stops.setdefault(trip[1], []).append(trip)
+
+        self.pattern_stops = []
+        self.pattern_trips = []
+        self.pattern_arrivals = []
+        self.pattern_departures = []
+        self.stop_patterns = [[] for i in range(len(self.stop_ids))]
+
+        for (stops, trips) in by_stops.items():
+            trips.sort(key=lambda trip: trip[3][0])
+
+            # split into FIFO patterns, so that every per-stop column of
+            # departures is sorted and can be bisected
+            patterns = []
+            for trip in trips:
+                for pattern in patterns:
+                    last = pattern[-1]
+                    if all(a <= b for (a, b) in zip(last[2], trip[2])) and \
+                       all(a <= b for (a, b) in zip(last[3], trip[3])):
+                        pattern.append(trip)
+                        break
+                else:
+                    patterns.append([trip])
+
+            for pattern in patterns:
+                p = len(self.pattern_stops)
+                self.pattern_stops.append(stops)
+                self.pattern_trips.append([trip[0] for trip in pattern])
+                self.pattern_arrivals.append(
+                    [[trip[2][i] for trip in pattern]
+                     for i in range(len(stops))])
+                self.pattern_departures.append(
+                    [[trip[3][i] for trip in pattern]
+                     for i in range(len(stops))])
+                for (i, stop) in enumerate(stops):
+                    self.stop_patterns[stop].append((p, i))
+
+    def _build_footpaths(self, schedule):
+        self.footpaths = [[] for i in range(len(self.stop_ids))]
+        self.change_times = [0] * len(self.stop_ids)
+        published = set()
+
+        for (from_stop_id, to_stop_id, transfer_type, min_transfer_time) in \
+                schedule.engine.execute("SELECT from_stop_id, to_stop_id, "
+                                        "transfer_type, min_transfer_time "
+                                        "FROM transfers"):
+            if from_stop_id not in self.stop_index or \
+               to_stop_id not in self.stop_index:
+                continue
+            duration = int(min_transfer_time) if min_transfer_time else 0
+            from_stop = self.stop_index[from_stop_id]
+            to_stop = self.stop_index[to_stop_id]
+            published.add((from_stop, to_stop))
+
+            if transfer_type == 3:
+                continue
+            elif from_stop == to_stop:
+                if transfer_type == 2:
+                    self.change_times[from_stop] = duration
+            else:
+                self.footpaths[from_stop].append((to_stop, duration))
+
+        if not schedule.engine.has_table("generated_transfers"):
+            return
+        for (from_stop_id, to_stop_id, duration) in \
+                schedule.engine.execute("SELECT from_stop_id, to_stop_id, "
+                                        "min_transfer_time "
+                                        "FROM generated_transfers"):
+            if from_stop_id not in self.stop_index or \
+               to_stop_id not in self.stop_index:
+                continue
+            from_stop = self.stop_index[from_stop_id]
+            to_stop = self.stop_index[to_stop_id]
+            if (from_stop, to_stop) not in published:
+                self.footpaths[from_stop].append((to_stop, duration))
+
+    def _stop_indexes(self, stop_ids):
+        if isinstance(stop_ids, basestring):
+            stop_ids = [stop_ids]
+        return [self.stop_index[stop_id] for stop_id in stop_ids]
+
+    def _run(self, sources, max_transfers, target=None):
+        """Runs RAPTOR rounds from sources, a dict of stop index to the
+        time it's reached"""
+        n = len(self.stop_ids)
+        max_rounds = max_transfers + 1
+
+        rounds = [[INFINITY] * n for k in range(max_rounds + 1)]
+        best = [INFINITY] * n
+        parents = [{} for k in range(max_rounds + 1)]
+
+        marked = set()
+        for (stop, time) in sources.items():
+            if time < rounds[0][stop]:
+                rounds[0][stop] = time
+                best[stop] = min(best[stop], time)
+                parents[0][stop] = None
+                marked.add(stop)
+        self._walk(marked, rounds[0], best, parents[0])
+
+        pattern_stops = self.pattern_stops
+        pattern_arrivals = self.pattern_arrivals
+        pattern_departures = self.pattern_departures
+        stop_patterns = self.stop_patterns
+        change_times = self.change_times
+
+        for k in range(1, max_rounds + 1):
+            if not marked:
+                break
+            previous = rounds[k - 1]
+            current = rounds[k]
+            parent = parents[k]
+
+            queue = {}
+            for stop in marked:
+                for (p, i) in stop_patterns[stop]:
+                    if i < queue.get(p, i + 1):
+                        queue[p] = i
+            marked = set()
+
+            for (p, start) in queue.items():
+                stops = pattern_stops[p]
+                arrivals = pattern_arrivals[p]
+                departures = pattern_departures[p]
+                trip = None
+                for i in range(start, len(stops)):
+                    stop = stops[i]
+                    if trip is not None:
+                        arrival = arrivals[i][trip]
+                        bound = best[stop]
+                        if target is not None and best[target] < bound:
+                            bound = best[target]
+                        if arrival < bound:
+                            current[stop] = arrival
+                            best[stop] = arrival
+                            parent[stop] = (p, trip, board, i)
+                            marked.add(stop)
+
+                    reached = previous[stop]
+                    if reached == INFINITY:
+                        continue
+                    if change_times[stop] and \
+                       len(parents[k - 1].get(stop) or ()) == 4:
+                        reached += change_times[stop]
+                    if trip is None or reached <= departures[i][trip]:
+                        t = bisect_left(departures[i], reached)
+                        if t < len(departures[i]) and (trip is None or
+                                                       t < trip):
+                            trip = t
+                            board = i
+
+            self._walk(marked, current, best, parent)
+
+        return (rounds, best, parents)
+
+    def _walk(self, marked, current, best, parent):
+        footpaths = self.footpaths
+        for stop in list(marked):
+            for (to_stop, duration) in footpaths[stop]:
+                arrival = current[stop] + duration
+                if arrival < best[to_stop]:
+                    current[to_stop] = arrival
+                    best[to_stop] = arrival
+                    parent[to_stop] = (stop, duration)
+                    marked.add(to_stop)
+
+    def arrival_times(self, origins, departure_time, max_transfers=4):
+        """Earliest arrival at every stop, leaving origins (a stop_id or a
+        list of them) at departure_time, as a list indexed like stop_ids.
+        Unreachable stops are INFINITY."""
+        sources = dict((stop, departure_time)
+                       for stop in self._stop_indexes(origins))
+        return self._run(sources, max_transfers)[1]
+
+    def earliest_arrival(self, origins, departure_time, max_transfers=4):
+        """Earliest arrival time at every reachable stop, as a dict of
+        stop_id to seconds since midnight"""
+        arrivals = self.arrival_times(origins, departure_time, max_transfers)
+        return dict((self.stop_ids[stop], time)
+                    for (stop, time) in enumerate(arrivals)
+                    if time != INFINITY)
+
+    def journey(self, origin, destination, departure_time, max_transfers=4):
+        """The list of Legs of an earliest-arrival journey from origin to
+        destination leaving at departure_time, or None if there is none.
+        Of the journeys arriving earliest, the one with fewest vehicle
+        legs is returned. Walking legs have trip_id None."""
+        target = self.stop_index[destination]
+        sources = dict((stop, departure_time)
+                       for stop in self._stop_indexes(origin))
+        (rounds, best, parents) = self._run(sources, max_transfers, target)
+        if best[target] == INFINITY:
+            return None
+
+        k = min(k for k in range(len(rounds))
+                if rounds[k][target] == best[target])
+        return self._legs(rounds, parents, k, target)
+
+    def _legs(self, rounds, parents, k, stop):
+        legs = []
+        while parents[k].get(stop) is not None:
+            step = parents[k][stop]
+            if len(step) == 2:
+                (from_stop, duration) = step
+                legs.append(Leg(None, self.stop_ids[from_stop],
+                                self.stop_ids[stop],
+                                rounds[k][from_stop], rounds[k][stop]))
+                stop = from_stop
+            else:
+                (p, trip, board, alight) = step
+                stops = self.pattern_stops[p]
+                legs.append(Leg(self.pattern_trips[p][trip],
+                                self.stop_ids[stops[board]],
+                                self.stop_ids[stop],
+                                self.pattern_departures[p][board][trip],
+                                self.pattern_arrivals[p][alight][trip]))
+                stop = stops[board]
+                k -= 1
+        legs.reverse()
+        return legs
+
+    def profile(self, origin, destination, start, end, max_transfers=4):
+        """Range query: the Pareto-optimal (departure_time, arrival_time)
+        pairs for travelling from origin to destination, departing between
+        start and end inclusive, ordered by departure_time.
+
+        Each departure from origin gets a RAPTOR run of its own. Runs
+        can't continue from the labels of a later departure's run, as
+        rRAPTOR's do, because their stops are pruned against the earliest
+        arrival over all rounds: a stop reached sooner with more transfers
+        later in the day would hide an arrival that leaves transfers to
+        spare."""
+        origins = self._stop_indexes(origin)
+        target = self.stop_index[destination]
+
+        departures = set()
+        for stop in origins:
+            for (p, i) in self.stop_patterns[stop]:
+                for time in self.pattern_departures[p][i]:
+                    if start <= time <= end:
+                        departures.add(time)
+
+        out = []
+        for time in sorted(departures, reverse=True):
+            arrival = self._run(dict((stop, time) for stop in origins),
+                                max_transfers, target)[1][target]
+            if arrival != INFINITY and (not out or arrival < out[-1][1]):
+                out.append((time, arrival))
+        out.reverse()
+        return out
+
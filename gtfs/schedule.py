@@ -1,21 +1,134 @@
+from collections import namedtuple
+from datetime import timedelta
+
 import sqlalchemy
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker, subqueryload_all
+from sqlalchemy.pool import StaticPool, QueuePool
+from sqlalchemy.sql import select, and_
 
 from gtfs.entity import *
+from gtfs.instrument import QueryStats
+from gtfs.types import TransitTime
+from gtfs.util import LRUCache
+
+NearbyStop = namedtuple("NearbyStop", ["stop_id", "distance"])
+
+Departure = namedtuple("Departure", ["trip_id", "route_id", "trip_headsign",
+                                     "stop_sequence", "arrival_time",
+                                     "departure_time"])
 
 
 class Schedule:
-    def __init__(self, db_filename, echo=False):
+    def __init__(self, db_filename, echo=False, readonly=False, pool_size=5,
+                 pragmas=None):
+        """Opens the schedule database db_filename. Each Schedule has its
+        own engine and sessions, so any number may be open at once.
+
+        Connections come from a pool of pool_size, and sessions are
+        per-thread, so one Schedule may be read from several threads. File
+        databases opened for writing are put in WAL mode, letting readers
+        run alongside each other and a writer; readonly leaves the journal
+        mode alone and sets query_only on every connection. pragmas is a
+        dict of further PRAGMAs to set on each connection, such as
+        {'synchronous': 'OFF'}.
+
+        A database compiled by an older version is brought up to date as
+        it's opened, unless readonly, by adding and filling in the columns
+        the loader now derives."""
         self.db_filename = db_filename
+        self.readonly = readonly
+
+        self.pragmas = []
+        if db_filename != ":memory:" and not readonly:
+            self.pragmas.append(("journal_mode", "WAL"))
+        self.pragmas.extend(sorted((pragmas or {}).items()))
+        if readonly:
+            self.pragmas.append(("query_only", "ON"))
+
+        if db_filename == ":memory:":
+            # every connection to :memory: is a new database, so share one
+            pool_args = dict(poolclass=StaticPool)
+        else:
+            pool_args = dict(poolclass=QueuePool, pool_size=pool_size)
 
         self.engine = sqlalchemy.create_engine(
-            'sqlite:///%s' % self.db_filename, echo=echo)
+            'sqlite:///%s' % self.db_filename, echo=echo,
+            connect_args={'check_same_thread': False}, **pool_args)
+        event.listen(self.engine, 'connect', self._set_pragmas)
+        self.query_stats = QueryStats(self.engine)
+
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+
+        self._timetable = None
+        self._stop_index = None
+        self._service_dates = LRUCache(1024)
+        self._has_service_dates = None
+
+        if not readonly:
+            self._add_derived_columns()
+
+    def _add_derived_columns(self):
+        """Adds the columns the loader derives to a database compiled
+        before they existed, and fills them in. A compressed database
+        keeps elapsed_time in timing_offsets, so there the stop_times view
+        is recreated with it. Returns True if any were missing."""
+        from gtfs.loader import build_trip_times
+        from gtfs.patterns import STOP_TIMES_VIEW, is_compressed
+
+        missing = []
+        for table in (Trip.__table__, StopTime.__table__):
+            if not self.engine.has_table(table.name):
+                continue
+            existing = set(row[1] for row in self.engine.execute(
+                "PRAGMA table_info(%s)" % table.name))
+            missing.extend(column for column in table.columns
+                           if column.info.get('derived') and
+                           column.name not in existing)
+        if not missing:
+            return False
 
-        Base.metadata.bind = self.engine
+        compressed = is_compressed(self)
+        for column in missing:
+            tablename = column.table.name
+            if compressed and column.table is StopTime.__table__:
+                tablename = TimingOffset.__tablename__
+            self.engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                tablename, column.name,
+                column.type.compile(dialect=self.engine.dialect)))
+        if compressed and any(column.table is StopTime.__table__
+                              for column in missing):
+            self.engine.execute("DROP VIEW stop_times")
+            self.engine.execute(STOP_TIMES_VIEW)
 
-        Session = scoped_session(sessionmaker())
-        Base.query = Session.query_property()
-        self.session = Session()
+        build_trip_times(self)
+        return True
+
+    def _set_pragmas(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for (name, value) in self.pragmas:
+            cursor.execute("PRAGMA %s = %s" % (name, value))
+        cursor.close()
+
+    @property
+    def session(self):
+        """The calling thread's session"""
+        return self.Session()
+
+    def stats(self):
+        """Returns a dict of the number of SQL statements the schedule has
+        run, the seconds they took, and a list of StatementStats for each
+        distinct statement, most often run first. See gtfs.instrument."""
+        return self.query_stats.snapshot()
+
+    def reset_stats(self):
+        self.query_stats.reset()
+
+    def capture_queries(self):
+        """A context manager yielding a gtfs.instrument.Capture of the
+        statements this thread runs inside the with block, for finding
+        N+1 query patterns"""
+        return self.query_stats.capture()
 
     @property
     def routes(self):
@@ -37,7 +150,80 @@ class Schedule:
     def trips(self):
         return self.session.query(Trip).all()
 
+    def find_trips(self, route_id=None, service_date=None,
+                   with_stop_times=False):
+        """Lists the trips of route_id, or of every route, running on
+        service_date, or on any date, ordered by direction_id and
+        first_departure.
+
+        with_stop_times loads each trip's stop_times, and their stops,
+        along with the trips, so the whole result can be walked in a fixed
+        number of queries rather than one or more per trip."""
+        q = self.session.query(Trip)
+        if route_id is not None:
+            q = q.filter(Trip.route_id == route_id)
+        if service_date is not None:
+            service_ids = self.service_for_date(service_date)
+            if not service_ids:
+                return []
+            q = q.filter(Trip.service_id.in_(service_ids))
+        if with_stop_times:
+            q = q.options(subqueryload_all('stop_times.stop'))
+        return q.order_by(Trip.direction_id, Trip.first_departure,
+                          Trip.trip_id).all()
+
+    def route_timetable(self, route_id, service_date):
+        """The trips of route_id running on service_date, with their
+        stop_times and stops loaded, for rendering a timetable: see
+        find_trips"""
+        return self.find_trips(route_id, service_date, with_stop_times=True)
+
     def service_for_date(self, service_date):
+        """Lists the service_ids running on service_date"""
+        # one locked lookup: another thread may evict the date between a
+        # membership test and a read
+        service_ids = self._service_dates.get(service_date)
+        if service_ids is None:
+            if self.has_service_dates():
+                service_ids = self.service_for_date_range(
+                    service_date, service_date)[service_date]
+            else:
+                service_ids = self._resolve_service_for_date(service_date)
+                self._service_dates[service_date] = service_ids
+        return list(service_ids)
+
+    def service_for_date_range(self, start_date, end_date):
+        """Returns a dict mapping each date from start_date to end_date
+        inclusive to the list of service_ids running that day"""
+        days = [start_date + timedelta(days=i)
+                for i in range((end_date - start_date).days + 1)]
+
+        if not self.has_service_dates():
+            return dict((day, self.service_for_date(day)) for day in days)
+
+        out = dict((day, []) for day in days)
+        table = ServiceDate.__table__
+        q = select([table.c.date, table.c.service_id],
+                   and_(table.c.date >= start_date, table.c.date <= end_date))
+        for (day, service_id) in self.engine.execute(q):
+            out[day].append(service_id)
+
+        for (day, service_ids) in out.items():
+            self._service_dates[day] = tuple(service_ids)
+        return out
+
+    def has_service_dates(self):
+        """True if the loader materialized the service_dates table for this
+        database. Older databases fall back to resolving each date from
+        calendar and calendar_dates."""
+        if self._has_service_dates is None:
+            self._has_service_dates = bool(
+                self.engine.has_table(ServiceDate.__tablename__) and
+                self.engine.execute(select([ServiceDate.__table__.c.date])
+                                    .limit(1)).fetchall())
+        return self._has_service_dates
+
+    def _resolve_service_for_date(self, service_date):
         q = self.session.query(ServiceException.service_id)
         q = q.filter_by(date=service_date, exception_type='1')
 
@@ -47,8 +233,153 @@ class Schedule:
             if period.active_on_date(service_date):
                 active_periods.append(period.service_id)
 
-        return active_periods
+        return tuple(active_periods)
+
+    def clear_caches(self):
+        """Forgets everything the Schedule has derived from the database,
+        for use after the database has been modified"""
+        self._timetable = None
+        self._stop_index = None
+        self._service_dates.clear()
+        self._has_service_dates = None
+
+    def departures(self, stop_id, service_date, start, end):
+        """Lists the Departures from stop_id on service_date with
+        start <= departure_time < end, ordered by departure_time.
+
+        start and end may be seconds since midnight, TransitTimes or
+        "HH:MM:SS" strings; the returned times are seconds since midnight.
+        Trips run by frequencies.txt are expanded into one Departure per
+        run within the window."""
+        from gtfs.frequencies import run_times
+
+        start = int(TransitTime(start)) if isinstance(start, basestring) \
+                else int(start)
+        end = int(TransitTime(end)) if isinstance(end, basestring) \
+              else int(end)
+        active = set(self.service_for_date(service_date))
+
+        conn = self.engine.connect()
+        try:
+            out = []
+
+            rows = conn.execute(
+                "SELECT st.trip_id, t.route_id, t.trip_headsign, "
+                "t.service_id, st.stop_sequence, st.arrival_time, "
+                "st.departure_time "
+                "FROM stop_times st JOIN trips t ON t.trip_id = st.trip_id "
+                "WHERE st.stop_id = ? "
+                "AND st.departure_time >= ? AND st.departure_time < ? "
+                "AND NOT EXISTS (SELECT 1 FROM frequencies f "
+                "                WHERE f.trip_id = st.trip_id)",
+                stop_id, start, end)
+            for (trip_id, route_id, headsign, service_id, sequence,
+                 arrival, departure) in rows:
+                if service_id in active:
+                    out.append(Departure(trip_id, route_id, headsign,
+                                         sequence, arrival, departure))
+
+            rows = conn.execute(
+                "SELECT st.trip_id, t.route_id, t.trip_headsign, "
+                "t.service_id, st.stop_sequence, st.arrival_time, "
+                "st.departure_time, f.start_time, f.end_time, "
+                "f.headway_secs, "
+                "(SELECT first.departure_time FROM stop_times first "
+                " WHERE first.trip_id = st.trip_id "
+                " ORDER BY first.stop_sequence LIMIT 1) "
+                "FROM stop_times st "
+                "JOIN trips t ON t.trip_id = st.trip_id "
+                "JOIN frequencies f ON f.trip_id = st.trip_id "
+                "WHERE st.stop_id = ? AND st.departure_time IS NOT NULL",
+                stop_id)
+            for (trip_id, route_id, headsign, service_id, sequence, arrival,
+                 departure, run_start, run_end, headway, first) in rows:
+                if service_id not in active or first is None:
+                    continue
+                arrival_offset = (arrival if arrival is not None
+                                  else departure) - first
+                departure_offset = departure - first
+
+                for run in run_times(run_start, run_end, headway,
+                                     start - departure_offset,
+                                     end - departure_offset):
+                    out.append(Departure(trip_id, route_id, headsign,
+                                         sequence, run + arrival_offset,
+                                         run + departure_offset))
+        finally:
+            conn.close()
+
+        out.sort(key=lambda departure: departure.departure_time)
+        return out
+
+    def stop_index(self):
+        """Returns the gtfs.spatial.StopIndex grid over the schedule's
+        stops, building it on first use"""
+        if self._stop_index is None:
+            from gtfs.spatial import StopIndex
+            self._stop_index = StopIndex.from_schedule(self)
+        return self._stop_index
+
+    def stops_near(self, lat, lon, radius_m):
+        """Lists the NearbyStops within radius_m metres of (lat, lon),
+        nearest first"""
+        index = self.stop_index()
+        return [NearbyStop(index.stop_ids[i], d)
+                for (d, i) in index.within(lat, lon, radius_m)]
+
+    def nearest_stops(self, lat, lon, k=1):
+        """Lists the k NearbyStops closest to (lat, lon), nearest first"""
+        index = self.stop_index()
+        return [NearbyStop(index.stop_ids[i], d)
+                for (d, i) in index.nearest(lat, lon, k)]
+
+    def shape(self, shape_id):
+        """Returns the points of shape_id as an (n, 2) NumPy array of lat,
+        lon, reading a single PackedShape row if the shapes were packed
+        when loaded. Raises KeyError for unknown shape_ids."""
+        from gtfs import shapes
+        import numpy as np
+
+        table = PackedShape.__table__
+        row = self.engine.execute(select([table.c.points],
+                                         table.c.shape_id == shape_id)).first()
+        if row is not None:
+            return shapes.unpack_points(row[0])
+
+        table = ShapePoint.__table__
+        rows = self.engine.execute(select([table.c.shape_pt_lat,
+                                           table.c.shape_pt_lon],
+                                          table.c.shape_id == shape_id,
+                                          order_by=table.c.shape_pt_sequence))
+        points = np.array(rows.fetchall(), dtype=np.float64)
+        if not len(points):
+            raise KeyError(shape_id)
+        return points
+
+    def timetable(self):
+        """Returns the schedule's stop times as a compact, array-backed
+        gtfs.timetable.Timetable. It's built on first use and kept for the
+        life of the Schedule. Requires NumPy."""
+        if self._timetable is None:
+            from gtfs.timetable import Timetable
+            self._timetable = Timetable.from_schedule(self)
+        return self._timetable
+
+    def export(self, filename, batch_size=10000):
+        """Writes the schedule out as a GTFS feed, to a zip archive if
+        filename ends in .zip or else to a folder, reading batch_size rows
+        at a time. Returns a dict of each file written to its number of
+        rows. See gtfs.export."""
+        from gtfs.export import export
+        return export(self, filename, batch_size)
+
+    def validate(self, jobs=4, examples=5):
+        """Checks the schedule for broken references, out of order stop
+        times and gaps in service, running up to jobs checks at once.
+        Returns a Report; see gtfs.validate."""
+        from gtfs.validate import validate
+        return validate(self, jobs, examples)
 
     def create_tables(self):
-        Base.metadata.create_all()
+        Base.metadata.create_all(bind=self.engine)
         self.session.commit()
@@ -0,0 +1,50 @@
+from optparse import OptionParser
+from datetime import datetime
+
+from gtfs.clip import clip
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y%m%d").date()
+
+
+def main():
+    usage = "usage: %prog [options] feed_filename output_filename"
+    parser = OptionParser(usage)
+    parser.add_option("-b", "--bbox", dest="bbox",
+                      help="keep trips touching the box MIN_LAT,MIN_LON,"
+                           "MAX_LAT,MAX_LON")
+    parser.add_option("-r", "--routes", dest="routes",
+                      help="keep trips of the comma-separated route_ids "
+                           "ROUTES")
+    parser.add_option("-s", "--start_date", dest="start_date",
+                      help="keep service from START_DATE, as YYYYMMDD")
+    parser.add_option("-e", "--end_date", dest="end_date",
+                      help="keep service up to END_DATE, as YYYYMMDD")
+
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("Feed and output filenames needed")
+
+    bbox = route_ids = start_date = end_date = None
+    try:
+        if options.bbox:
+            bbox = [float(value) for value in options.bbox.split(",")]
+            if len(bbox) != 4:
+                raise ValueError(options.bbox)
+        if options.start_date:
+            start_date = parse_date(options.start_date)
+        if options.end_date:
+            end_date = parse_date(options.end_date)
+    except ValueError, e:
+        parser.error(str(e))
+    if options.routes:
+        route_ids = options.routes.split(",")
+
+    counts = clip(args[0], args[1], bbox, route_ids, start_date, end_date)
+    for filename in sorted(counts):
+        print "%s: %d rows" % (filename, counts[filename])
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,95 @@
 from optparse import OptionParser
 import os
 
-from gtfs.loader import load
+from gtfs.loader import load, update
 from gtfs.schedule import Schedule
 
 
 def main():
-    usage = "usage: %prog [options] gtfs_filename"
+    usage = "usage: %prog [options] gtfs_filename\n" \
+            "       %prog --export feed_filename db_filename"
     parser = OptionParser(usage)
     parser.add_option("-o", "--output_filename", dest="output_filename")
+    parser.add_option("-b", "--bulk", dest="bulk", action="store_true",
+                      default=False,
+                      help="write rows in executemany batches instead of "
+                           "through the ORM session")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="convert feed files in JOBS worker processes")
+    parser.add_option("-p", "--pack", dest="pack", action="store_true",
+                      default=False,
+                      help="store each shape as one packed row")
+    parser.add_option("-t", "--shape_tolerance", dest="shape_tolerance",
+                      type="float",
+                      help="simplify packed shapes to within "
+                           "SHAPE_TOLERANCE metres")
+    parser.add_option("-c", "--compress", dest="compress",
+                      action="store_true", default=False,
+                      help="store stop_times as trip patterns")
+    parser.add_option("-f", "--format", dest="format", default="db",
+                      type="choice", choices=["db", "snapshot"],
+                      help="compile into a SQLite database (db) or a "
+                           "memory-mappable gtfs.snapshot file (snapshot) "
+                           "[default: %default]")
+    parser.add_option("-e", "--export", dest="export_filename",
+                      help="instead of compiling, write the compiled "
+                           "database out as a GTFS feed to EXPORT_FILENAME, "
+                           "a .zip or a folder")
+    parser.add_option("-u", "--update", dest="update", action="store_true",
+                      default=False,
+                      help="if the output database exists, only apply the "
+                           "changes in feed files that differ from when it "
+                           "was last compiled, with the same options")
+    parser.add_option("-w", "--walk_radius", dest="walk_radius",
+                      type="float",
+                      help="generate walking transfers between stops of "
+                           "different routes up to WALK_RADIUS metres "
+                           "apart")
+    parser.add_option("-v", "--validate", dest="validate",
+                      action="store_true", default=False,
+                      help="check the compiled database and report any "
+                           "problems found")
 
     options, args = parser.parse_args()
 
     if len(args) != 1:
         parser.error("No gtfs filename supplied")
 
+    if options.export_filename:
+        schedule = Schedule(args[0], readonly=True)
+        counts = schedule.export(options.export_filename)
+        for filename in sorted(counts):
+            print "%s: %d rows" % (filename, counts[filename])
+        return
+
     gtfs_filename = args[0]
 
     if options.output_filename:
         output_filename = options.output_filename
     else:
-        output_filename = os.path.splitext(gtfs_filename)[0] + ".db"
+        output_filename = os.path.splitext(gtfs_filename)[0] + "." + \
+                          options.format
+
+    if options.format == "snapshot":
+        # the database is only a step on the way
+        schedule = load(gtfs_filename, bulk=options.bulk, jobs=options.jobs)
+        from gtfs import snapshot
+        snapshot.write(schedule, output_filename)
+        return
+
+    build = update if options.update else load
+    schedule = build(gtfs_filename, output_filename, bulk=options.bulk,
+                     jobs=options.jobs, pack=options.pack,
+                     shape_tolerance=options.shape_tolerance,
+                     compress=options.compress)
+
+    if options.walk_radius:
+        from gtfs import transfers
+        print "%d walking transfers" % transfers.generate(
+            schedule, options.walk_radius, jobs=options.jobs)
 
-    load(gtfs_filename, output_filename)
+    if options.validate:
+        print schedule.validate(jobs=max(options.jobs, 4))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,99 @@
+"""Packing of shapes into one compact blob per shape_id.
+
+A packed shape stores its vertices as little-endian int32 pairs of
+(latitude, longitude) in millionths of a degree, each pair holding the
+difference from the vertex before it, so that a whole shape is fetched as
+one row and decoded with a cumulative sum. shape_dist_traveled values, if
+present, are kept alongside as little-endian float64s, NaN where blank."""
+
+import sys
+from array import array
+from math import radians, cos, sqrt
+
+from gtfs.spatial import EARTH_RADIUS
+
+SCALE = 1000000
+
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+
+def pack_points(points):
+    """Encodes a sequence of (lat, lon) pairs"""
+    out = array('i')
+    last_lat = last_lon = 0
+    for (lat, lon) in points:
+        lat = int(round(lat * SCALE))
+        lon = int(round(lon * SCALE))
+        out.append(lat - last_lat)
+        out.append(lon - last_lon)
+        last_lat, last_lon = lat, lon
+    return _little_endian(out)
+
+
+def pack_distances(distances):
+    """Encodes a sequence of shape_dist_traveled values, or returns None if
+    they're all None"""
+    if all(d is None for d in distances):
+        return None
+    return _little_endian(array('d', [float('nan') if d is None else d
+                                      for d in distances]))
+
+
+def unpack_points(blob):
+    """Decodes packed points into an (n, 2) NumPy array of lat, lon"""
+    import numpy as np
+    deltas = np.frombuffer(blob, dtype='<i4').reshape(-1, 2)
+    return deltas.cumsum(axis=0, dtype=np.int64) / float(SCALE)
+
+
+def unpack_distances(blob):
+    import numpy as np
+    return np.frombuffer(blob, dtype='<f8')
+
+
+def simplify(points, tolerance):
+    """Douglas-Peucker simplification of a sequence of (lat, lon) pairs.
+
+    Returns the indexes of the points to keep, such that no dropped point
+    is further than tolerance metres from the simplified line. The first
+    and last points are always kept."""
+    n = len(points)
+    if n < 3:
+        return range(n)
+
+    scale_x = radians(1) * EARTH_RADIUS * cos(radians(points[0][0]))
+    scale_y = radians(1) * EARTH_RADIUS
+    xy = [(lon * scale_x, lat * scale_y) for (lat, lon) in points]
+
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        (first, last) = stack.pop()
+        (x1, y1) = xy[first]
+        (x2, y2) = xy[last]
+        dx, dy = x2 - x1, y2 - y1
+        length2 = dx * dx + dy * dy
+
+        worst, worst_distance = None, tolerance
+        for i in range(first + 1, last):
+            (x, y) = xy[i]
+            if length2 == 0:
+                d = sqrt((x - x1) ** 2 + (y - y1) ** 2)
+            else:
+                t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) /
+                                 length2))
+                d = sqrt((x - x1 - t * dx) ** 2 + (y - y1 - t * dy) ** 2)
+            if d > worst_distance:
+                worst, worst_distance = i, d
+
+        if worst is not None:
+            keep[worst] = True
+            stack.append((first, worst))
+            stack.append((worst, last))
+
+    return [i for i in range(n) if keep[i]]
@@ -0,0 +1,339 @@
+"""A read-only binary snapshot of a schedule, opened by memory mapping.
+
+A snapshot holds a schedule's stops, routes, trips, stop times and service
+calendar as fixed-width little-endian arrays, with strings kept in string
+tables. open() maps the file and points NumPy arrays straight at it, so
+opening takes milliseconds whatever the size of the feed, nothing is read
+until it's used, and processes forked after opening share the pages. Only
+NumPy is needed to read one; this module doesn't import SQLAlchemy.
+
+The file starts with a header
+
+  magic "GTFSSNAP", format version and section count, as <8sII
+
+followed by a directory entry per section
+
+  name, NumPy dtype, byte offset and element count, as <32s4sQQ
+
+and then the sections, each aligned to 8 bytes. A string table named t is
+the sections t.offsets (int64 byte offsets, one more than there are
+strings), t.data (the UTF-8 bytes) and t.order (int32 positions of the
+strings in byte order, for lookups by bisection).
+
+Stop times are stored as in gtfs.timetable.Timetable: sorted by trip and
+stop_sequence, with the stop times of trip i at trips.stop_times[i] to
+trips.stop_times[i + 1], and an index of each stop's stop times ordered by
+departure. Times are seconds since midnight, -1 where blank."""
+
+import __builtin__
+from collections import namedtuple
+from datetime import date
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = "GTFSSNAP"
+VERSION = 1
+
+HEADER = struct.Struct("<8sII")
+ENTRY = struct.Struct("<32s4sQQ")
+
+Stop = namedtuple("Stop", ["stop_id", "stop_name", "stop_lat", "stop_lon"])
+
+Route = namedtuple("Route", ["route_id", "route_short_name",
+                             "route_long_name", "route_type"])
+
+Trip = namedtuple("Trip", ["trip_id", "route_id", "service_id",
+                           "trip_headsign", "direction_id", "shape_id",
+                           "first_departure", "uses_frequency"])
+
+StopTime = namedtuple("StopTime", ["trip_id", "stop_id", "stop_sequence",
+                                   "arrival_time", "departure_time"])
+
+
+def _string_table(name, values):
+    encoded = [(value or u"").encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    data = np.frombuffer("".join(encoded), dtype=np.uint8) if offsets[-1] \
+           else np.zeros(0, dtype=np.uint8)
+    order = sorted(range(len(encoded)), key=encoded.__getitem__)
+    return [(name + ".offsets", offsets), (name + ".data", data),
+            (name + ".order", np.array(order, dtype="<i4"))]
+
+
+def _index(ids, values, default):
+    """Positions in ids of each of values, default where missing"""
+    index = dict((value, i) for (i, value) in enumerate(ids))
+    return np.array([index.get(value, default) for value in values],
+                    dtype="<i4")
+
+
+def write(schedule, filename):
+    """Writes a snapshot of schedule, a gtfs.schedule.Schedule, to
+    filename"""
+    timetable = schedule.timetable()
+    stop_ids = timetable.stop_ids
+    trip_ids = timetable.trip_ids
+    conn = schedule.engine.connect()
+    try:
+        stops = dict((row[0], row[1:]) for row in conn.execute(
+            "SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops"))
+        routes = conn.execute("SELECT route_id, route_short_name, "
+                              "route_long_name, route_type FROM routes "
+                              "ORDER BY route_id").fetchall()
+        trips = dict((row[0], row[1:]) for row in conn.execute(
+            "SELECT trip_id, route_id, service_id, trip_headsign, "
+            "direction_id, shape_id, first_departure, uses_frequency "
+            "FROM trips"))
+        service_ids = sorted(set(
+            [row[0] for row in conn.execute("SELECT service_id FROM calendar")] +
+            [row[0] for row in conn.execute("SELECT service_id FROM "
+                                            "calendar_dates")]))
+        bounds = conn.execute(
+            "SELECT min(d), max(d) FROM (SELECT start_date AS d FROM calendar "
+            "UNION ALL SELECT end_date FROM calendar "
+            "UNION ALL SELECT date FROM calendar_dates)").first()
+    finally:
+        conn.close()
+
+    stop_rows = [stops.get(stop_id, (None, None, None)) for stop_id in stop_ids]
+    trip_rows = [trips.get(trip_id, (None,) * 7) for trip_id in trip_ids]
+
+    dates = []
+    date_offsets = [0]
+    date_services = []
+    if bounds[0] is not None:
+        first, last = [date(*map(int, d.split("-"))) for d in bounds]
+        by_date = schedule.service_for_date_range(first, last)
+        service_index = dict((s, i) for (i, s) in enumerate(service_ids))
+        for day in sorted(by_date):
+            dates.append(day.toordinal())
+            date_services.extend(sorted(service_index[s]
+                                        for s in by_date[day]))
+            date_offsets.append(len(date_services))
+
+    def column(rows, i, dtype, blank):
+        return np.array([blank if row[i] is None else row[i] for row in rows],
+                        dtype=dtype)
+
+    sections = []
+    sections += _string_table("stops.id", stop_ids)
+    sections += _string_table("stops.name", [row[0] for row in stop_rows])
+    sections += [("stops.lat", column(stop_rows, 1, "<f8", np.nan)),
+                 ("stops.lon", column(stop_rows, 2, "<f8", np.nan)),
+                 ("stops.stop_times", timetable.stop_offsets.astype("<i8")),
+                 ("stops.events", timetable.stop_events.astype("<i4"))]
+
+    sections += _string_table("routes.id", [row[0] for row in routes])
+    sections += _string_table("routes.short_name", [row[1] for row in routes])
+    sections += _string_table("routes.long_name", [row[2] for row in routes])
+    sections += [("routes.type", column(routes, 3, "<i4", -1))]
+
+    sections += _string_table("services.id", service_ids)
+
+    sections += _string_table("trips.id", trip_ids)
+    sections += _string_table("trips.headsign", [row[2] for row in trip_rows])
+    sections += _string_table("trips.shape", [row[4] for row in trip_rows])
+    sections += [("trips.route", _index([row[0] for row in routes],
+                                        [row[0] for row in trip_rows], -1)),
+                 ("trips.service", _index(service_ids,
+                                          [row[1] for row in trip_rows], -1)),
+                 ("trips.direction", column(trip_rows, 3, "<i4", -1)),
+                 ("trips.first_departure", column(trip_rows, 5, "<i4", -1)),
+                 ("trips.uses_frequency", column(trip_rows, 6, "<u1", 0)),
+                 ("trips.stop_times", timetable.trip_offsets.astype("<i8"))]
+
+    sections += [("stop_times.stop", timetable.stops.astype("<i4")),
+                 ("stop_times.sequence", timetable.sequences.astype("<i4")),
+                 ("stop_times.arrival", timetable.arrivals.astype("<i4")),
+                 ("stop_times.departure", timetable.departures.astype("<i4"))]
+
+    sections += [("calendar.dates", np.array(dates, dtype="<i4")),
+                 ("calendar.services", np.array(date_offsets, dtype="<i8")),
+                 ("calendar.service", np.array(date_services, dtype="<i4"))]
+
+    _write_sections(filename, sections)
+
+
+def _write_sections(filename, sections):
+    offset = HEADER.size + ENTRY.size * len(sections)
+    entries = []
+    for (name, values) in sections:
+        offset += -offset % 8
+        entries.append(ENTRY.pack(name, values.dtype.str[1:], offset,
+                                  len(values)))
+        offset += values.nbytes
+
+    with __builtin__.open(filename, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, len(sections)))
+        for entry in entries:
+            fp.write(entry)
+        for (name, values) in sections:
+            fp.write("\0" * (-fp.tell() % 8))
+            fp.write(values.tostring())
+
+
+class StringTable(object):
+    """A sequence of the strings of one string table, decoded as they're
+    read"""
+
+    def __init__(self, snapshot, name):
+        self.offsets = snapshot.sections[name + ".offsets"]
+        self.data = snapshot.sections[name + ".data"]
+        self.order = snapshot.sections[name + ".order"]
+
+    def __len__(self):
+        return len(self.order)
+
+    def _bytes(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tostring()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._bytes(i).decode("utf-8")
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def get(self, i):
+        """The string at i, or None for blanks and for i == -1"""
+        return (self[i] or None) if i >= 0 else None
+
+    def index(self, value):
+        """Position of value, by bisection; raises KeyError if it's absent"""
+        key = value.encode("utf-8")
+        (lo, hi) = (0, len(self.order))
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self.order) or self._bytes(self.order[lo]) != key:
+            raise KeyError(value)
+        return int(self.order[lo])
+
+
+class Snapshot(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        with __builtin__.open(filename, "rb") as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, count) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a gtfs snapshot" % filename)
+        if version != VERSION:
+            raise ValueError("%s is snapshot format version %d, not %d" %
+                             (filename, version, VERSION))
+
+        # the arrays keep buf, and so the mapping, alive
+        self.sections = {}
+        for i in range(count):
+            (name, dtype, offset, length) = ENTRY.unpack_from(
+                buf, HEADER.size + i * ENTRY.size)
+            dtype = np.dtype("<" + dtype.rstrip("\0"))
+            if length:
+                values = np.frombuffer(buf, dtype, length, offset)
+            else:
+                values = np.zeros(0, dtype)
+            self.sections[name.rstrip("\0")] = values
+
+        s = self.sections
+        self.stop_ids = StringTable(self, "stops.id")
+        self.stop_names = StringTable(self, "stops.name")
+        self.stop_lats = s["stops.lat"]
+        self.stop_lons = s["stops.lon"]
+        self.route_ids = StringTable(self, "routes.id")
+        self.route_short_names = StringTable(self, "routes.short_name")
+        self.route_long_names = StringTable(self, "routes.long_name")
+        self.service_ids = StringTable(self, "services.id")
+        self.trip_ids = StringTable(self, "trips.id")
+        self.trip_headsigns = StringTable(self, "trips.headsign")
+        self.trip_shapes = StringTable(self, "trips.shape")
+        self.trip_routes = s["trips.route"]
+        self.trip_services = s["trips.service"]
+        self.trip_offsets = s["trips.stop_times"]
+        self.stops = s["stop_times.stop"]
+        self.sequences = s["stop_times.sequence"]
+        self.arrivals = s["stop_times.arrival"]
+        self.departures = s["stop_times.departure"]
+        self.stop_events = s["stops.events"]
+        self.stop_offsets = s["stops.stop_times"]
+
+    def stop(self, stop_id):
+        i = self.stop_ids.index(stop_id)
+        return Stop(stop_id, self.stop_names.get(i), float(self.stop_lats[i]),
+                    float(self.stop_lons[i]))
+
+    def route(self, route_id):
+        i = self.route_ids.index(route_id)
+        route_type = int(self.sections["routes.type"][i])
+        return Route(route_id, self.route_short_names.get(i),
+                     self.route_long_names.get(i),
+                     None if route_type == -1 else route_type)
+
+    def trip(self, trip_id):
+        i = self.trip_ids.index(trip_id)
+        s = self.sections
+        (direction, first) = (int(s["trips.direction"][i]),
+                              int(s["trips.first_departure"][i]))
+        return Trip(trip_id, self.route_ids.get(self.trip_routes[i]),
+                    self.service_ids.get(self.trip_services[i]),
+                    self.trip_headsigns.get(i),
+                    None if direction == -1 else direction,
+                    self.trip_shapes.get(i),
+                    None if first == -1 else first,
+                    bool(s["trips.uses_frequency"][i]))
+
+    def _stop_times(self, positions):
+        trips = np.searchsorted(self.trip_offsets, positions, side="right") - 1
+        return [StopTime(self.trip_ids[trip], self.stop_ids[stop],
+                         sequence, None if arrival == -1 else arrival,
+                         None if departure == -1 else departure)
+                for (trip, stop, sequence, arrival, departure) in
+                zip(trips.tolist(), self.stops[positions].tolist(),
+                    self.sequences[positions].tolist(),
+                    self.arrivals[positions].tolist(),
+                    self.departures[positions].tolist())]
+
+    def trip_stop_times(self, trip_id):
+        """The StopTimes of trip_id in stop_sequence order"""
+        i = self.trip_ids.index(trip_id)
+        return self._stop_times(np.arange(self.trip_offsets[i],
+                                          self.trip_offsets[i + 1]))
+
+    def stop_stop_times(self, stop_id):
+        """The StopTimes at stop_id ordered by departure, untimed first"""
+        i = self.stop_ids.index(stop_id)
+        return self._stop_times(
+            self.stop_events[self.stop_offsets[i]:self.stop_offsets[i + 1]])
+
+    def service_for_date(self, service_date):
+        """Lists the service_ids running on service_date"""
+        dates = self.sections["calendar.dates"]
+        offsets = self.sections["calendar.services"]
+        i = np.searchsorted(dates, service_date.toordinal())
+        if i == len(dates) or dates[i] != service_date.toordinal():
+            return []
+        return [self.service_ids[j] for j in
+                self.sections["calendar.service"][offsets[i]:offsets[i + 1]]]
+
+    def trips_for_date(self, service_date):
+        """Lists the trip_ids running on service_date"""
+        active = [self.service_ids.index(service_id)
+                  for service_id in self.service_for_date(service_date)]
+        return [self.trip_ids[i] for i in
+                np.flatnonzero(np.in1d(self.trip_services, active))]
+
+
+def open(filename):
+    """Maps the snapshot filename, returning a Snapshot"""
+    return Snapshot(filename)
@@ -0,0 +1,137 @@
+"""A dependency-free spatial index for stops.
+
+Stops are bucketed into a grid of cells a fixed number of metres on a side,
+using an equirectangular projection around the feed's mean latitude. Radius
+queries only look at the cells overlapping the query circle, and nearest
+neighbour queries search rings of cells outward from the query point until
+no closer stop can remain. Distances are great-circle distances in
+metres."""
+
+from math import radians, degrees, sin, cos, asin, sqrt, ceil, floor
+import heapq
+
+EARTH_RADIUS = 6371008.8
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Haversine distance in metres"""
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + \
+        cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+
+class StopIndex(object):
+
+    def __init__(self, stops, cell_size=500.0):
+        """stops is a sequence of (stop_id, lat, lon) tuples; cell_size is
+        the side of a grid cell in metres"""
+        self.stop_ids = []
+        self.lats = []
+        self.lons = []
+        for (stop_id, lat, lon) in stops:
+            self.stop_ids.append(stop_id)
+            self.lats.append(lat)
+            self.lons.append(lon)
+
+        self.cell_size = cell_size
+        mean_lat = sum(self.lats) / len(self.lats) if self.lats else 0.0
+        self.mean_cos = max(cos(radians(mean_lat)), 0.01)
+        self.lat_step = cell_size / (radians(1) * EARTH_RADIUS)
+        self.lon_step = self.lat_step / self.mean_cos
+
+        self.cells = {}
+        for (i, (lat, lon)) in enumerate(zip(self.lats, self.lons)):
+            self.cells.setdefault(self._cell(lat, lon), []).append(i)
+
+        if self.cells:
+            self.bounds = (min(y for (y, x) in self.cells),
+                           max(y for (y, x) in self.cells),
+                           min(x for (y, x) in self.cells),
+                           max(x for (y, x) in self.cells))
+
+    @classmethod
+    def from_schedule(cls, schedule, cell_size=500.0):
+        return cls(schedule.engine.execute("SELECT stop_id, stop_lat, stop_lon "
+                                           "FROM stops"), cell_size)
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def _cell(self, lat, lon):
+        return (int(floor(lat / self.lat_step)),
+                int(floor(lon / self.lon_step)))
+
+    def _cell_width(self, lat, radius):
+        """The narrowest side in metres of the cells within radius metres
+        of latitude lat. A degree of longitude is shortest at the poleward
+        edge of that band, and the shortest path to any stop within radius
+        stays inside it."""
+        edge = min(abs(lat) + degrees(radius / EARTH_RADIUS), 90.0)
+        return self.cell_size * min(1.0, max(cos(radians(edge)), 1e-9) /
+                                    self.mean_cos)
+
+    def _ring(self, center, r):
+        """The cells at Chebyshev distance r from center"""
+        (y, x) = center
+        if r == 0:
+            yield center
+            return
+        for dx in range(-r, r + 1):
+            yield (y - r, x + dx)
+            yield (y + r, x + dx)
+        for dy in range(-r + 1, r):
+            yield (y + dy, x - r)
+            yield (y + dy, x + r)
+
+    def within(self, lat, lon, radius):
+        """Indexes and distances of the stops within radius metres of
+        (lat, lon), as (distance, index) pairs ordered by distance"""
+        if not self.stop_ids:
+            return []
+        (y, x) = self._cell(lat, lon)
+        reach_y = int(ceil(radius / self.cell_size))
+        reach_x = int(ceil(radius / self._cell_width(lat, radius)))
+
+        # a huge radius mustn't walk the empty cells beyond the stops
+        (min_y, max_y, min_x, max_x) = self.bounds
+        out = []
+        lats = self.lats
+        lons = self.lons
+        for cy in range(max(y - reach_y, min_y), min(y + reach_y, max_y) + 1):
+            for cx in range(max(x - reach_x, min_x),
+                            min(x + reach_x, max_x) + 1):
+                for i in self.cells.get((cy, cx), ()):
+                    d = distance(lat, lon, lats[i], lons[i])
+                    if d <= radius:
+                        out.append((d, i))
+        out.sort()
+        return out
+
+    def nearest(self, lat, lon, k=1):
+        """The k stops nearest (lat, lon), as (distance, index) pairs
+        ordered by distance"""
+        if not self.stop_ids:
+            return []
+        center = self._cell(lat, lon)
+        k = min(k, len(self.stop_ids))
+
+        (min_y, max_y, min_x, max_x) = self.bounds
+        max_r = max(abs(center[0] - min_y), abs(center[0] - max_y),
+                    abs(center[1] - min_x), abs(center[1] - max_x))
+
+        found = []
+        for r in range(max_r + 1):
+            for cell in self._ring(center, r):
+                for i in self.cells.get(cell, ()):
+                    found.append((distance(lat, lon, self.lats[i],
+                                           self.lons[i]), i))
+            # every stop outside the searched square is more than r cell
+            # widths away, taking the narrowest cells within the distance
+            # of the kth stop, so once k stops are that close we're done
+            if len(found) >= k:
+                best = heapq.nsmallest(k, found)
+                d = best[-1][0]
+                if d <= r * self._cell_width(lat, d) * 0.99:
+                    return best
+        return heapq.nsmallest(k, found)
@@ -0,0 +1,134 @@
+"""A compact, array-backed copy of a schedule's stop times.
+
+Stop times are held in int32 arrays sorted by trip and stop_sequence, with
+CSR-style offsets so that the stop times of trip i are the slice
+trip_offsets[i]:trip_offsets[i + 1]. A second index, stop_events, lists the
+positions of every stop's stop times ordered by departure, again addressed
+through offsets. Stops and trips are referred to by their position in
+stop_ids and trip_ids. Untimed stop times have arrival and departure -1."""
+
+from array import array
+
+import numpy as np
+
+
+class Timetable(object):
+
+    def __init__(self, stop_ids, trip_ids, trips, stops, sequences, arrivals,
+                 departures):
+        self.stop_ids = stop_ids
+        self.trip_ids = trip_ids
+        self.stop_index = dict((stop_id, i) for (i, stop_id)
+                               in enumerate(stop_ids))
+        self.trip_index = dict((trip_id, i) for (i, trip_id)
+                               in enumerate(trip_ids))
+
+        order = np.lexsort((sequences, trips))
+        self.trips = trips[order]
+        self.stops = stops[order]
+        self.sequences = sequences[order]
+        self.arrivals = arrivals[order]
+        self.departures = departures[order]
+        self.trip_offsets = _offsets(self.trips, len(trip_ids))
+
+        self.stop_events = np.lexsort((self.departures,
+                                       self.stops)).astype(np.int32)
+        self.stop_offsets = _offsets(self.stops, len(stop_ids))
+
+    @classmethod
+    def from_schedule(cls, schedule, batch_size=100000):
+        """Reads every stop time of schedule into a Timetable with a single
+        pass over the stop_times table"""
+        conn = schedule.engine.connect()
+        try:
+            stop_ids = [r[0] for r in conn.execute("SELECT stop_id FROM stops")]
+            trip_ids = [r[0] for r in conn.execute("SELECT trip_id FROM trips")]
+            stop_index = dict((s, i) for (i, s) in enumerate(stop_ids))
+            trip_index = dict((t, i) for (i, t) in enumerate(trip_ids))
+
+            columns = [array('i') for i in range(5)]
+            result = conn.execute("SELECT trip_id, stop_id, stop_sequence, "
+                                  "arrival_time, departure_time "
+                                  "FROM stop_times")
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                for (trip_id, stop_id, sequence, arrival, departure) in rows:
+                    if trip_id not in trip_index:
+                        trip_index[trip_id] = len(trip_ids)
+                        trip_ids.append(trip_id)
+                    if stop_id not in stop_index:
+                        stop_index[stop_id] = len(stop_ids)
+                        stop_ids.append(stop_id)
+                    columns[0].append(trip_index[trip_id])
+                    columns[1].append(stop_index[stop_id])
+                    columns[2].append(sequence)
+                    columns[3].append(-1 if arrival is None else arrival)
+                    columns[4].append(-1 if departure is None else departure)
+        finally:
+            conn.close()
+
+        return cls(stop_ids, trip_ids, *[_to_numpy(c) for c in columns])
+
+    def __len__(self):
+        return len(self.stops)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.trips, self.stops, self.sequences,
+                                      self.arrivals, self.departures,
+                                      self.trip_offsets, self.stop_events,
+                                      self.stop_offsets))
+
+    def trip_slice(self, trip_id):
+        """The slice of the stop time arrays holding trip_id's stop times,
+        in stop_sequence order"""
+        i = self.trip_index[trip_id]
+        return slice(self.trip_offsets[i], self.trip_offsets[i + 1])
+
+    def trip_stop_times(self, trip_id):
+        """Returns (stop indexes, arrivals, departures) for trip_id"""
+        s = self.trip_slice(trip_id)
+        return self.stops[s], self.arrivals[s], self.departures[s]
+
+    def stop_time_indexes(self, stop_id):
+        """Positions in the stop time arrays of every stop time at
+        stop_id, ordered by departure"""
+        i = self.stop_index[stop_id]
+        return self.stop_events[self.stop_offsets[i]:self.stop_offsets[i + 1]]
+
+
+def interpolate(arrivals, departures):
+    """Fills in untimed (-1) stop times linearly between the timed stop
+    times around them. Returns None for trips whose first or last stop time
+    is untimed."""
+    arrivals = [d if a == -1 else a for (a, d) in zip(arrivals, departures)]
+    departures = [a if d == -1 else d for (a, d) in zip(arrivals, departures)]
+    if not arrivals or arrivals[0] == -1 or arrivals[-1] == -1:
+        return None
+
+    last = 0
+    for i in range(1, len(arrivals)):
+        if arrivals[i] == -1:
+            continue
+        for j in range(last + 1, i):
+            time = departures[last] + \
+                (arrivals[i] - departures[last]) * (j - last) // (i - last)
+            arrivals[j] = departures[j] = time
+        last = i
+    return arrivals, departures
+
+
+def _to_numpy(column):
+    if not len(column):
+        return np.zeros(0, dtype=np.int32)
+    return np.frombuffer(column, dtype=np.intc).astype(np.int32)
+
+
+def _offsets(keys, n):
+    """CSR offsets for an array of sorted keys in range(n)"""
+    offsets = np.zeros(n + 1, dtype=np.int32)
+    if n:
+        np.cumsum(np.bincount(keys, minlength=n), out=offsets[1:])
+    return offsets
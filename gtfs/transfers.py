@@ -0,0 +1,126 @@
+"""Walking transfers between nearby stops, for feeds that publish few or
+none in transfers.txt.
+
+generate() buckets the stops into a gtfs.spatial.StopIndex grid whose
+cells are as wide as the walking radius, so each stop is only compared
+with the stops of the cells around it and finding every pair within the
+radius takes time roughly linear in the number of stops. Cells are shared
+out among a pool of worker processes, and the pairs they find are
+written to the generated_transfers table in executemany batches, each
+with a min_transfer_time of its great-circle distance over the walking
+speed, rounded up to the second.
+
+By default a walk from one stop to another is only generated if the
+second is served by some route the first isn't, since changing between
+stops of the same routes gains nothing. The Router walks generated
+transfers wherever transfers.txt has no row for the same two stops.
+
+The table isn't touched by update(), so generate() again after a feed's
+stops or routes change."""
+
+from math import ceil
+import multiprocessing
+
+from gtfs.entity import GeneratedTransfer
+from gtfs.spatial import StopIndex
+
+WALK_SPEED = 1.2
+
+# set before the pool forks, so the workers inherit them
+_index = None
+_routes = None
+_options = None
+
+
+def _served_routes(schedule):
+    """Returns {stop_id: frozenset of the route_ids serving it}"""
+    routes = {}
+    for (stop_id, route_id) in schedule.engine.execute(
+            "SELECT DISTINCT st.stop_id, t.route_id FROM stop_times st "
+            "JOIN trips t ON t.trip_id = st.trip_id"):
+        routes.setdefault(stop_id, set()).add(route_id)
+    return dict((stop_id, frozenset(route_ids))
+                for (stop_id, route_ids) in routes.items())
+
+
+def _walks(cells):
+    """Pool worker: the walks from the stops in cells, as
+    (from_stop_id, to_stop_id, distance, min_transfer_time) tuples"""
+    (radius, walk_speed, all_stops) = _options
+    stop_ids = _index.stop_ids
+    out = []
+    for cell in cells:
+        for i in _index.cells[cell]:
+            for (d, j) in _index.within(_index.lats[i], _index.lons[i],
+                                        radius):
+                # each pair is found from both ends; keep it once
+                if j <= i:
+                    continue
+                (a, b) = (stop_ids[i], stop_ids[j])
+                seconds = int(ceil(d / walk_speed))
+                if all_stops or _routes[b] - _routes[a]:
+                    out.append((a, b, d, seconds))
+                if all_stops or _routes[a] - _routes[b]:
+                    out.append((b, a, d, seconds))
+    return out
+
+
+def _chunks(items, n):
+    size = max(1, int(ceil(len(items) / float(n))))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def generate(schedule, radius=400.0, walk_speed=WALK_SPEED, jobs=1,
+             all_stops=False, batch_size=50000):
+    """Replaces the contents of generated_transfers with a walk between
+    every two stops within radius metres of each other, at walk_speed
+    metres per second, in jobs worker processes. Only stops with stop
+    times are paired, unless all_stops is true, in which case every pair
+    of stops is. Returns the number of transfers written."""
+    global _index, _routes, _options
+
+    _routes = _served_routes(schedule)
+    stops = [(stop_id, lat, lon) for (stop_id, lat, lon) in
+             schedule.engine.execute("SELECT stop_id, stop_lat, stop_lon "
+                                     "FROM stops")
+             if all_stops or stop_id in _routes]
+    _index = StopIndex(stops, cell_size=radius)
+    _options = (radius, walk_speed, all_stops)
+
+    cells = sorted(_index.cells)
+    pool = None
+    try:
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            # several chunks a worker, to even out dense and sparse cells
+            results = pool.imap_unordered(_walks, _chunks(cells, jobs * 8))
+        else:
+            results = [_walks(cells)]
+
+        schedule.create_tables()
+        table = GeneratedTransfer.__table__
+        columns = [column.name for column in table.columns]
+        count = 0
+        conn = schedule.engine.connect()
+        trans = conn.begin()
+        try:
+            conn.execute(table.delete())
+            for walks in results:
+                for i in range(0, len(walks), batch_size):
+                    conn.execute(table.insert(),
+                                 [dict(zip(columns, walk))
+                                  for walk in walks[i:i + batch_size]])
+                count += len(walks)
+            trans.commit()
+        except:
+            trans.rollback()
+            raise
+        finally:
+            conn.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _index = _routes = _options = None
+
+    return count
@@ -1,4 +1,9 @@
 from csv import reader
+from collections import OrderedDict
+from threading import Lock
+
+def make_record(header,row):
+	return dict(zip(header,[unicode(x,"utf-8") for x in row]))
 
 class TolerantDictReader(object):
 	def __init__(self,stream):
@@ -10,4 +15,44 @@ class TolerantDictReader(object):
 		return self
 
 	def next(self):
-		return dict(zip(self.header,[unicode(x,"utf-8") for x in self.rd.next()]))
\ No newline at end of file
+		return make_record(self.header,self.rd.next())
+
+class LRUCache(object):
+	"""A dict-like cache holding at most maxsize items, evicting the least
+	recently used. Safe to share between threads."""
+	def __init__(self,maxsize=256):
+		self.maxsize = maxsize
+		self.items = OrderedDict()
+		self.lock = Lock()
+
+	def __contains__(self,key):
+		return key in self.items
+
+	def __len__(self):
+		return len(self.items)
+
+	def __getitem__(self,key):
+		with self.lock:
+			value = self.items.pop(key)
+			self.items[key] = value
+			return value
+
+	def get(self,key,default=None):
+		"""The value for key, or default if it isn't cached"""
+		with self.lock:
+			if key not in self.items:
+				return default
+			value = self.items.pop(key)
+			self.items[key] = value
+			return value
+
+	def __setitem__(self,key,value):
+		with self.lock:
+			self.items.pop(key,None)
+			self.items[key] = value
+			if len(self.items) > self.maxsize:
+				self.items.popitem(last=False)
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
@@ -0,0 +1,241 @@
+"""Validation of a compiled schedule.
+
+Rather than checking objects one at a time, each check is a single
+set-based SQL query over the compiled tables, run once, so that SQLite
+does the work in one pass over each table and its indexes. The checks run
+in parallel, each on its own pooled connection, and their results are
+gathered into a Report of Problems: what was checked, how many rows fail
+it, and a few of them as examples.
+
+Errors make a feed unusable or wrong; warnings are suspicious but legal.
+The ordering of stop times is checked with window functions, which need
+SQLite 3.25 or later."""
+
+from collections import namedtuple
+from datetime import date, timedelta
+from multiprocessing.pool import ThreadPool
+import time
+
+ERROR = "error"
+WARNING = "warning"
+
+Problem = namedtuple("Problem", ["check", "severity", "message", "count",
+                                 "examples"])
+
+
+def _foreign_key(table, column, parent, parent_column, keys):
+    return ("%s.%s" % (table, column), ERROR,
+            "%s whose %s is not in %s" % (table, column, parent),
+            "SELECT %s FROM %s c WHERE c.%s IS NOT NULL AND NOT EXISTS "
+            "(SELECT 1 FROM %s p WHERE p.%s = c.%s)" % (
+                keys, table, column, parent, parent_column, column))
+
+
+# (check, severity, message, query selecting the offending rows)
+SQL_CHECKS = [
+    # a feed with one agency needn't name it in routes.txt
+    ("routes.agency_id", ERROR, "routes whose agency_id is not in agency",
+     "SELECT route_id, agency_id FROM routes r WHERE NOT EXISTS "
+     "(SELECT 1 FROM agency a WHERE a.agency_id = r.agency_id) "
+     "AND NOT (r.agency_id = '__DEFAULT__' "
+     "         AND (SELECT count(*) FROM agency) = 1)"),
+    _foreign_key("trips", "route_id", "routes", "route_id", "trip_id"),
+    _foreign_key("stop_times", "trip_id", "trips", "trip_id",
+                 "trip_id, stop_sequence"),
+    _foreign_key("stop_times", "stop_id", "stops", "stop_id",
+                 "trip_id, stop_sequence"),
+    _foreign_key("frequencies", "trip_id", "trips", "trip_id", "trip_id"),
+    _foreign_key("transfers", "from_stop_id", "stops", "stop_id",
+                 "from_stop_id, to_stop_id"),
+    _foreign_key("transfers", "to_stop_id", "stops", "stop_id",
+                 "from_stop_id, to_stop_id"),
+    _foreign_key("fare_rules", "fare_id", "fare_attributes", "fare_id",
+                 "fare_id, route_id"),
+    _foreign_key("fare_rules", "route_id", "routes", "route_id",
+                 "fare_id, route_id"),
+    ("trips.service_id", ERROR,
+     "trips whose service_id is in neither calendar nor calendar_dates",
+     "SELECT trip_id, service_id FROM trips t WHERE NOT EXISTS "
+     "(SELECT 1 FROM calendar c WHERE c.service_id = t.service_id) "
+     "AND NOT EXISTS "
+     "(SELECT 1 FROM calendar_dates d WHERE d.service_id = t.service_id)"),
+    # a shape may be in either table, as points or packed
+    ("trips.shape_id", ERROR, "trips whose shape_id is not in shapes",
+     "SELECT trip_id, shape_id FROM trips t WHERE shape_id IS NOT NULL "
+     "AND NOT EXISTS (SELECT 1 FROM shapes s WHERE s.shape_id = t.shape_id) "
+     "AND NOT EXISTS "
+     "(SELECT 1 FROM packed_shapes p WHERE p.shape_id = t.shape_id)"),
+    ("trips.stop_times", ERROR, "trips with fewer than two stop times",
+     "SELECT trip_id FROM trips t WHERE (SELECT count(*) FROM stop_times st "
+     "                                   WHERE st.trip_id = t.trip_id) < 2"),
+    ("trips.untimed_ends", ERROR,
+     "trips whose first or last stop time has no times",
+     "SELECT e.trip_id, s.stop_sequence FROM "
+     "(SELECT trip_id, min(stop_sequence) AS first, "
+     "        max(stop_sequence) AS last "
+     " FROM stop_times GROUP BY trip_id) e "
+     "JOIN stop_times s ON s.trip_id = e.trip_id "
+     "AND s.stop_sequence IN (e.first, e.last) "
+     "WHERE s.arrival_time IS NULL AND s.departure_time IS NULL"),
+    ("stop_times.stop_sequence", ERROR,
+     "stop_sequences used more than once in a trip",
+     "SELECT trip_id, stop_sequence, count(*) FROM stop_times "
+     "GROUP BY trip_id, stop_sequence HAVING count(*) > 1"),
+    # each stop time against the latest time of those before it in its
+    # trip, so that untimed stop times in between are passed over
+    ("stop_times.time_order", ERROR,
+     "stop_times earlier than a stop time before them in their trip",
+     "SELECT trip_id, stop_sequence FROM "
+     "(SELECT trip_id, stop_sequence, "
+     "        coalesce(arrival_time, departure_time) AS time, "
+     "        max(coalesce(departure_time, arrival_time)) OVER ("
+     "          PARTITION BY trip_id ORDER BY stop_sequence "
+     "          ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) AS latest "
+     " FROM stop_times) "
+     "WHERE time < latest"),
+    ("stop_times.departure_time", ERROR,
+     "stop_times departing before they arrive",
+     "SELECT trip_id, stop_sequence, arrival_time, departure_time "
+     "FROM stop_times WHERE arrival_time > departure_time"),
+    ("calendar.end_date", ERROR, "service periods ending before they start",
+     "SELECT service_id, start_date, end_date FROM calendar "
+     "WHERE end_date < start_date"),
+    ("frequencies.headway_secs", ERROR,
+     "frequencies with no runs: end_time not after start_time, or a "
+     "headway that isn't positive",
+     "SELECT trip_id, start_time, end_time, headway_secs FROM frequencies "
+     "WHERE end_time <= start_time OR headway_secs <= 0"),
+    ("stops.location", ERROR, "stops with impossible coordinates",
+     "SELECT stop_id, stop_lat, stop_lon FROM stops "
+     "WHERE stop_lat NOT BETWEEN -90 AND 90 "
+     "OR stop_lon NOT BETWEEN -180 AND 180 "
+     "OR (stop_lat = 0 AND stop_lon = 0)"),
+    ("stops.unused", WARNING, "stops no trip stops at",
+     "SELECT stop_id FROM stops s WHERE coalesce(location_type, 0) = 0 "
+     "AND NOT EXISTS (SELECT 1 FROM stop_times st "
+     "                WHERE st.stop_id = s.stop_id)"),
+]
+
+SERVICE_CHECKS = [
+    ("trips.service_dates", WARNING, "service_ids of trips that never run",
+     "SELECT DISTINCT service_id FROM trips t WHERE NOT EXISTS "
+     "(SELECT 1 FROM service_dates d WHERE d.service_id = t.service_id)"),
+]
+
+
+def _sql_check(schedule, check, severity, message, query, examples):
+    # one pass, keeping the first rows as examples and counting the rest
+    conn = schedule.engine.connect()
+    try:
+        rows = []
+        count = 0
+        for row in conn.execute(query):
+            if count < examples:
+                rows.append(tuple(row))
+            count += 1
+    finally:
+        conn.close()
+    if not count:
+        return []
+    return [Problem(check, severity, message, count, rows)]
+
+
+def _coverage_check(schedule, examples):
+    """Dates within the span of the calendar on which nothing runs"""
+    conn = schedule.engine.connect()
+    try:
+        days = [row[0] for row in conn.execute(
+            "SELECT DISTINCT date FROM service_dates ORDER BY date")]
+    finally:
+        conn.close()
+
+    days = [date(*map(int, day.split("-"))) for day in days]
+    gaps = []
+    for (before, after) in zip(days, days[1:]):
+        day = before + timedelta(days=1)
+        while day < after:
+            gaps.append((day,))
+            day += timedelta(days=1)
+    if not gaps:
+        return []
+    return [Problem("service_dates.coverage", WARNING,
+                    "dates between the first and last day of service with "
+                    "no service", len(gaps), gaps[:examples])]
+
+
+class Report(object):
+
+    def __init__(self, problems, seconds):
+        self.problems = problems
+        self.seconds = seconds
+
+    @property
+    def errors(self):
+        return [p for p in self.problems if p.severity == ERROR]
+
+    @property
+    def warnings(self):
+        return [p for p in self.problems if p.severity == WARNING]
+
+    @property
+    def ok(self):
+        """True if there are no errors"""
+        return not self.errors
+
+    def to_dict(self):
+        """The report as a dict of JSON-friendly values"""
+        return {'ok': self.ok,
+                'seconds': self.seconds,
+                'problems': [dict(problem._asdict(),
+                                  examples=[[value if isinstance(
+                                      value, (int, long, float, basestring,
+                                              type(None))) else str(value)
+                                             for value in example]
+                                            for example in problem.examples])
+                             for problem in self.problems]}
+
+    def __str__(self):
+        if not self.problems:
+            return "no problems found"
+        return "\n".join("%s %s: %d %s, e.g. %s" % (
+            problem.severity.upper(), problem.check, problem.count,
+            problem.message, ", ".join(repr(example) for example
+                                       in problem.examples))
+            for problem in self.problems)
+
+
+def validate(schedule, jobs=4, examples=5):
+    """Checks schedule, returning a Report. Up to jobs checks run at once,
+    except on :memory: databases, whose one connection can't be shared;
+    each Problem keeps up to examples of its failing rows."""
+    start = time.time()
+
+    checks = [(_sql_check, (schedule,) + check + (examples,))
+              for check in SQL_CHECKS]
+    if schedule.has_service_dates():
+        checks += [(_sql_check, (schedule,) + check + (examples,))
+                   for check in SERVICE_CHECKS]
+        checks.append((_coverage_check, (schedule, examples)))
+
+    if schedule.db_filename == ":memory:":
+        jobs = 1
+
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(_run, checks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_run(check) for check in checks]
+
+    problems = [problem for result in results for problem in result]
+    problems.sort(key=lambda problem: (problem.severity != ERROR,
+                                       problem.check))
+    return Report(problems, time.time() - start)
+
+
+def _run(check):
+    (function, args) = check
+    return function(*args)
@@ -3,8 +3,13 @@ setup(
     name = "gtfs",
     version = "0.1.2",
     packages = find_packages(),
-    install_requires=['sqlalchemy>=0.6.3'],
+    install_requires=['sqlalchemy>=0.7'],
+    extras_require={'numpy': ['numpy'],
+                    'aio': ['trollius; python_version < "3"',
+                            'futures; python_version < "3"']},
     entry_points = {
-      "console_scripts": ["compile_gtfs = gtfs.scripts.compile_gtfs:main"]
+      "console_scripts": ["compile_gtfs = gtfs.scripts.compile_gtfs:main",
+                          "clip_gtfs = gtfs.scripts.clip_gtfs:main",
+                          "gtfs_bench = gtfs.bench.runner:main"]
     }
 )
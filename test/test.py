@@ -1,11 +1,33 @@
-from gtfs.loader import load
+from gtfs.loader import load, update
 from gtfs.schedule import Schedule
 from gtfs.types import TransitTime
 from gtfs.feed import Feed
+from gtfs.routing import Router
+from gtfs.frequencies import FrequencyExpander, run_times
+from gtfs.entity import Frequency
+from gtfs.bench import generate_feed
+from gtfs import snapshot, analytics, transfers
+from gtfs.spatial import StopIndex, distance
+from gtfs.clip import clip
+from gtfs.matrix import Matrix
+from gtfs import realtime
+import math
 import os
+import subprocess
+import sys
+import shutil
+import tempfile
+import threading
+import zipfile
+from datetime import date
 
 import unittest
 
+try:
+  from gtfs.aio import AsyncSchedule, asyncio
+except ImportError:
+  AsyncSchedule = None
+
 class TestDictReader(unittest.TestCase):
   def test_basic(self):
     curpath = os.path.dirname(os.path.realpath(__file__))
@@ -22,6 +44,44 @@ class TestDictReader(unittest.TestCase):
       u'stop_name': u'Mission St. & \u9280 Ave.', u'location_type': u''})
 
 
+class TestReadColumns(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feed = Feed( os.path.join(curpath,"data/sample-feed.zip") )
+
+  def test_stop_times( self ):
+    chunks = list( self.feed.read_columns( "stop_times.txt",
+                                           ["trip_id", "arrival_time", "stop_sequence"],
+                                           chunk_rows=6 ) )
+    self.assertEqual( [len(chunk["trip_id"]) for chunk in chunks], [6, 5] )
+    self.assertEqual( list(chunks[0]["trip_id"][:2]), [u'AWE1', u'AWE1'] )
+    self.assertEqual( list(chunks[0]["arrival_time"]), [370, -1, 380, -1, 405, 370] )
+    self.assertEqual( list(chunks[1]["stop_sequence"]), [2, 3, 4, 5, 6] )
+
+  def test_dates_and_floats( self ):
+    chunk = self.feed.read_columns( "calendar.txt", ["start_date", "monday"] ).next()
+    self.assertEqual( str(chunk["start_date"][0]), "2006-07-01" )
+    self.assertEqual( list(chunk["monday"]), [0, 1] )
+
+    chunk = self.feed.read_columns( "stops.txt", ["stop_lat", "missing"] ).next()
+    self.assertAlmostEqual( chunk["stop_lat"][0], 37.728631 )
+    self.assertEqual( list(chunk["missing"]), [u''] * 8 )
+
+  def test_parse_times( self ):
+    from gtfs.columns import parse_times
+    self.assertEqual( list(parse_times(["0:06:10", " 25:00:01", "", "100:00:00"])),
+                      [370, 90001, -1, 360000] )
+    self.assertRaises( ValueError, parse_times, ["12:60:00"] )
+    self.assertRaises( ValueError, parse_times, ["1200:00:00"] )
+
+  def test_parse_dates( self ):
+    from gtfs.columns import parse_dates
+    self.assertEqual( [str(date) for date in parse_dates(["20080229", "", "20101231"])],
+                      ["2008-02-29", "NaT", "2010-12-31"] )
+    for value in ["20100231", "20101301", "20090229", "20100100", "20100001"]:
+      self.assertRaises( ValueError, parse_dates, [value] )
+
+
 class TestSchedule(unittest.TestCase):
   def setUp(self):
     curpath = os.path.dirname(os.path.realpath(__file__))
@@ -63,6 +123,88 @@ class TestSchedule(unittest.TestCase):
     self.assertEqual( [(st.arrival_time.val,st.departure_time.val) for st in self.schedule.stops[0].stop_times],
       [(370, 370), (370, 370)] )
 
+  def test_timetable( self ):
+    timetable = self.schedule.timetable()
+    self.assertEqual( len(timetable), 11 )
+
+    stops, arrivals, departures = timetable.trip_stop_times( "AWE1" )
+    self.assertEqual( [timetable.stop_ids[i] for i in stops],
+                      [u'S1', u'S2', u'S3', u'S5', u'S6'] )
+    self.assertEqual( list(arrivals), [370, -1, 380, -1, 405] )
+    self.assertEqual( list(departures), [370, -1, 390, -1, 405] )
+
+    events = timetable.stop_time_indexes( "S3" )
+    self.assertEqual( list(timetable.departures[events]), [380, 390] )
+    self.assertEqual( sorted(timetable.trip_ids[i] for i in timetable.trips[events]),
+                      [u'AWD1', u'AWE1'] )
+    self.assertEqual( list(timetable.stop_time_indexes( "S8" )), [] )
+
+  def test_service_for_date( self ):
+    self.assertEqual( self.schedule.service_for_date( date(2006, 7, 1) ), [u'WE'] )
+    self.assertEqual( self.schedule.service_for_date( date(2006, 7, 3) ), [u'WE'] )
+    self.assertEqual( self.schedule.service_for_date( date(2006, 7, 5) ), [u'WD'] )
+    self.assertEqual( self.schedule.service_for_date( date(2006, 8, 1) ), [] )
+
+    from gtfs.util import LRUCache
+    self.schedule._service_dates = LRUCache( 1 )
+    for day in (date(2006, 7, 1), date(2006, 7, 5), date(2006, 7, 1)):
+      self.assertEqual( len( self.schedule.service_for_date( day ) ), 1 )
+    self.assertEqual( self.schedule._service_dates.get( date(2006, 7, 5) ), None )
+
+  def test_service_for_date_range( self ):
+    days = self.schedule.service_for_date_range( date(2006, 7, 2), date(2006, 7, 5) )
+    self.assertEqual( sorted(days.items()),
+                      [(date(2006, 7, 2), [u'WE']), (date(2006, 7, 3), [u'WE']),
+                       (date(2006, 7, 4), [u'WE']), (date(2006, 7, 5), [u'WD'])] )
+
+  def test_service_dates_match_calendar( self ):
+    schedule = self.schedule
+    for day in schedule.service_for_date_range( date(2006, 6, 25), date(2006, 8, 5) ):
+      self.assertEqual( sorted(schedule.service_for_date( day )),
+                        sorted(schedule._resolve_service_for_date( day )) )
+
+  def test_departures( self ):
+    departures = self.schedule.departures( "S3", date(2006, 7, 5), 0, "01:00:00" )
+    self.assertEqual( departures, [("AWD1", "A", "Downtown", 3, 380, 380)] )
+
+    departures = self.schedule.departures( "S3", date(2006, 7, 1),
+                                           "05:30:00", "05:45:00" )
+    self.assertEqual( [(d.trip_id, d.arrival_time, d.departure_time) for d in departures],
+                      [("AWE1", 19810, 19820), ("AWE1", 20110, 20120),
+                       ("AWE1", 20410, 20420)] )
+
+    self.assertEqual( self.schedule.departures( "S3", date(2006, 7, 1), 0, 1000 ), [] )
+    self.assertEqual( self.schedule.departures( "S3", date(2006, 8, 1), 0, 100000 ), [] )
+
+  def test_stops_near( self ):
+    near = self.schedule.stops_near( 37.75223, -122.418581, 100 )
+    self.assertEqual( [stop.stop_id for stop in near], [u'S3', u'S7', u'S8'] )
+    self.assertEqual( near[0].distance, 0 )
+    self.assertTrue( 10 < near[1].distance < 20 )
+
+    self.assertEqual( self.schedule.stops_near( 0, 0, 1000 ), [] )
+    # only the cells holding stops are searched, however far the radius reaches
+    self.assertEqual( len( self.schedule.stops_near( 0, 0, 20000000 ) ), 8 )
+
+  def test_nearest_stops( self ):
+    nearest = self.schedule.nearest_stops( 37.7295, -122.4313, 2 )
+    self.assertEqual( [stop.stop_id for stop in nearest], [u'S1', u'S2'] )
+
+    nearest = self.schedule.nearest_stops( 38.5, -122.4, 1 )
+    self.assertEqual( [stop.stop_id for stop in nearest], [u'S6'] )
+    self.assertEqual( len( self.schedule.nearest_stops( 37.7, -122.4, 20 ) ), 8 )
+
+  def test_high_latitude_index( self ):
+    # a degree of longitude shortens toward the pole, so stops just north
+    # of the query can be further across the grid than its own cells are
+    stops = [(None, 79.7 + i * 0.02, j * 0.04) for i in range( 31 ) for j in range( 801 )]
+    index = StopIndex( stops, cell_size=200000.0 )
+    for (lat, lon) in ((80.0, index.lon_step - 0.01), (80.0, 2 * index.lon_step - 0.01), (80.25, 15.0)):
+      brute = sorted( (distance( lat, lon, stop_lat, stop_lon ), i)
+                      for (i, (stop_id, stop_lat, stop_lon)) in enumerate( stops ) )
+      self.assertEqual( index.within( lat, lon, 200000.0 ), [pair for pair in brute if pair[0] <= 200000.0] )
+      self.assertEqual( index.nearest( lat, lon, 500 ), brute[:500] )
+
   def test_agencies( self ):
     self.assertEqual( [ag.agency_id for ag in self.schedule.agencies],
       [u'FunBus'] )
@@ -71,5 +213,1010 @@ class TestSchedule(unittest.TestCase):
     self.assertEqual( [rt.route_id for rt in self.schedule.agencies[0].routes],
       [] )
 
+class TestRouter(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.schedule = load( os.path.join(curpath,"data/sample-feed.zip") )
+
+  def test_earliest_arrival( self ):
+    router = Router( self.schedule, date(2006, 7, 5) )
+    arrivals = router.earliest_arrival( "S1", 300 )
+    self.assertEqual( arrivals["S6"], 405 )
+    self.assertEqual( arrivals["S7"], 705 )
+    self.assertEqual( arrivals["S3"], 380 )
+    self.assertTrue( "S8" not in arrivals )
+
+    self.assertEqual( router.earliest_arrival( "S1", 371 ), {u'S1': 371} )
+
+  def test_journey( self ):
+    router = Router( self.schedule, date(2006, 7, 5) )
+    self.assertEqual( router.journey( "S1", "S7", 300 ),
+                      [("AWD1", "S1", "S6", 370, 405),
+                       (None, "S6", "S7", 405, 705)] )
+    self.assertEqual( router.journey( "S6", "S1", 300 ), None )
+
+  def test_frequency_profile( self ):
+    router = Router( self.schedule, date(2006, 7, 1) )
+    self.assertEqual( router.earliest_arrival( "S1", 19805 )["S3"], 20110 )
+    self.assertEqual( router.profile( "S1", "S6", 19800, 20400 ),
+                      [(19800, 19835), (20100, 20135), (20400, 20435)] )
+
+  def test_profile_transfer_limit( self ):
+    # leaving O at 1005 reaches Y sooner than leaving at 900 does, but with
+    # one transfer more, so only the 900 departure can go on to D
+    tmpdir = tempfile.mkdtemp()
+    try:
+      stop_times = [("R1", "O", 1005, "X", 1100), ("R2", "X", 1110, "Y", 1150),
+                    ("R3", "O", 1005, "D", 2000), ("R4", "O", 900, "Y", 1160),
+                    ("R5", "Y", 1170, "D", 1200)]
+      hms = lambda t: "%d:%02d:%02d" % (t // 3600, t // 60 % 60, t % 60)
+      files = {"agency.txt": "agency_id,agency_name,agency_url,agency_timezone\n"
+                             "A,Agency,http://example.com,America/Los_Angeles\n",
+               "stops.txt": "stop_id,stop_name,stop_lat,stop_lon\n" +
+                            "".join( "%s,%s,37.%d,-122.4\n" % (stop, stop, i)
+                                     for (i, stop) in enumerate( "OXYD" ) ),
+               "calendar.txt": "service_id,monday,tuesday,wednesday,thursday,friday,"
+                               "saturday,sunday,start_date,end_date\n"
+                               "S,1,1,1,1,1,1,1,20060101,20061231\n",
+               "routes.txt": "route_id,agency_id,route_short_name,route_long_name,route_type\n" +
+                             "".join( "%s,A,%s,,3\n" % (row[0], row[0]) for row in stop_times ),
+               "trips.txt": "route_id,service_id,trip_id\n" +
+                            "".join( "%s,S,T%s\n" % (row[0], row[0]) for row in stop_times ),
+               "stop_times.txt": "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n" +
+                                 "".join( "T%s,%s,%s,%s,1\nT%s,%s,%s,%s,2\n" %
+                                          (route, hms( t0 ), hms( t0 ), s0,
+                                           route, hms( t1 ), hms( t1 ), s1)
+                                          for (route, s0, t0, s1, t1) in stop_times )}
+      for (filename, text) in files.items():
+        open( os.path.join( tmpdir, filename ), "w" ).write( text )
+
+      router = Router( load( tmpdir ), date(2006, 7, 5) )
+      self.assertEqual( router.earliest_arrival( "O", 900, max_transfers=1 )["D"], 1200 )
+      self.assertEqual( router.profile( "O", "D", 0, 3600, max_transfers=1 ),
+                        [(900, 1200), (1005, 2000)] )
+    finally:
+      shutil.rmtree( tmpdir )
+
+
+class TestFrequencyExpansion(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.schedule = load( os.path.join(curpath,"data/sample-feed.zip") )
+    self.expander = FrequencyExpander( self.schedule )
+
+  def test_expand( self ):
+    records = list( self.expander.expand( date(2006, 7, 1), 19800, 20100 ) )
+    self.assertEqual( [(r.trip_id, r.run_start, r.stop_id, r.departure_time)
+                       for r in records if r.stop_id in ("S1", "S3", "S6")],
+                      [("AWE1", 19800, "S1", 19800),
+                       ("AWE1", 19800, "S3", 19820),
+                       ("AWE1", 19800, "S6", 19835)] )
+    self.assertEqual( len(records), 5 )
+    self.assertFalse( records[0].exact_times )
+    self.assertEqual( records[0].headway_secs, 300 )
+    self.assertEqual( list( self.expander.expand( date(2006, 7, 5) ) ), [] )
+
+    # the sample's runs are all headway-based
+    self.assertEqual( list( self.expander.expand( date(2006, 7, 1), 19800, 20100, exact_times=True ) ), [] )
+    self.assertEqual( list( self.expander.expand( date(2006, 7, 1), 19800, 20100, exact_times=False ) ),
+                      records )
+    # a run passing through the window without stopping in it yields nothing
+    self.assertEqual( list( self.expander.chunks( date(2006, 7, 1), 19801, 19805 ) ), [] )
+
+  def test_arrays( self ):
+    arrays = self.expander.arrays( date(2006, 7, 1), 19810, 20110 )
+    self.assertEqual( sorted( arrays["departure_time"].tolist() )[-2:],
+                      [20100, 20105] )
+    self.assertEqual( set( arrays["run_start"].tolist() ), set([19800, 20100]) )
+
+    whole_day = self.expander.arrays( date(2006, 7, 1) )
+    runs = sum( len( frequency.trip_times )
+                for frequency in self.schedule.session.query( Frequency )
+                                     .filter_by( trip_id="AWE1" ) )
+    self.assertEqual( len( whole_day["stop"] ), runs * 5 )
+
+  def test_run_times( self ):
+    self.assertEqual( run_times( 100, 400, 100 ), [100, 200, 300] )
+    self.assertEqual( run_times( 100, 400, 100, 150, 300 ), [200] )
+    self.assertEqual( run_times( 100, 400, 100, -50, 1000 ), [100, 200, 300] )
+    self.assertEqual( run_times( 100, 400, 0 ), [] )
+
+    # departures() and the expander run the same arithmetic
+    expanded = [(r.trip_id, r.arrival_time, r.departure_time)
+                for r in self.expander.expand( date(2006, 7, 1), 19830, 21000 ) if r.stop_id == "S3"]
+    departures = self.schedule.departures( "S3", date(2006, 7, 1), 19830, 21000 )
+    self.assertEqual( [(d.trip_id, d.arrival_time, d.departure_time) for d in departures], expanded )
+    self.assertEqual( len( expanded ), 3 )
+
+
+class TestPackedShapes(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+
+  def test_packed_matches_points( self ):
+    points = load( self.feedpath ).shape( "A_shp" )
+    schedule = load( self.feedpath, pack=True )
+    self.assertEqual( schedule.engine.execute( "SELECT count(*) FROM shapes" ).scalar(), 0 )
+
+    packed = schedule.shape( "A_shp" )
+    self.assertEqual( packed.shape, (3, 2) )
+    self.assertTrue( abs(packed - points).max() < 1e-6 )
+    self.assertAlmostEqual( packed[1][0], 37.64430 )
+    self.assertRaises( KeyError, schedule.shape, "nope" )
+
+  def test_simplify( self ):
+    from gtfs.shapes import simplify
+    line = [(37.0, -122.0), (37.0001, -121.99), (37.0, -121.98), (37.05, -121.97)]
+    self.assertEqual( simplify( line, 50 ), [0, 2, 3] )
+    self.assertEqual( simplify( line, 5 ), [0, 1, 2, 3] )
+
+    schedule = load( self.feedpath, pack=True, shape_tolerance=10000 )
+    self.assertEqual( len( schedule.shape( "A_shp" ) ), 2 )
+
+  def test_ungrouped_shapes( self ):
+    from gtfs.loader import pack_shapes
+    tmpdir = tempfile.mkdtemp()
+    try:
+      zipfile.ZipFile( self.feedpath ).extractall( tmpdir )
+      # B_shp's points are interleaved with A_shp's, and out of order
+      open( os.path.join( tmpdir, "shapes.txt" ), "w" ).write(
+        "shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled\n"
+        "A_shp,37.61956,-122.48161,1,0\n"
+        "B_shp,37.70000,-122.40000,2,\n"
+        "A_shp,37.64430,-122.41070,2,6.8310\n"
+        "B_shp,37.60000,-122.30000,1,\n"
+        "A_shp,37.65863,-122.30839,3,15.8765\n"
+        "C_shp,37.50000,-122.20000,1,\n" )
+      schedule = load( tmpdir, pack=True )
+      self.assertEqual( len( schedule.shape( "A_shp" ) ), 3 )
+      self.assertAlmostEqual( schedule.shape( "B_shp" )[0][0], 37.6 )
+      self.assertEqual( len( schedule.shape( "C_shp" ) ), 1 )
+
+      schedule.engine.execute( "DELETE FROM packed_shapes" )
+      self.assertEqual( pack_shapes( schedule, Feed( tmpdir ), batch_size=2 ), 3 )
+      self.assertEqual( schedule.engine.execute( "SELECT count(*) FROM packed_shapes" ).scalar(), 3 )
+    finally:
+      shutil.rmtree( tmpdir )
+
+
+class TestCompressedStopTimes(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+    self.schedule = load( self.feedpath, bulk=True, compress=True )
+
+  def test_view_matches_table( self ):
+    query = ("SELECT trip_id, arrival_time, departure_time, stop_id, stop_sequence, "
+             "stop_headsign, pickup_type, drop_off_type, shape_dist_traveled "
+             "FROM stop_times ORDER BY trip_id, stop_sequence")
+    self.assertEqual( self.schedule.engine.execute( query ).fetchall(),
+                      load( self.feedpath ).engine.execute( query ).fetchall() )
+    self.assertEqual( self.schedule.engine.execute(
+      "SELECT count(*) FROM trip_patterns" ).scalar(), 2 )
+
+  def test_relationships( self ):
+    trip = [tr for tr in self.schedule.trips if tr.trip_id == "AWE1"][0]
+    self.assertEqual( [(st.stop_id, st.arrival_time) for st in trip.stop_times],
+                      [(u'S1', TransitTime(370)), (u'S2', None),
+                       (u'S3', TransitTime(380)), (u'S5', None),
+                       (u'S6', TransitTime(405))] )
+    self.assertEqual( trip.stop_times[4].elapsed_time, 35 )
+    self.assertEqual( [st.trip_id for st in self.schedule.stops[0].stop_times],
+                      [u'AWD1', u'AWE1'] )
+    self.assertEqual( len( self.schedule.timetable() ), 11 )
+
+  def test_departures_use_indexes( self ):
+    from gtfs.patterns import is_compressed
+    self.assertTrue( is_compressed( self.schedule ) )
+    self.assertFalse( is_compressed( load( self.feedpath ) ) )
+
+    # the stop's patterns and their trips are looked up, not scanned
+    plan = [row[3] for row in self.schedule.engine.execute(
+      "EXPLAIN QUERY PLAN SELECT trip_id FROM stop_times "
+      "WHERE stop_id = ? AND departure_time >= ? AND departure_time < ?", "S3", 0, 3600 )]
+    self.assertEqual( len( plan ), 3 )
+    self.assertTrue( all( step.startswith( "SEARCH" ) for step in plan ) )
+    self.assertTrue( "ix_pattern_stops_stop_id" in plan[0] )
+    self.assertEqual( [d.trip_id for d in self.schedule.departures( "S3", date(2006, 7, 5), 0, 3600 )],
+                      ["AWD1"] )
+
+
+class TestBulkLoad(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+
+  def test_matches_orm_load( self ):
+    orm = load( self.feedpath )
+    bulk = load( self.feedpath, bulk=True )
+
+    for table in ("agency", "routes", "stops", "trips", "stop_times",
+                  "calendar", "calendar_dates", "fare_attributes",
+                  "fare_rules", "shapes", "frequencies", "transfers"):
+      query = "SELECT * FROM %s" % table
+      self.assertEqual( bulk.engine.execute( query ).fetchall(),
+                        orm.engine.execute( query ).fetchall() )
+
+  def test_parallel_matches_orm_load( self ):
+    orm = load( self.feedpath )
+    parallel = load( self.feedpath, jobs=2 )
+
+    for table in ("stops", "trips", "stop_times", "calendar", "shapes"):
+      query = "SELECT * FROM %s" % table
+      self.assertEqual( parallel.engine.execute( query ).fetchall(),
+                        orm.engine.execute( query ).fetchall() )
+
+  def test_relationships( self ):
+    schedule = load( self.feedpath, bulk=True )
+    self.assertEqual( [(st.arrival_time, st.departure_time) for st in schedule.routes[0].trips[0].stop_times][:3],
+                      [(TransitTime(370), TransitTime(370)),
+                      (None, None),
+                      (TransitTime(380), TransitTime(390))] )
+    self.assertEqual( type( schedule.service_periods[0].monday ), bool )
+
+class TestExport(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_round_trip( self ):
+    original = load( self.feedpath )
+    exportpath = os.path.join( self.tmpdir, "export.zip" )
+    counts = original.export( exportpath )
+    self.assertEqual( counts["stop_times.txt"], 11 )
+    self.assertEqual( Feed( exportpath ).open( "calendar.txt" ).read().splitlines()[1],
+                      "WE,0,0,0,0,0,1,1,20060701,20060731" )
+
+    exported = load( exportpath )
+    for table in ("agency", "routes", "stops", "trips", "stop_times",
+                  "calendar", "calendar_dates", "fare_attributes",
+                  "fare_rules", "shapes", "frequencies", "transfers"):
+      query = "SELECT * FROM %s" % table
+      self.assertEqual( exported.engine.execute( query ).fetchall(),
+                        original.engine.execute( query ).fetchall() )
+
+  def test_compressed_and_packed( self ):
+    schedule = load( self.feedpath, bulk=True, pack=True, compress=True )
+    exportpath = os.path.join( self.tmpdir, "export" )
+    schedule.export( exportpath )
+
+    exported = load( exportpath, bulk=True )
+    query = "SELECT * FROM stop_times ORDER BY trip_id, stop_sequence"
+    self.assertEqual( [row[1:] for row in exported.engine.execute( query )],
+                      [row[1:] for row in load( self.feedpath ).engine.execute( query )] )
+    self.assertEqual( exported.shape( "A_shp" ).tolist(),
+                      schedule.shape( "A_shp" ).tolist() )
+
+
+class TestSyntheticFeed(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_generate_and_load( self ):
+    first = os.path.join( self.tmpdir, "first.zip" )
+    second = os.path.join( self.tmpdir, "second" )
+    counts = generate_feed( first, 3000, seed=1 )
+    generate_feed( second, 3000, seed=1 )
+    self.assertEqual( Feed( first ).open( "stop_times.txt" ).read(),
+                      Feed( second ).open( "stop_times.txt" ).read() )
+
+    schedule = load( first, bulk=True )
+    self.assertEqual( schedule.engine.execute(
+      "SELECT count(*) FROM stop_times" ).scalar(), counts["stop_times.txt"] )
+    self.assertTrue( 3000 <= counts["stop_times.txt"] < 3100 )
+    self.assertEqual( sorted( schedule.service_for_date( date(2024, 7, 4) ) ),
+                      ["SUN"] )
+    self.assertTrue( len( FrequencyExpander( schedule ).arrays(
+      date(2024, 7, 5), 6 * 3600, 7 * 3600 )["stop"] ) > 0 )
+
+
+class TestInstrumentation(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+
+  def test_load_progress( self ):
+    for options in ({}, {"bulk": True}, {"jobs": 2}):
+      tables = []
+      load( self.feedpath, progress=tables.append, **options )
+      stop_times = [stats for stats in tables if stats.tablename == "stop_times"][0]
+      self.assertEqual( stop_times.rows, 11 )
+      self.assertEqual( stop_times.bytes,
+                        len( Feed( self.feedpath ).open( "stop_times.txt" ).read() ) )
+      self.assertTrue( 0 <= stop_times.commit_seconds <= stop_times.seconds )
+      self.assertEqual( len( tables ), 12 )
+
+  def test_silent_load( self ):
+    from StringIO import StringIO
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+      for options in ({}, {"bulk": True, "pack": True, "compress": True}, {"jobs": 2}):
+        load( self.feedpath, progress=None, **options )
+      output = sys.stdout.getvalue()
+    finally:
+      sys.stdout = stdout
+    self.assertEqual( output, "" )
+
+  def test_query_stats( self ):
+    schedule = load( self.feedpath, progress=None )
+    schedule.reset_stats()
+    schedule.routes
+    schedule.routes
+    stats = schedule.stats()
+    self.assertEqual( stats["queries"], 2 )
+    self.assertEqual( stats["statements"][0].count, 2 )
+
+  def test_capture_n_plus_one( self ):
+    schedule = load( self.feedpath, progress=None )
+    with schedule.capture_queries() as capture:
+      stops = schedule.stops
+      for stop in stops:
+        stop.stop_times
+    self.assertEqual( len( capture ), len( stops ) + 1 )
+    repeated = capture.repeated()
+    self.assertEqual( len( repeated ), 1 )
+    self.assertEqual( repeated[0].count, len( stops ) )
+    self.assertTrue( "stop_times" in repeated[0].statement )
+
+    with schedule.capture_queries() as capture:
+      schedule.stops
+    self.assertEqual( capture.repeated(), [] )
+
+
+class TestBatchLoading(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.schedule = load( os.path.join(curpath,"data/sample-feed.zip") )
+
+  def test_derived_columns( self ):
+    trips = dict( (trip.trip_id, trip) for trip in self.schedule.trips )
+    self.assertEqual( trips["AWE1"].first_departure, TransitTime(370) )
+    self.assertTrue( trips["AWE1"].uses_frequency )
+    self.assertFalse( trips["AWD1"].uses_frequency )
+    self.assertEqual( [st.elapsed_time for st in trips["AWE1"].stop_times],
+                      [0, None, 10, None, 35] )
+
+  def test_old_database( self ):
+    from gtfs.patterns import STOP_TIMES_VIEW
+    from gtfs.entity import Trip
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    tmpdir = tempfile.mkdtemp()
+    try:
+      for compress in (False, True):
+        dbpath = os.path.join( tmpdir, "old%d.db" % compress )
+        old = load( os.path.join(curpath,"data/sample-feed.zip"), dbpath,
+                    compress=compress, progress=None )
+        # take the database back to before the derived columns
+        columns = ", ".join( column.name for column in Trip.__table__.columns
+                             if not column.info.get( "derived" ) )
+        statements = ["CREATE TABLE old_trips AS SELECT %s FROM trips" % columns,
+                      "DROP TABLE trips",
+                      "ALTER TABLE old_trips RENAME TO trips"]
+        if compress:
+          statements += ["DROP VIEW stop_times",
+                         "ALTER TABLE timing_offsets DROP COLUMN elapsed_time",
+                         STOP_TIMES_VIEW.replace( ",\n       o.elapsed_time AS elapsed_time", "" )]
+        else:
+          statements += ["ALTER TABLE stop_times DROP COLUMN elapsed_time"]
+        for statement in statements:
+          old.engine.execute( statement )
+        old.engine.dispose()
+
+        self.schedule = Schedule( dbpath )
+        self.assertFalse( self.schedule._add_derived_columns() )
+        self.test_derived_columns()
+        self.assertEqual( [trip.trip_id for trip in self.schedule.find_trips( "A" )],
+                          ["AWD1", "AWE1"] )
+        self.schedule.engine.dispose()
+    finally:
+      shutil.rmtree( tmpdir )
+
+  def test_route_timetable( self ):
+    trips = self.schedule.route_timetable( "A", date(2006, 7, 1) )
+    self.assertEqual( [trip.trip_id for trip in trips], ["AWE1"] )
+    self.assertEqual( self.schedule.route_timetable( "A", date(2006, 8, 1) ), [] )
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+      feedpath = os.path.join( tmpdir, "synthetic.zip" )
+      generate_feed( feedpath, 3000 )
+      schedule = load( feedpath, bulk=True, progress=None )
+    finally:
+      shutil.rmtree( tmpdir )
+
+    with schedule.capture_queries() as capture:
+      trips = schedule.route_timetable( "R0", date(2024, 7, 5) )
+      rows = [(trip.trip_id, trip.uses_frequency,
+               [(st.stop.stop_name, st.departure_time, st.elapsed_time)
+                for st in trip.stop_times]) for trip in trips]
+    self.assertTrue( len( trips ) > 50 )
+    # service_dates lookups, trips, stop_times and stops; none per trip
+    self.assertTrue( len( capture ) <= 6 )
+    self.assertEqual( capture.repeated(), [] )
+    self.assertEqual( [trip.first_departure.val for trip in trips if trip.direction_id == 0],
+                      sorted( trip.first_departure.val for trip in trips
+                              if trip.direction_id == 0 ) )
+
+    everything = schedule.find_trips( with_stop_times=True )
+    self.assertEqual( len( everything ), len( schedule.trips ) )
+
+
+class TestSnapshot(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.schedule = load( os.path.join(curpath,"data/sample-feed.zip"), progress=None )
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join( self.tmpdir, "sample.snapshot" )
+    snapshot.write( self.schedule, self.path )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_read( self ):
+    snap = snapshot.open( self.path )
+    stop = [st for st in self.schedule.stops if st.stop_id == "S7"][0]
+    self.assertEqual( snap.stop( "S7" ), ("S7", stop.stop_name, stop.stop_lat,
+                                          stop.stop_lon) )
+    self.assertEqual( snap.trip( "AWE1" ).route_id, "A" )
+    self.assertEqual( snap.trip( "AWE1" ).first_departure, 370 )
+    self.assertTrue( snap.trip( "AWE1" ).uses_frequency )
+    self.assertEqual( snap.route( "A" ).route_type, 3 )
+    self.assertRaises( KeyError, snap.trip, "nonexistent" )
+
+    self.assertEqual( [(st.stop_id, st.arrival_time, st.departure_time)
+                       for st in snap.trip_stop_times( "AWE1" )],
+                      [("S1", 370, 370), ("S2", None, None), ("S3", 380, 390),
+                       ("S5", None, None), ("S6", 405, 405)] )
+    self.assertEqual( [st.trip_id for st in snap.stop_stop_times( "S1" )],
+                      ["AWD1", "AWE1"] )
+
+    for day in (date(2006, 7, 1), date(2006, 7, 3), date(2006, 7, 5),
+                date(2006, 8, 1)):
+      self.assertEqual( sorted( snap.service_for_date( day ) ),
+                        sorted( self.schedule.service_for_date( day ) ) )
+    self.assertEqual( snap.trips_for_date( date(2006, 7, 5) ), ["AWD1"] )
+
+  def test_no_sqlalchemy( self ):
+    script = ("import sys, gtfs.snapshot; "
+              "snap = gtfs.snapshot.open(sys.argv[1]); snap.trip_stop_times('AWE1'); "
+              "sys.exit('sqlalchemy' in sys.modules)")
+    env = dict( os.environ )
+    env["PYTHONPATH"] = os.path.dirname( os.path.dirname( os.path.realpath(__file__) ) )
+    self.assertEqual( subprocess.call( [sys.executable, "-c", script, self.path],
+                                       env=env ), 0 )
+
+  def test_version_check( self ):
+    with open( self.path, "r+b" ) as fp:
+      fp.seek( 8 )
+      fp.write( "\x63\0\0\0" )
+    self.assertRaises( ValueError, snapshot.open, self.path )
+
+
+class TestConcurrentSchedules(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+    self.tmpdir = tempfile.mkdtemp()
+    self.dbpath = os.path.join( self.tmpdir, "sample.db" )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_two_schedules( self ):
+    first = load( self.feedpath )
+    second = load( self.feedpath, bulk=True, compress=True )
+    first.engine.execute( "DELETE FROM calendar_dates" )
+
+    for (schedule, removed) in ((first, False), (second, True)):
+      weekday = [sp for sp in schedule.service_periods if sp.service_id == "WD"][0]
+      self.assertTrue( weekday.active_on_date( date(2006, 7, 5) ) )
+      self.assertEqual( weekday.active_on_date( date(2006, 7, 4) ), not removed )
+
+  def test_threaded_reads( self ):
+    loaded = load( self.feedpath, self.dbpath, bulk=True )
+    self.assertEqual( loaded.engine.execute(
+      "PRAGMA journal_mode" ).scalar(), "wal" )
+    # switching to WAL writes to the database, so readonly opens don't
+    loaded.engine.execute( "PRAGMA journal_mode = DELETE" )
+    loaded.engine.dispose()
+
+    schedule = Schedule( self.dbpath, readonly=True )
+    self.assertEqual( schedule.engine.execute(
+      "PRAGMA journal_mode" ).scalar(), "delete" )
+    self.assertRaises( Exception, schedule.engine.execute,
+                       "DELETE FROM stops" )
+
+    expected = [(stop.stop_id, len( stop.stop_times )) for stop in schedule.stops]
+    results = []
+    def read():
+      for i in range( 20 ):
+        results.append( [(stop.stop_id, len( stop.stop_times ))
+                         for stop in schedule.stops] )
+        schedule.departures( "S1", date(2006, 7, 1), 0, 86400 )
+      schedule.Session.remove()
+    threads = [threading.Thread( target=read ) for i in range( 4 )]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual( results, [expected] * 80 )
+
+class TestUpdate(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.tmpdir = tempfile.mkdtemp()
+    self.feedpath = os.path.join( self.tmpdir, "feed" )
+    self.dbpath = os.path.join( self.tmpdir, "sample.db" )
+    zipfile.ZipFile( os.path.join(curpath,"data/sample-feed.zip") ).extractall( self.feedpath )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def edit( self, filename, old, new ):
+    path = os.path.join( self.feedpath, filename )
+    text = open( path ).read()
+    self.assertTrue( old in text )
+    open( path, "w" ).write( text.replace( old, new ) )
+
+  def rows( self, schedule, table ):
+    # the surrogate ids of rows differ between compiles
+    rows = [tuple( row ) for row in schedule.engine.execute( "SELECT * FROM %s" % table )]
+    if table in ("stop_times", "fare_rules", "frequencies", "transfers"):
+      rows = [row[1:] for row in rows]
+    return sorted( rows )
+
+  def test_update( self ):
+    load( self.feedpath, self.dbpath )
+
+    changes = []
+    update( self.feedpath, self.dbpath, progress=changes.append )
+    self.assertEqual( changes, [] )
+
+    self.edit( "stop_times.txt", "AWE1,0:06:20,0:06:30,S3,3", "AWE1,0:06:21,0:06:31,S3,3" )
+    self.edit( "stop_times.txt", "AWD1,,,S2,2,0,0,0\n", "" )
+    self.edit( "stop_times.txt", "AWE1,0:06:45,0:06:45,S6,5,0,0,0\n",
+               "AWE1,0:06:45,0:06:45,S6,5,0,0,0\nAWE1,0:06:50,0:06:50,S7,6,0,0,0\n" )
+    self.edit( "calendar_dates.txt", "WD,20060704,2", "WD,20060705,2" )
+    schedule = update( self.feedpath, self.dbpath, progress=changes.append )
+
+    self.assertEqual( [c[:4] for c in changes], [("stop_times", 1, 1, 1),
+                                                 ("calendar_dates", 1, 0, 1)] )
+    self.assertEqual( schedule.service_for_date( date(2006, 7, 5) ), [] )
+    self.assertEqual( schedule.service_for_date( date(2006, 7, 4) ), [u'WD', u'WE'] )
+
+    fresh = load( self.feedpath )
+    for table in ("stop_times", "trips", "calendar_dates", "service_dates",
+                  "fare_rules", "frequencies", "feed_files"):
+      self.assertEqual( self.rows( schedule, table ), self.rows( fresh, table ) )
+
+  def test_update_compressed( self ):
+    load( self.feedpath, self.dbpath, compress=True, progress=None )
+
+    # the view can't be updated, so the trip times are rebuilt through the
+    # pattern tables, whatever compress is given as
+    self.edit( "frequencies.txt", "AWE1,", "AWD1," )
+    changes = []
+    schedule = update( self.feedpath, self.dbpath, progress=changes.append )
+    self.assertEqual( [c[:4] for c in changes], [("frequencies", 3, 0, 3)] )
+    trips = dict( (trip.trip_id, trip) for trip in schedule.trips )
+    self.assertTrue( trips["AWD1"].uses_frequency )
+    self.assertFalse( trips["AWE1"].uses_frequency )
+
+    fresh = load( self.feedpath, compress=True, progress=None )
+    for table in ("stop_times", "trips", "timing_offsets", "feed_files"):
+      self.assertEqual( self.rows( schedule, table ), self.rows( fresh, table ) )
+
+    self.edit( "stop_times.txt", "AWE1,0:06:20,0:06:30,S3,3", "AWE1,0:06:21,0:06:31,S3,3" )
+    schedule = update( self.feedpath, self.dbpath, progress=None )
+    self.assertEqual( self.rows( schedule, "stop_times" ),
+                      self.rows( load( self.feedpath, progress=None ), "stop_times" ) )
+    changes = []
+    update( self.feedpath, self.dbpath, progress=changes.append )
+    self.assertEqual( changes, [] )
+
+@unittest.skipIf( AsyncSchedule is None, "needs asyncio, or trollius and futures" )
+class TestAsyncSchedule(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.tmpdir = tempfile.mkdtemp()
+    self.dbpath = os.path.join( self.tmpdir, "sample.db" )
+    load( os.path.join(curpath,"data/sample-feed.zip"), self.dbpath )
+    self.loop = asyncio.new_event_loop()
+    self.schedule = AsyncSchedule( self.dbpath, loop=self.loop )
+
+  def tearDown(self):
+    self.schedule.close()
+    self.loop.close()
+    shutil.rmtree( self.tmpdir )
+
+  def test_coalesced_lookups( self ):
+    futures = [self.schedule.departures( "S3", date(2006, 7, 5), 0, 3600 )
+               for i in range( 100 )]
+    self.assertEqual( len( self.schedule.in_flight ), 1 )
+    futures[0].cancel()
+
+    results = self.loop.run_until_complete( asyncio.gather( *futures[1:] ) )
+    self.assertEqual( results, [[("AWD1", "A", "Downtown", 3, 380, 380)]] * 99 )
+    self.assertEqual( self.schedule.in_flight, {} )
+    self.assertEqual( self.schedule.schedule.stats()["statements"][0].count, 1 )
+
+  def test_detached_entities( self ):
+    stop = self.loop.run_until_complete( self.schedule.stop( "S1" ) )
+    self.assertEqual( stop.stop_lat, 37.728631 )
+    stop_times = self.loop.run_until_complete( self.schedule.trip_stop_times( "AWE1" ) )
+    self.assertEqual( [st.stop.stop_id for st in stop_times],
+                      [u'S1', u'S2', u'S3', u'S5', u'S6'] )
+    self.assertEqual( self.loop.run_until_complete( self.schedule.stop( "nowhere" ) ), None )
+
+class TestAnalytics(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+    self.schedule = load( self.feedpath, summarize=True )
+
+  def test_day_types( self ):
+    # July 3rd and 4th run weekend service, so aren't typical weekdays
+    self.assertEqual( analytics.day_types( self.schedule ),
+                      {"weekday": date(2006, 7, 5), "saturday": date(2006, 7, 1),
+                       "sunday": date(2006, 7, 2)} )
+
+  def test_summaries( self ):
+    self.assertEqual( analytics.trips_per_hour( self.schedule, "A" ), {0: 1} )
+
+    saturday = analytics.trips_per_hour( self.schedule, "A", "saturday" )
+    self.assertEqual( (saturday[5], saturday[6], saturday[7]), (6, 16, 20) )
+    self.assertEqual( sum( saturday.values() ), 357 )
+
+    [service] = analytics.route_service( self.schedule, "saturday" )
+    self.assertEqual( (service.trips, service.first_departure.val, service.last_departure.val),
+                      (357, 19800, 100680) )
+    self.assertAlmostEqual( service.mean_headway, (100680 - 19800) / 356.0 )
+
+    stops = analytics.stop_service( self.schedule, "sunday" )
+    self.assertEqual( [(s.stop_id, s.departures, s.first_departure.val) for s in stops],
+                      [("S1", 357, 19800), ("S3", 357, 19820), ("S6", 357, 19835)] )
+    self.assertEqual( analytics.departures_per_hour( self.schedule, "S3" ), {0: 1} )
+
+  def test_rebuilt_when_feed_changes( self ):
+    self.assertFalse( analytics.refresh( self.schedule ) )
+    self.schedule.engine.execute( "UPDATE feed_files SET sha1 = '' "
+                                  "WHERE filename = 'calendar_dates.txt'" )
+    self.assertRaises( analytics.StaleSummaries, analytics.day_types, self.schedule )
+    self.assertTrue( analytics.refresh( self.schedule ) )
+    self.assertEqual( analytics.trips_per_hour( self.schedule, "A" ), {0: 1} )
+
+  def test_readonly( self ):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      dbpath = os.path.join( tmpdir, "sample.db" )
+      load( self.feedpath, dbpath, progress=None ).engine.dispose()
+      schedule = Schedule( dbpath, readonly=True )
+      # readers never write, so there's nothing to read until they're built
+      self.assertRaises( analytics.StaleSummaries, analytics.trips_per_hour, schedule, "A" )
+      self.assertRaises( analytics.StaleSummaries, analytics.refresh, schedule )
+      schedule.engine.dispose()
+
+      update( self.feedpath, dbpath, progress=None, summarize=True ).engine.dispose()
+      schedule = Schedule( dbpath, readonly=True )
+      self.assertEqual( analytics.trips_per_hour( schedule, "A" ), {0: 1} )
+      schedule.engine.dispose()
+
+      # once built, update() keeps them current
+      writable = Schedule( dbpath )
+      writable.engine.execute( "UPDATE feed_files SET sha1 = '' WHERE filename = 'trips.txt'" )
+      writable.engine.dispose()
+      update( self.feedpath, dbpath, progress=None ).engine.dispose()
+      schedule = Schedule( dbpath, readonly=True )
+      self.assertTrue( analytics.is_current( schedule ) )
+      schedule.engine.dispose()
+    finally:
+      shutil.rmtree( tmpdir )
+
+class TestValidate(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+    self.tmpdir = tempfile.mkdtemp()
+    self.dbpath = os.path.join( self.tmpdir, "sample.db" )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def checks( self, report ):
+    return dict( (problem.check, problem) for problem in report.problems )
+
+  def test_sample_feed( self ):
+    # the sample feed's fare rules and transfers refer to things it lacks
+    checks = self.checks( load( self.feedpath ).validate() )
+    self.assertEqual( sorted( checks ), ["fare_rules.fare_id",
+                                         "fare_rules.route_id",
+                                         "stops.unused",
+                                         "transfers.from_stop_id"] )
+    self.assertEqual( checks["fare_rules.fare_id"].count, 10 )
+    self.assertEqual( len( checks["fare_rules.fare_id"].examples ), 5 )
+    self.assertEqual( checks["stops.unused"].severity, "warning" )
+
+  def test_broken_feed( self ):
+    schedule = load( self.feedpath, self.dbpath )
+    for statement in ["UPDATE stop_times SET arrival_time = 1, departure_time = 1 "
+                      "WHERE trip_id = 'AWE1' AND stop_sequence = 3",
+                      "UPDATE stop_times SET arrival_time = NULL, departure_time = NULL "
+                      "WHERE trip_id = 'AWD1' AND stop_sequence = 1",
+                      "INSERT INTO stop_times (trip_id, stop_id, stop_sequence) "
+                      "VALUES ('AWE1', 'S1', 4)",
+                      "UPDATE trips SET route_id = 'X' WHERE trip_id = 'AWE1'",
+                      "UPDATE trips SET shape_id = 'A_shp' WHERE trip_id = 'AWD1'",
+                      "UPDATE trips SET shape_id = 'B_shp' WHERE trip_id = 'AWE1'",
+                      "DELETE FROM service_dates WHERE date = '2006-07-12'"]:
+      schedule.engine.execute( statement )
+    schedule.clear_caches()
+
+    report = schedule.validate( jobs=4 )
+    self.assertFalse( report.ok )
+    checks = self.checks( report )
+    self.assertEqual( checks["stop_times.time_order"].examples, [("AWE1", 3)] )
+    self.assertEqual( checks["trips.untimed_ends"].examples, [("AWD1", 1)] )
+    self.assertEqual( checks["stop_times.stop_sequence"].examples, [("AWE1", 4, 2)] )
+    self.assertEqual( checks["trips.route_id"].examples, [("AWE1",)] )
+    self.assertEqual( checks["trips.shape_id"].examples, [("AWE1", "B_shp")] )
+    self.assertEqual( checks["service_dates.coverage"].examples, [(date(2006, 7, 12),)] )
+    self.assertEqual( report.to_dict()["problems"][0]["severity"], "error" )
+
+
+class TestClip(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.feedpath = os.path.join(curpath,"data/sample-feed.zip")
+    self.tmpdir = tempfile.mkdtemp()
+    self.clippath = os.path.join( self.tmpdir, "clip.zip" )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_date_range( self ):
+    counts = clip( self.feedpath, self.clippath, start_date=date(2006, 7, 1),
+                   end_date=date(2006, 7, 2) )
+    self.assertEqual( counts["trips.txt"], 1 )
+    self.assertEqual( counts["calendar_dates.txt"], 0 )
+    self.assertEqual( Feed( self.clippath ).open( "calendar.txt" ).read().splitlines()[1],
+                      "WE,0,0,0,0,0,1,1,20060701,20060702" )
+
+    schedule = load( self.clippath )
+    self.assertEqual( [trip.trip_id for trip in schedule.trips], ["AWE1"] )
+    self.assertEqual( sorted( schedule.service_for_date( date(2006, 7, 1) ) ), ["WE"] )
+    self.assertEqual( schedule.service_for_date( date(2006, 7, 3) ), [] )
+
+  def test_bbox_and_routes( self ):
+    # only AWD1 stops at S4; it's kept whole, with the stops outside the box
+    counts = clip( self.feedpath, self.clippath, bbox=(37.757, -122.42, 37.758, -122.418) )
+    self.assertEqual( counts["trips.txt"], 1 )
+    self.assertEqual( counts["stop_times.txt"], 6 )
+    self.assertEqual( counts["stops.txt"], 6 )
+    self.assertEqual( counts["frequencies.txt"], 0 )
+    self.assertEqual( load( self.clippath ).validate().errors, [] )
+
+    counts = clip( self.feedpath, self.clippath, route_ids=["X"] )
+    self.assertEqual( counts["trips.txt"], 0 )
+    self.assertEqual( counts["agency.txt"], 0 )
+
+  def test_odd_files( self ):
+    feeddir = os.path.join( self.tmpdir, "feed" )
+    zipfile.ZipFile( self.feedpath ).extractall( feeddir )
+    notes = "not\x00csv,\n\"unbalanced\n"
+    for (filename, contents) in (("transfers.txt", ""), ("empty.txt", ""), ("notes.txt", notes)):
+      with open( os.path.join( feeddir, filename ), "wb" ) as fp:
+        fp.write( contents )
+
+    counts = clip( feeddir, self.clippath, route_ids=["A"] )
+    self.assertEqual( counts["transfers.txt"], 0 )
+    self.assertEqual( counts["notes.txt"], None )
+    out = Feed( self.clippath )
+    self.assertEqual( out.open( "transfers.txt" ).read(), "" )
+    self.assertEqual( out.open( "empty.txt" ).read(), "" )
+    self.assertEqual( out.open( "notes.txt" ).read(), notes )
+    self.assertEqual( counts["trips.txt"], 2 )
+
+
+class TestGeneratedTransfers(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def walks( self, schedule ):
+    return sorted( tuple( row ) for row in schedule.engine.execute(
+      "SELECT from_stop_id, to_stop_id, min_transfer_time FROM generated_transfers" ) )
+
+  def test_matches_brute_force( self ):
+    feedpath = os.path.join( self.tmpdir, "feed.zip" )
+    generate_feed( feedpath, 20000, seed=1 )
+    schedule = load( feedpath, bulk=True )
+
+    stops = dict( (stop_id, (lat, lon)) for (stop_id, lat, lon) in schedule.engine.execute(
+      "SELECT stop_id, stop_lat, stop_lon FROM stops" ) )
+    routes = {}
+    for (stop_id, route_id) in schedule.engine.execute(
+        "SELECT st.stop_id, t.route_id FROM stop_times st JOIN trips t ON t.trip_id = st.trip_id" ):
+      routes.setdefault( stop_id, set() ).add( route_id )
+    expected = []
+    for a in routes:
+      for b in routes:
+        d = distance( *(stops[a] + stops[b]) )
+        if a != b and d <= 1000 and routes[b] - routes[a]:
+          expected.append( (a, b, int( math.ceil( d / 1.2 ) )) )
+
+    # stops are about 400m apart, so pairs span several grid cells
+    self.assertEqual( transfers.generate( schedule, radius=1000 ), len( expected ) )
+    self.assertEqual( self.walks( schedule ), sorted( expected ) )
+    self.assertTrue( len( expected ) > 0 )
+
+    transfers.generate( schedule, radius=1000, jobs=2 )
+    self.assertEqual( self.walks( schedule ), sorted( expected ) )
+
+  def test_routing( self ):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    schedule = load( os.path.join(curpath,"data/sample-feed.zip") )
+    # every served stop is on route A, so nothing is gained by walking
+    self.assertEqual( transfers.generate( schedule ), 0 )
+
+    self.assertEqual( transfers.generate( schedule, all_stops=True ), 6 )
+    self.assertEqual( self.walks( schedule )[:2], [("S3", "S7", 10), ("S3", "S8", 10)] )
+    # the walk from S3 beats getting off at S6 and taking the published transfer
+    arrivals = Router( schedule, date(2006, 7, 5) ).earliest_arrival( "S1", 300 )
+    self.assertEqual( arrivals["S7"], 390 )
+
+
+class TestMatrix(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.schedule = load( os.path.join(curpath,"data/sample-feed.zip") )
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_array( self ):
+    matrix = Matrix( self.schedule, date(2006, 7, 5) )
+    origins = ["S1", "S3", "S6"]
+    destinations = ["S3", "S6", "S7", "S8"]
+    times = matrix.array( origins, destinations, [300, 360], jobs=2 )
+    self.assertEqual( times.shape, (2, 3, 4) )
+    self.assertEqual( times[0, 0].tolist(), [80, 105, 405, float('inf')] )
+
+    router = Router( self.schedule, date(2006, 7, 5) )
+    for (t, departure_time) in enumerate( [300, 360] ):
+      for (o, origin) in enumerate( origins ):
+        arrivals = router.earliest_arrival( origin, departure_time )
+        self.assertEqual( times[t, o].tolist(),
+                          [arrivals.get( stop_id, float('inf') ) - departure_time
+                           for stop_id in destinations] )
+    self.assertEqual( matrix.array( origins, destinations, [300, 360] ).tolist(),
+                      times.tolist() )
+
+  def test_zones_csv( self ):
+    csvpath = os.path.join( self.tmpdir, "matrix.csv" )
+    # a zone is reached when its first stop is, and left from all of them
+    count = Matrix( self.schedule, date(2006, 7, 5) ).write_csv(
+      csvpath, {"south": ["S1", "S2"]}, {"mission": ["S6", "S7"], "station": ["S8"]},
+      [300] )
+    self.assertEqual( count, 1 )
+    self.assertEqual( open( csvpath ).read().splitlines(),
+                      ["origin,destination,departure_time,travel_time",
+                       "south,mission,300,105"] )
+
+
+def pb_varint( value ):
+  if value < 0:
+    value += 1 << 64
+  out = bytearray()
+  while value >= 0x80:
+    out.append( (value & 0x7f) | 0x80 )
+    value >>= 7
+  out.append( value )
+  return str( out )
+
+def pb_field( number, value ):
+  """Encodes a protocol buffer field: a varint if value is a number, else
+  a string or message"""
+  if isinstance( value, (int, long) ):
+    return pb_varint( number << 3 ) + pb_varint( value )
+  return pb_varint( (number << 3) | 2 ) + pb_varint( len( value ) ) + value
+
+def pb_trip_update( entity_id, trip_id, updates=(), relationship=None, start_date=None ):
+  trip = pb_field( 1, trip_id )
+  if start_date is not None:
+    trip += pb_field( 3, start_date )
+  if relationship is not None:
+    trip += pb_field( 4, relationship )
+  trip_update = pb_field( 1, trip ) + "".join( pb_field( 2, update ) for update in updates )
+  return pb_field( 1, entity_id ) + pb_field( 3, trip_update )
+
+def pb_feed( entities, incrementality=realtime.FULL_DATASET ):
+  header = pb_field( 1, "2.0" ) + pb_field( 2, incrementality ) + pb_field( 3, 1152000000 )
+  return pb_field( 1, header ) + "".join( pb_field( 2, entity ) for entity in entities )
+
+
+class TestRealtime(unittest.TestCase):
+  def setUp(self):
+    curpath = os.path.dirname(os.path.realpath(__file__))
+    self.schedule = load( os.path.join(curpath,"data/sample-feed.zip") )
+    self.overlay = realtime.Overlay( self.schedule, date(2006, 7, 5), midnight=0 )
+    # AWD1 leaves S1 at 370, S3 at 380 and reaches S6 at 405
+    self.late = pb_trip_update( "1", "AWD1", [
+      pb_field( 1, 3 ) + pb_field( 2, pb_field( 1, 60 ) ) + pb_field( 3, pb_field( 1, 90 ) ),
+      pb_field( 4, "S6" ) + pb_field( 5, realtime.SKIPPED )] )
+
+  def test_parse( self ):
+    vehicle = pb_field( 1, "2" ) + pb_field( 4, pb_field( 1, "bus" ) )
+    data = pb_feed( [self.late, vehicle,
+                     pb_trip_update( "3", "AWE1", [pb_field( 1, 1 ) + pb_field( 2, pb_field( 2, 400 ) ) +
+                                                   pb_field( 9, 7 )] )] )
+    message = realtime.parse_feed( data )
+    self.assertEqual( message[:3], ("2.0", realtime.FULL_DATASET, 1152000000) )
+    self.assertEqual( [entity.id for entity in message.entities], ["1", "3"] )
+    updates = message.entities[0].trip_update.stop_time_updates
+    self.assertEqual( updates[0], realtime.StopTimeUpdate( 3, None, 60, None, 90, None, 0 ) )
+    self.assertEqual( updates[1].stop_id, "S6" )
+    self.assertEqual( message.entities[1].trip_update.stop_time_updates[0].arrival_time, 400 )
+    self.assertEqual( realtime.parse_feed( pb_feed( [pb_trip_update( "4", "AWD1", [
+      pb_field( 1, 1 ) + pb_field( 3, pb_field( 1, -30 ) )] )] ) ).entities[0].trip_update.
+      stop_time_updates[0].departure_delay, -30 )
+    self.assertRaises( realtime.DecodeError, realtime.parse_feed, data[:-3] )
+    self.assertRaises( realtime.DecodeError, realtime.parse_feed, pb_feed( [pb_trip_update( "\xc3", "AWD1" )] ) )
+
+  def test_overlay( self ):
+    self.assertEqual( self.overlay.apply( pb_feed( [self.late] ) ), 1 )
+    (sequences, arrivals, departures, skipped) = self.overlay.stop_times( "AWD1" )
+    # untimed stop times stay untimed, and the delay carries on to S6
+    self.assertEqual( arrivals.tolist(), [370, -1, 440, -1, -1, 495] )
+    self.assertEqual( departures.tolist(), [370, -1, 470, -1, -1, 495] )
+    self.assertEqual( skipped.tolist(), [False] * 5 + [True] )
+
+    (departure,) = self.overlay.departures( "S3", 0, 1000 )
+    self.assertEqual( departure.trip_id, "AWD1" )
+    self.assertEqual( (departure.departure_time, departure.predicted_arrival_time,
+                       departure.predicted_departure_time, departure.skipped),
+                      (380, 440, 470, False) )
+    self.assertTrue( self.overlay.departures( "S6", 0, 1000 )[0].skipped )
+    # nothing is written to the database
+    self.assertEqual( self.schedule.departures( "S3", date(2006, 7, 5), 0, 1000 )[0].departure_time, 380 )
+
+  def test_incremental( self ):
+    self.overlay.apply( pb_feed( [self.late] ) )
+    # a POSIX time, counted from midnight, and an update for another day
+    early = pb_trip_update( "2", "AWD1", [pb_field( 1, 6 ) + pb_field( 2, pb_field( 2, 400 ) )] )
+    tomorrow = pb_trip_update( "3", "AWD1", [pb_field( 1, 1 ) + pb_field( 2, pb_field( 1, 600 ) )],
+                               start_date="20060706" )
+    self.assertEqual( self.overlay.apply( pb_feed( [early, tomorrow], realtime.DIFFERENTIAL ) ), 1 )
+    self.assertEqual( self.overlay.stop_times( "AWD1" )[1].tolist(), [370, -1, 380, -1, -1, 400] )
+
+    self.overlay.apply( pb_feed( [pb_field( 1, "2" ) + pb_field( 2, 1 )], realtime.DIFFERENTIAL ) )
+    self.assertEqual( self.overlay.stop_times( "AWD1" )[1].tolist(), [370, -1, 380, -1, -1, 405] )
+
+    self.overlay.apply( pb_feed( [pb_trip_update( "4", "AWD1", relationship=realtime.CANCELED )] ) )
+    self.assertTrue( all( departure.skipped for departure in self.overlay.departures( "S1", 0, 1000 ) ) )
+    self.overlay.apply( pb_feed( [] ) )
+    self.assertFalse( self.overlay.stop_times( "AWD1" )[3].any() )
+
+    # trip updates are applied together; a later one of the same trip wins, and a
+    # trip delay holds up to the first stop time update
+    delayed = pb_field( 1, "6" ) + pb_field( 3, pb_field( 1, pb_field( 1, "AWD1" ) ) + pb_field( 5, 20 ) +
+                                             pb_field( 2, pb_field( 1, 6 ) + pb_field( 2, pb_field( 1, 5 ) ) ) )
+    self.assertEqual( self.overlay.apply( pb_feed( [self.late, delayed] ) ), 2 )
+    self.assertEqual( self.overlay.stop_times( "AWD1" )[1].tolist(), [390, -1, 400, -1, -1, 410] )
+    self.assertFalse( self.overlay.stop_times( "AWD1" )[3].any() )
+
+
 if __name__=='__main__':
   unittest.main()